@@ -0,0 +1,239 @@
+from array import array
+from decimal import Decimal
+from threading import Lock
+from Profiles.models import Wallet
+from .models import Bet, MatchBettingGroup, pool_amount, pool_percent
+import heapq
+
+# The bets on an open betting group, held in memory as parallel arrays of wallet ids, sides and amounts rather than
+# Bet instances, with running totals for each side and each bettor. A hundred thousand bets take a couple of megabytes,
+# and the totals, the pool split per bettor and the odds can be worked out without going back to the database
+#
+# Each process builds a market from the Bet table the first time it is needed, and after that only reads the bets
+# placed since the last one it has. A market found behind the running totals on the betting group, say because a bet
+# with an earlier id was committed late, is built again
+
+SIDE_A = 0
+SIDE_B = 1
+# A bet on neither side of the match, which still counts towards the pool
+NEITHER = 2
+
+_markets = {}
+_lock = Lock()
+
+
+def to_pennies(amount):
+    return int(amount * 100)
+
+
+def to_pounds(pennies):
+    return Decimal(pennies).scaleb(-2)
+
+
+def implied_probability(side_total, total):
+    ''' The chance of a side winning that the pool prices in, or None if nothing has been staked. '''
+    if not total:
+        return None
+    return float(side_total) / float(total)
+
+
+def payout_multiplier(side_total, total):
+    ''' What each pound staked on a side is paid back if it wins, as settlement works it out, or None if nothing is on
+    the side. '''
+    if not side_total:
+        return None
+    return float(total) / float(side_total)
+
+
+class Market:
+    ''' The bets on one betting group. sides maps the chosen team or user id a bet is placed with to its side, and
+    side_names are what each side is called in the pool. Amounts are kept in pennies. '''
+
+    def __init__(self, betting_group_id, side_field, sides, side_names):
+        self.betting_group_id = betting_group_id
+        self.side_field = side_field
+        self.sides = sides
+        self.side_names = side_names
+
+        # One entry per bet
+        self.bet_ids = array('q')
+        self.wallets = array('q')
+        self.bet_sides = array('b')
+        self.amounts = array('q')
+        # One entry per bettor, in the order they first bet, with what they have on each side
+        self.positions = {}
+        self.bettors = array('q')
+        self.stakes = (array('q'), array('q'))
+
+        self.totals = [0, 0, 0]
+        self.total = 0
+        self.last_id = 0
+        # Names and colours of bettors listed in the pool, which don't change with the bets
+        self.names = {}
+        self.lock = Lock()
+
+    @classmethod
+    def for_group(cls, match_betting_group):
+        ''' An empty market for the betting group, with its sides taken from the match. '''
+        match = match_betting_group.match
+        if match.team_a_id:
+            return cls(
+                match_betting_group.id, 'chosen_team_id', {match.team_a_id: SIDE_A, match.team_b_id: SIDE_B},
+                (match.team_a.name, match.team_b.name)
+            )
+        return cls(
+            match_betting_group.id, 'chosen_user_id', {match.user_a_id: SIDE_A, match.user_b_id: SIDE_B},
+            (match.user_a.profile.user.username, match.user_b.profile.user.username)
+        )
+
+    def append(self, bet_id, wallet_id, side, pennies):
+        self.bet_ids.append(bet_id)
+        self.wallets.append(wallet_id)
+        self.bet_sides.append(side)
+        self.amounts.append(pennies)
+        self.totals[side] += pennies
+        self.total += pennies
+
+        position = self.positions.get(wallet_id)
+        if position is None:
+            position = self.positions[wallet_id] = len(self.bettors)
+            self.bettors.append(wallet_id)
+            self.stakes[SIDE_A].append(0)
+            self.stakes[SIDE_B].append(0)
+        if side != NEITHER:
+            self.stakes[side][position] += pennies
+        if bet_id > self.last_id:
+            self.last_id = bet_id
+
+    def catch_up(self):
+        ''' Add the bets placed since the last one the market has, with one query. '''
+        bets = Bet.objects.filter(
+            match_betting_group_id=self.betting_group_id,
+            id__gt=self.last_id
+        ).order_by('id').values_list('id', 'wallet_id', self.side_field, 'amount')
+        sides = self.sides
+        # Read in full rather than streamed, so the query isn't left open holding up bets being written
+        for bet_id, wallet_id, chosen_id, amount in list(bets):
+            self.append(bet_id, wallet_id, sides.get(chosen_id, NEITHER), to_pennies(amount))
+
+    def behind(self, match_betting_group):
+        ''' Whether the betting group's running totals have bets in them the market hasn't seen. '''
+        return self.total < to_pennies(match_betting_group.total_staked)
+
+    def side_total(self, side):
+        return to_pounds(self.totals[side])
+
+    @property
+    def total_staked(self):
+        return to_pounds(self.total)
+
+    @property
+    def bettor_count(self):
+        return len(self.positions)
+
+    def stake(self, wallet_id):
+        ''' What the wallet has on each side. '''
+        position = self.positions.get(wallet_id)
+        if position is None:
+            return Decimal(0), Decimal(0)
+        return to_pounds(self.stakes[SIDE_A][position]), to_pounds(self.stakes[SIDE_B][position])
+
+    def implied_probabilities(self):
+        return tuple(implied_probability(self.totals[side], self.total) for side in (SIDE_A, SIDE_B))
+
+    def payout_multipliers(self):
+        return tuple(payout_multiplier(self.totals[side], self.total) for side in (SIDE_A, SIDE_B))
+
+    def bettor_pool(self, top=None):
+        ''' The same pool as MatchBettingGroup.bettor_pool, worked out from the arrays. Only the names of the bettors
+        listed that haven't been listed before are read from the database. '''
+        with self.lock:
+            return self.split_pool(top)
+
+    def split_pool(self, top):
+        # Only the top bettors on each side need putting in order, the rest of the side is what's left of its total
+        rows = []
+        others = []
+        for side in (SIDE_A, SIDE_B):
+            # Largest first, so stakes are negated
+            stakes = [
+                (-pennies, wallet_id, side) for wallet_id, pennies in zip(self.bettors, self.stakes[side]) if pennies
+            ]
+            if top is not None and len(stakes) > top:
+                stakes = heapq.nsmallest(top + 1, stakes)
+                # The sides' Others slices go in the order their first bettor left out comes in, as in the database's
+                # version
+                first_left_out = stakes.pop()
+                listed = -sum(stake[0] for stake in stakes)
+                others.append((first_left_out, side, self.totals[side] - listed))
+            rows.extend(stakes)
+        rows.sort()
+        others.sort()
+        slices = [(wallet_id, -pennies, side) for pennies, wallet_id, side in rows]
+
+        unnamed = {wallet_id for wallet_id, pennies, side in slices if wallet_id not in self.names}
+        if unnamed:
+            for wallet_id, name, colour in Wallet.objects.filter(id__in=unnamed).values_list(
+                'id', 'profile__user__username', 'profile__colour'
+            ):
+                self.names[wallet_id] = (name, colour)
+
+        total = to_pounds(self.total)
+        pool = []
+        for wallet_id, pennies, side in slices:
+            name, colour = self.names[wallet_id]
+            amount = to_pounds(pennies)
+            pool.append({
+                'name': name,
+                'amount': pool_amount(amount),
+                'percent': pool_percent(amount, total),
+                'team': self.side_names[side],
+                'colour': '#' + colour
+            })
+        for first_left_out, side, pennies in others:
+            amount = to_pounds(pennies)
+            pool.append({
+                'name': 'Others',
+                'amount': pool_amount(amount),
+                'percent': pool_percent(amount, total),
+                'team': self.side_names[side],
+                'colour': '#D3D3D3'
+            })
+        return pool
+
+
+def load_group(betting_group_id):
+    ''' The betting group with the match's sides, so a market can be made for it without reading them one at a time. '''
+    return MatchBettingGroup.objects.select_related(
+        'match__team_a',
+        'match__team_b',
+        'match__user_a__profile__user',
+        'match__user_b__profile__user'
+    ).get(id=betting_group_id)
+
+
+def get_market(match_betting_group):
+    ''' The market for a betting group, caught up with the running totals match_betting_group was loaded with. '''
+    betting_group_id = match_betting_group.id
+    with _lock:
+        market = _markets.get(betting_group_id)
+        if market is None:
+            market = _markets[betting_group_id] = Market.for_group(match_betting_group)
+
+    with market.lock:
+        if market.behind(match_betting_group):
+            market.catch_up()
+        if market.behind(match_betting_group):
+            # A bet was committed after one placed later than it, so it was skipped over
+            rebuilt = Market.for_group(match_betting_group)
+            rebuilt.catch_up()
+            rebuilt.names = market.names
+            with _lock:
+                _markets[betting_group_id] = market = rebuilt
+    return market
+
+
+def forget(betting_group_id):
+    ''' Drop a market that isn't needed here any more. '''
+    with _lock:
+        _markets.pop(betting_group_id, None)
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.1 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+def fill_pool_totals(apps, schema_editor):
+    MatchBettingGroup = apps.get_model('Bets', 'MatchBettingGroup')
+    Bet = apps.get_model('Bets', 'Bet')
+    for mbg in MatchBettingGroup.objects.select_related('match'):
+        match = mbg.match
+        totals = {'total_staked': 0, 'side_a_total': 0, 'side_b_total': 0, 'total_paid_out': 0}
+        wallets = set()
+        for bet in Bet.objects.filter(match_betting_group=mbg):
+            totals['total_staked'] += bet.amount
+            if (bet.chosen_team_id and bet.chosen_team_id == match.team_a_id) or \
+                    (bet.chosen_user_id and bet.chosen_user_id == match.user_a_id):
+                totals['side_a_total'] += bet.amount
+            elif (bet.chosen_team_id and bet.chosen_team_id == match.team_b_id) or \
+                    (bet.chosen_user_id and bet.chosen_user_id == match.user_b_id):
+                totals['side_b_total'] += bet.amount
+            if bet.status == 'Paid':
+                totals['total_paid_out'] += bet.winnings
+            wallets.add(bet.wallet_id)
+        MatchBettingGroup.objects.filter(id=mbg.id).update(bettor_count=len(wallets), **totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Bets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='bettor_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='side_a_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=9),
+        ),
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='side_b_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=9),
+        ),
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='total_paid_out',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=9),
+        ),
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='total_staked',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=9),
+        ),
+        migrations.RunPython(fill_pool_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.1 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Bets', '0002_pool_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchbettinggroup',
+            name='pool_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
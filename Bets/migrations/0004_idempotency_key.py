@@ -0,0 +1,23 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Profiles', '0002_auto_20190506_1119'),
+        ('Bets', '0003_pool_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bet',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='bet',
+            index_together={('wallet', 'idempotency_key')},
+        ),
+    ]
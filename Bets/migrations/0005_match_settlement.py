@@ -0,0 +1,24 @@
+# Generated by Django 2.2.1 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Games', '0002_auto_20190506_1233'),
+        ('Bets', '0004_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchSettlement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('winner', models.CharField(choices=[('Not Decided', 'Not Decided'), ('A is the winner', 'A is the winner'), ('B is the winner', 'B is the winner')], max_length=60)),
+                ('queued_at', models.DateTimeField()),
+                ('match', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, related_name='settlement', to='Games.Match')),
+            ],
+        ),
+    ]
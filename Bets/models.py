@@ -1,14 +1,30 @@
-from django.db import models
+from django.db import models, transaction
 from Games.models import Match
 from Groups.models import CommunityGroup
 from Profiles.models import Wallet, Team, Profile
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_init
+from django.db.models import F, Q, Sum, Count, Case, When, Value
+from django.db.models.functions import Coalesce
+from decimal import Decimal
 
 # Create your models here.
 
+
+def pool_amount(amount):
+    # Sums of stakes don't always come back from the database to the penny
+    return Decimal(amount).quantize(Decimal('0.01'))
+
+
+def pool_percent(amount, total):
+    # Share of the pool as a percentage, rounded for display
+    if not total:
+        return 0
+    return round(float(amount * 100 / total), 2)
+
+
 class MatchBettingGroup(models.Model):
     match = models.ForeignKey(Match, related_name='game_mbgs', on_delete=models.PROTECT)
     group = models.ForeignKey(CommunityGroup, related_name='group_mbgs', on_delete=models.PROTECT)
@@ -24,9 +40,115 @@ class MatchBettingGroup(models.Model):
                               default=active,
                               null=False,
                               blank=False)
+
+    # Running totals for the pool, kept up to date as bets are placed and settled so that pages showing the pool
+    # don't have to add up every bet
+    total_staked = models.DecimalField(max_digits=9, decimal_places=2, default=0, editable=False)
+    side_a_total = models.DecimalField(max_digits=9, decimal_places=2, default=0, editable=False)
+    side_b_total = models.DecimalField(max_digits=9, decimal_places=2, default=0, editable=False)
+    bettor_count = models.IntegerField(default=0, editable=False)
+    total_paid_out = models.DecimalField(max_digits=9, decimal_places=2, default=0, editable=False)
+    # Goes up by one every time the pool changes, so a page can tell whether the pool it is showing is out of date
+    pool_version = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         unique_together = ('match', 'group')
 
+    def side_total_field(self, chosen_team_id=None, chosen_user_id=None):
+        # Returns the name of the running total a bet on the given team or user counts towards
+        match = self.match
+        if chosen_team_id is not None:
+            sides = {match.team_a_id: 'side_a_total', match.team_b_id: 'side_b_total'}
+            return sides.get(chosen_team_id)
+        sides = {match.user_a_id: 'side_a_total', match.user_b_id: 'side_b_total'}
+        return sides.get(chosen_user_id)
+
+    def add_to_pool(self, amount, side_field, new_bettors=0):
+        ''' Add newly placed stakes to the running totals with a single UPDATE. '''
+        totals = {
+            'total_staked': F('total_staked') + amount,
+            'bettor_count': F('bettor_count') + new_bettors,
+            'pool_version': F('pool_version') + 1
+        }
+        if side_field is not None:
+            totals[side_field] = F(side_field) + amount
+        MatchBettingGroup.objects.filter(id=self.id).update(**totals)
+
+    def pool_totals(self):
+        # The running totals as they're sent out to the browser
+        return {
+            'total_bet': self.total_staked,
+            'side_a_total': self.side_a_total,
+            'side_b_total': self.side_b_total,
+            'bettor_count': self.bettor_count
+        }
+
+    @property
+    def odds(self):
+        # Worked out from the running totals already loaded, so listing match cards doesn't read anything more
+        from .odds import Odds
+        return Odds.for_group(self)
+
+    def bettor_pool(self, top=None):
+        ''' The stakes in the pool added up per bettor and side, largest first, with each one's share precomputed. '''
+        # Only the top bettors on each side are listed by name when top is given, with the rest of the side
+        # merged into an "Others" slice, so the pie stays in the same order as the team ring around it
+        rows = self.mbg_bets.values(
+            'wallet_id',
+            'wallet__profile__user__username',
+            'wallet__profile__colour',
+            'chosen_team__name',
+            'chosen_user__profile__user__username'
+        ).annotate(amount=Sum('amount')).order_by('-amount', 'wallet_id')
+
+        total = self.total_staked
+        pool = []
+        others = {}
+        listed = {}
+        for row in rows:
+            team = row['chosen_team__name'] or row['chosen_user__profile__user__username']
+            if top is not None and listed.get(team, 0) >= top:
+                others[team] = others.get(team, 0) + row['amount']
+                continue
+            listed[team] = listed.get(team, 0) + 1
+            pool.append({
+                'name': row['wallet__profile__user__username'],
+                'amount': pool_amount(row['amount']),
+                'percent': pool_percent(row['amount'], total),
+                'team': team,
+                'colour': '#' + row['wallet__profile__colour']
+            })
+        for team, amount in others.items():
+            pool.append({
+                'name': 'Others',
+                'amount': pool_amount(amount),
+                'percent': pool_percent(amount, total),
+                'team': team,
+                'colour': '#D3D3D3'
+            })
+        return pool
+
+    def refresh_pool(self):
+        self.refresh_from_db(fields=['total_staked', 'side_a_total', 'side_b_total', 'bettor_count', 'total_paid_out',
+                                     'pool_version'])
+
+    def recalculate_pool(self):
+        ''' Rebuild the running totals from the bets themselves. '''
+        match = self.match
+        side_a = Q(chosen_team_id=match.team_a_id) if match.team_a_id else Q(chosen_user_id=match.user_a_id)
+        side_b = Q(chosen_team_id=match.team_b_id) if match.team_b_id else Q(chosen_user_id=match.user_b_id)
+        zero = Value(0, output_field=models.DecimalField())
+        totals = self.mbg_bets.aggregate(
+            total_staked=Coalesce(Sum('amount'), zero),
+            side_a_total=Coalesce(Sum(Case(When(side_a, then=F('amount')), default=zero)), zero),
+            side_b_total=Coalesce(Sum(Case(When(side_b, then=F('amount')), default=zero)), zero),
+            bettor_count=Count('wallet', distinct=True),
+            total_paid_out=Coalesce(Sum('winnings', filter=Q(status=Bet.paid)), zero)
+        )
+        MatchBettingGroup.objects.filter(id=self.id).update(pool_version=F('pool_version') + 1, **totals)
+        for field, value in totals.items():
+            setattr(self, field, value)
+
     def __str__(self):
         return str(self.group.name) + "'s betting group for : " + str(self.match.__str__())
 
@@ -53,9 +175,15 @@ class Bet(models.Model):
 
     winnings = models.DecimalField(max_digits=7, decimal_places=2, default=0)
 
+    # Made up by the page placing the bet, so a bet sent again after a dropped connection isn't placed twice
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True, editable=False)
+
     created = models.DateTimeField(editable=False)
     modified = models.DateTimeField(editable=False)
 
+    class Meta:
+        index_together = ('wallet', 'idempotency_key')
+
     def clean(self):
         super(Bet, self).clean()
         # raise error if none are filled out or both are filled out
@@ -75,6 +203,17 @@ class Bet(models.Model):
     def __str__(self):
         return str(self.match_betting_group.match) + " | " + str(self.wallet.profile.user) + " | £" + str(self.amount) +" bet for: " + str(self.chosen_team)
 
+class MatchSettlement(models.Model):
+    # The last settlement queued for a match. Web and worker processes don't share a cache, so they check this row
+    # to avoid queueing the same result twice
+    match = models.OneToOneField(Match, related_name='settlement', on_delete=models.PROTECT)
+    winner = models.CharField(max_length=60, choices=Match.teams)
+    queued_at = models.DateTimeField()
+
+    def __str__(self):
+        return "Settlement of " + str(self.match) + " | " + self.winner
+
+
 # Create mbg upon Match creation
 @receiver(post_save, sender=Match)
 def create_mbg_on_match_creation(sender, instance, created, **kwargs):
@@ -83,4 +222,55 @@ def create_mbg_on_match_creation(sender, instance, created, **kwargs):
         mbg = MatchBettingGroup()
         mbg.match = match
         mbg.group = match.tournament.owning_group
-        mbg.save()
\ No newline at end of file
+        mbg.save()
+
+
+# Add each new bet to its betting group's running totals, inside whatever transaction created the bet
+@receiver(post_save, sender=Bet)
+def add_bet_to_pool_on_creation(sender, instance, created, **kwargs):
+    if created:
+        bet = instance
+        mbg = bet.match_betting_group
+        new_bettor = not Bet.objects.filter(
+            match_betting_group_id=bet.match_betting_group_id,
+            wallet_id=bet.wallet_id
+        ).exclude(id=bet.id).exists()
+        mbg.add_to_pool(bet.amount, mbg.side_total_field(bet.chosen_team_id, bet.chosen_user_id), int(new_bettor))
+
+
+result_fields = {'winner', 'status'}
+
+
+# Remember the result a match was loaded with so a change to it can be spotted on save
+@receiver(post_init, sender=Match)
+def remember_match_result(sender, instance, **kwargs):
+    # Reading a deferred field loads it, which would build another Match and end up back here
+    if result_fields & instance.get_deferred_fields():
+        instance._loaded_result = None
+        return
+    instance._loaded_result = (instance.winner, instance.status)
+
+
+# Queue settlement once a finished match has a confirmed winner
+@receiver(post_save, sender=Match)
+def queue_settlement_on_result_change(sender, instance, created, **kwargs):
+    from .settlement import is_settleable
+    from .tasks import queue_settlement
+
+    # A match saved without its result loaded can't have changed it
+    if result_fields <= instance.get_deferred_fields():
+        return
+    # The result a match was loaded with is unknown if it was deferred, so anything it's set to counts as a change
+    if (instance.winner, instance.status) != instance._loaded_result and is_settleable(instance):
+        queue_settlement(instance)
+    instance._loaded_result = (instance.winner, instance.status)
+
+
+# Sockets watching the match keep their own copy of it, so tell them when it's edited
+@receiver(post_save, sender=Match)
+def reload_match_rooms(sender, instance, created, **kwargs):
+    from Groups.room import match_changed
+
+    if not created:
+        match_id = instance.id
+        transaction.on_commit(lambda: match_changed(match_id))
@@ -0,0 +1,46 @@
+from decimal import Decimal
+from .market import implied_probability, payout_multiplier
+from .models import pool_percent
+
+# The odds on betting groups, worked out from the running totals kept on each of them rather than from their bets, so
+# the betting groups already loaded for a page of match cards are priced without reading anything more
+
+
+class Odds:
+    ''' The totals on each side of a betting group, the chance of each side winning that they price in, and what each
+    pound on a side would be paid back. '''
+
+    def __init__(self, betting_group_id, side_a_total, side_b_total, total_staked):
+        self.betting_group_id = betting_group_id
+        self.totals = (side_a_total, side_b_total)
+        self.total = total_staked
+        self.probabilities = tuple(implied_probability(side_total, total_staked) for side_total in self.totals)
+        self.multipliers = tuple(payout_multiplier(side_total, total_staked) for side_total in self.totals)
+
+    @classmethod
+    def for_group(cls, match_betting_group):
+        return cls(
+            match_betting_group.id,
+            match_betting_group.side_a_total,
+            match_betting_group.side_b_total,
+            match_betting_group.total_staked
+        )
+
+    @property
+    def percents(self):
+        # How a match's card splits its pie between the two sides, evenly until either has anything on it
+        side_a_total, side_b_total = self.totals
+        both = side_a_total + side_b_total
+        if not both:
+            return 50.0, 50.0
+        return pool_percent(side_a_total, both), pool_percent(side_b_total, both)
+
+    def payout(self, side, stake):
+        ''' What stake on side would be paid back if the side won, were it placed now. The stake goes into the pool
+        too, so it shortens the odds it is paid at, and the multiplier is rounded the way settlement rounds it. '''
+        # Nothing staked is paid nothing, even on a side with nothing on it yet
+        if stake <= 0:
+            return Decimal('0.00')
+        multiplier = ((self.total + stake) / (self.totals[side] + stake)).quantize(Decimal('0.0000000001'))
+        return (stake * multiplier).quantize(Decimal('0.01'))
+
@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Case, When, Value, DecimalField
+from django.utils import timezone
+from Profiles.models import Wallet
+from .models import Bet
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class DuplicateBet(Exception):
+    ''' The bet has already been placed, with the same idempotency key. bet is the one that was placed. '''
+
+    def __init__(self, bet):
+        super().__init__('Bet %s was already placed with key %s' % (bet.id, bet.idempotency_key))
+        self.bet = bet
+
+
+def recent_bets(wallet_ids, idempotency_keys):
+    # Bets placed with any of the keys within the last BET_DEDUPE_SECONDS. A retry is sent soon after the bet it
+    # repeats, so there is no need to look further back than that
+    since = timezone.now() - timezone.timedelta(seconds=settings.BET_DEDUPE_SECONDS)
+    return Bet.objects.filter(wallet_id__in=wallet_ids, idempotency_key__in=idempotency_keys, created__gte=since)
+
+
+def debit_wallet(wallet_id, amount):
+    ''' Take amount from a wallet with one conditional UPDATE, spending the non-withdrawable bank first. '''
+    # Both SET expressions are evaluated against the row as it was before the update, so the split is worked out
+    # from the same balances the WHERE clause checked
+    debited = Wallet.objects.annotate(
+        bank_total=F('withdrawable_bank') + F('non_withdrawable_bank')
+    ).filter(
+        id=wallet_id,
+        bank_total__gte=amount
+    ).update(
+        non_withdrawable_bank=Case(
+            When(non_withdrawable_bank__gte=amount, then=F('non_withdrawable_bank') - amount),
+            default=Value(0),
+            output_field=DecimalField()
+        ),
+        withdrawable_bank=Case(
+            When(non_withdrawable_bank__gte=amount, then=F('withdrawable_bank')),
+            default=F('withdrawable_bank') + F('non_withdrawable_bank') - amount,
+            output_field=DecimalField()
+        ),
+        modified=timezone.now()
+    )
+    if not debited:
+        raise InsufficientFunds('Wallet %s does not have %s to spend' % (wallet_id, amount))
+
+
+def place_bet(wallet_id, mbg, amount, chosen_team=None, chosen_user=None, idempotency_key=None):
+    ''' Debit the wallet and record the bet in one short transaction. '''
+    # With an idempotency key, a bet that repeats one placed recently raises DuplicateBet instead of being placed again.
+    # The wallet is locked first so a retry arriving alongside the original waits for it
+    with transaction.atomic():
+        if idempotency_key is not None:
+            Wallet.objects.select_for_update().filter(id=wallet_id).values_list('id').first()
+            duplicate = recent_bets([wallet_id], [idempotency_key]).first()
+            if duplicate is not None:
+                raise DuplicateBet(duplicate)
+        debit_wallet(wallet_id, amount)
+        bet = Bet.objects.create(
+            match_betting_group=mbg,
+            wallet_id=wallet_id,
+            amount=amount,
+            chosen_team=chosen_team,
+            chosen_user=chosen_user,
+            idempotency_key=idempotency_key
+        )
+    return bet
+
+
+def spend(wallet, amount):
+    # The same split as debit_wallet, worked out on a wallet that's already locked and loaded
+    if wallet.non_withdrawable_bank >= amount:
+        wallet.non_withdrawable_bank -= amount
+    else:
+        wallet.withdrawable_bank += wallet.non_withdrawable_bank - amount
+        wallet.non_withdrawable_bank = 0
+
+
+def place_bets(mbg, bets, idempotency_keys=None):
+    ''' Place a batch of bets on one betting group with the same handful of queries whatever the size of the batch. '''
+    # bets is a list of (wallet_id, amount, chosen) where chosen is the chosen_team or chosen_user keyword for the
+    # bet, and idempotency_keys an optional list of the bets' keys in the same order. Returns the new Bet, or the
+    # InsufficientFunds or DuplicateBet it was refused with, for each one in the same order
+    now = timezone.now()
+    results = []
+    if idempotency_keys is None:
+        idempotency_keys = [None] * len(bets)
+    with transaction.atomic():
+        wallets = {wallet.id: wallet for wallet in Wallet.objects.select_for_update().filter(
+            id__in={wallet_id for wallet_id, amount, chosen in bets}
+        )}
+        placed = {}
+        if any(idempotency_keys):
+            placed = {(bet.wallet_id, bet.idempotency_key): bet for bet in recent_bets(
+                list(wallets), [idempotency_key for idempotency_key in idempotency_keys if idempotency_key]
+            )}
+
+        new_bets = []
+        debited = {}
+        for (wallet_id, amount, chosen), idempotency_key in zip(bets, idempotency_keys):
+            duplicate = placed.get((wallet_id, idempotency_key))
+            if duplicate is not None:
+                results.append(DuplicateBet(duplicate))
+                continue
+            wallet = wallets.get(wallet_id)
+            if wallet is None or wallet.withdrawable_bank + wallet.non_withdrawable_bank < amount:
+                results.append(InsufficientFunds('Wallet %s does not have %s to spend' % (wallet_id, amount)))
+                continue
+            spend(wallet, amount)
+            wallet.modified = now
+            debited[wallet_id] = wallet
+            bet = Bet(match_betting_group=mbg, wallet_id=wallet_id, amount=amount, idempotency_key=idempotency_key,
+                      created=now, modified=now, **chosen)
+            new_bets.append(bet)
+            results.append(bet)
+            # The same bet sent twice in one batch
+            if idempotency_key is not None:
+                placed[(wallet_id, idempotency_key)] = bet
+
+        if new_bets:
+            Wallet.objects.bulk_update(debited.values(), ['withdrawable_bank', 'non_withdrawable_bank', 'modified'])
+            # bulk_create doesn't send post_save, so the running totals are added to here instead
+            returning = set(mbg.mbg_bets.filter(wallet_id__in=debited).values_list('wallet_id', flat=True))
+            Bet.objects.bulk_create(new_bets)
+
+            sides = {}
+            for bet in new_bets:
+                side_field = mbg.side_total_field(chosen_team_id=bet.chosen_team_id, chosen_user_id=bet.chosen_user_id)
+                sides[side_field] = sides.get(side_field, 0) + bet.amount
+            new_bettors = len(set(debited) - returning)
+            for side_field, amount in sides.items():
+                mbg.add_to_pool(amount, side_field, new_bettors)
+                new_bettors = 0
+    return results
@@ -0,0 +1,130 @@
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Q, F, Sum, Case, When, Value, DecimalField, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from Games.models import Match
+from Profiles.models import Wallet
+from .models import Bet, MatchBettingGroup
+
+
+class SettlementError(Exception):
+    pass
+
+
+# Statuses a match with a decided winner can be settled from. Payouts can't be taken back, so the winner has to have
+# been confirmed first
+settleable_statuses = (Match.finished_confirmed,)
+
+
+def winning_side(match):
+    # Bets are placed on a Team for team matches and on a Wallet for user vs user matches, so the winning side is
+    # whichever of the two is filled out on the winning half of the match
+    if match.winner == Match.a_winner:
+        team_id, user_id = match.team_a_id, match.user_a_id
+    elif match.winner == Match.b_winner:
+        team_id, user_id = match.team_b_id, match.user_b_id
+    else:
+        raise SettlementError('Match %s cannot be settled until a winner has been decided' % match.id)
+
+    if team_id is not None:
+        return Q(chosen_team_id=team_id)
+    return Q(chosen_user_id=user_id)
+
+
+def settle_betting_group(mbg, match=None, limit=None):
+    ''' Settle open bets in a pari-mutuel pool with a fixed number of bulk UPDATEs, at most `limit` of them if given.
+    Returns the number of bets settled. '''
+    if match is None:
+        match = mbg.match
+    winners = winning_side(match)
+
+    with transaction.atomic():
+        # Lock the pool so two settlements of the same betting group cannot interleave
+        MatchBettingGroup.objects.select_for_update().get(id=mbg.id)
+
+        bets = Bet.objects.filter(match_betting_group_id=mbg.id)
+        pool = bets.aggregate(
+            total=Sum('amount'),
+            winning_total=Sum(Case(When(winners, then=F('amount')), default=Value(0), output_field=DecimalField()))
+        )
+        # The bets settled here are picked out by id, so the winnings credited below are exactly theirs
+        open_ids = bets.filter(status=Bet.open).order_by('id').values_list('id', flat=True)
+        if limit is not None:
+            # The multiplier above is always worked out from the whole pool, so the pool can be paid out in pieces
+            open_ids = open_ids[:limit]
+        settling = list(open_ids)
+        if not settling:
+            return 0
+        open_bets = Bet.objects.filter(id__in=settling, status=Bet.open)
+        settled_at = timezone.now()
+
+        if not pool['winning_total']:
+            # Nobody backed the winner, so the pool is returned to the people who paid into it
+            settled = open_bets.update(status=Bet.paid, winnings=F('amount'), modified=settled_at)
+        else:
+            # Work out the multiplier here rather than dividing in SQL, where some backends do integer division
+            multiplier = (pool['total'] / pool['winning_total']).quantize(Decimal('0.0000000001'))
+            payout = ExpressionWrapper(F('amount') * multiplier, output_field=DecimalField(max_digits=7, decimal_places=2))
+            settled = open_bets.filter(winners).update(status=Bet.paid, winnings=payout, modified=settled_at)
+            settled += open_bets.update(status=Bet.lost, winnings=0, modified=settled_at)
+
+        paid_bets = Bet.objects.filter(id__in=settling, status=Bet.paid)
+        wallet_winnings = Subquery(
+            paid_bets.filter(wallet_id=OuterRef('pk')).order_by().values('wallet')
+            .annotate(total=Sum('winnings')).values('total'),
+            output_field=DecimalField()
+        )
+        Wallet.objects.filter(id__in=paid_bets.values('wallet')).update(
+            withdrawable_bank=F('withdrawable_bank') + wallet_winnings,
+            modified=settled_at
+        )
+        pool_winnings = Subquery(
+            paid_bets.order_by().values('match_betting_group').annotate(total=Sum('winnings')).values('total'),
+            output_field=DecimalField()
+        )
+        MatchBettingGroup.objects.filter(id=mbg.id).update(
+            total_paid_out=F('total_paid_out') + Coalesce(pool_winnings, Value(0))
+        )
+
+    return settled
+
+
+def is_settleable(match):
+    return match.winner in (Match.a_winner, Match.b_winner) and match.status in settleable_statuses
+
+
+def settle_match_chunk(match, chunk_size):
+    ''' Settle up to chunk_size open bets on a decided and confirmed match.
+    Returns True once every bet has been settled and the match has been marked as paid. '''
+    winning_side(match)
+    if match.status not in settleable_statuses:
+        raise SettlementError('Match %s cannot be settled until its winner has been confirmed' % match.id)
+
+    settled = 0
+    for mbg in match.game_mbgs.all():
+        settled += settle_betting_group(mbg, match, limit=chunk_size - settled)
+        if settled >= chunk_size:
+            return False
+
+    Match.objects.filter(id=match.id, status=Match.finished_confirmed).update(status=Match.finished_paid)
+    match.status = Match.finished_paid
+    return True
+
+
+def settle_match(match):
+    ''' Settle all betting groups attached to a decided match and mark it as paid. '''
+    # Fail before taking any locks if the match isn't ready
+    winning_side(match)
+    if match.status not in settleable_statuses:
+        raise SettlementError('Match %s cannot be settled until its winner has been confirmed' % match.id)
+
+    settled = 0
+    with transaction.atomic():
+        for mbg in match.game_mbgs.all():
+            settled += settle_betting_group(mbg, match)
+
+        Match.objects.filter(id=match.id, status=Match.finished_confirmed).update(status=Match.finished_paid)
+        match.status = Match.finished_paid
+
+    return settled
@@ -1,7 +1,48 @@
 from CommunityTournaments.celery import app
+from django.conf import settings
+from django.db import transaction
+from Games.models import Match
+from django.utils import timezone
+from datetime import timedelta
+from .models import MatchSettlement
+from .settlement import is_settleable, settle_match_chunk
 
 
 @app.task
 def add(x, y):
     return x + y
 
+
+@app.task(ignore_result=True)
+def settle_match_task(match_id):
+    match = Match.objects.get(id=match_id)
+
+    # The result may have been changed again since this task was queued
+    if not is_settleable(match):
+        return
+
+    if not settle_match_chunk(match, settings.SETTLEMENT_CHUNK_SIZE):
+        # Hand the rest of the pool to a fresh task so one huge match doesn't hold on to a worker
+        settle_match_task.delay(match_id)
+
+
+def queue_settlement(match):
+    # Double submitted winner forms would otherwise queue the same settlement twice. The match's settlement row is
+    # locked while it's checked, so only one of the processes saving the same result queues it. Settlement only ever
+    # touches open bets so a duplicate that slips through is harmless, it just wastes a worker
+    queued_at = timezone.now()
+    with transaction.atomic():
+        settlement, created = MatchSettlement.objects.select_for_update().get_or_create(
+            match_id=match.id,
+            defaults={'winner': match.winner, 'queued_at': queued_at}
+        )
+        if not created:
+            dedupe_window = timedelta(seconds=settings.SETTLEMENT_DEDUPE_SECONDS)
+            if settlement.winner == match.winner and queued_at - settlement.queued_at < dedupe_window:
+                return
+            settlement.winner = match.winner
+            settlement.queued_at = queued_at
+            settlement.save()
+
+    match_id = match.id
+    transaction.on_commit(lambda: settle_match_task.delay(match_id))
@@ -1,3 +1,827 @@
 from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from decimal import Decimal
+from Groups.models import CommunityGroup
+from Games.models import Tournament, Match
+from Profiles.models import Wallet
+from Bets.models import MatchBettingGroup, Bet, MatchSettlement
+from Bets.settlement import settle_betting_group, settle_match, settle_match_chunk, SettlementError
+from Bets.tasks import settle_match_task, queue_settlement
+from Bets.placement import place_bet, place_bets, InsufficientFunds, DuplicateBet
+from Bets import market
+from Bets.market import get_market
+from Bets.odds import Odds
+from django.test import override_settings
+User = get_user_model()
+
 
 # Create your tests here.
+class SettlementTests(TestCase):
+    # Settlement takes a decided match and pays out every betting group attached to it as a pari-mutuel pool:
+    # the winners split the whole pool in proportion to their stake and the losers get nothing
+    # ----
+    # Test 1: Test that winning bets are paid their share of the pool and losing bets are marked as lost
+    # Test 2: Test that winnings are credited to the withdrawable bank of each winning wallet
+    # Test 3: Test that the match is marked as paid
+    # Test 4: Test that stakes are refunded when nobody backed the winner
+    # Test 5: Test that settling a match twice does not pay anybody twice
+    # Test 6: Test that a match without a winner cannot be settled
+    # Test 7: Test that the number of queries does not depend on the number of bets
+    # Test 8: Test that a match whose winner hasn't been confirmed is not paid out
+    # Test 9: Test that settling a betting group again pays nobody who was paid by an earlier settlement
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor_1, self.bettor_2 = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        # 30 on a and 10 on b, so a 40 pool
+        self.bet_1 = Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_1, amount=10,
+                                        chosen_user=self.player_a)
+        self.bet_2 = Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_2, amount=20,
+                                        chosen_user=self.player_a)
+        self.bet_3 = Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_1, amount=10,
+                                        chosen_user=self.player_b)
+
+    def decide(self, winner):
+        self.match.winner = winner
+        self.match.status = Match.finished_confirmed
+        self.match.save()
+
+    def test_1_winners_and_losers(self):
+        self.decide(Match.a_winner)
+
+        settled = settle_match(self.match)
+        self.assertEqual(settled, 3)
+
+        bet_1 = Bet.objects.get(id=self.bet_1.id)
+        bet_2 = Bet.objects.get(id=self.bet_2.id)
+        bet_3 = Bet.objects.get(id=self.bet_3.id)
+
+        self.assertEqual(bet_1.status, Bet.paid)
+        self.assertEqual(bet_1.winnings, Decimal('13.33'))
+        self.assertEqual(bet_2.status, Bet.paid)
+        self.assertEqual(bet_2.winnings, Decimal('26.67'))
+        self.assertEqual(bet_3.status, Bet.lost)
+        self.assertEqual(bet_3.winnings, 0)
+
+    def test_2_wallets_credited(self):
+        self.decide(Match.b_winner)
+
+        settle_match(self.match)
+
+        self.assertEqual(Wallet.objects.get(id=self.bettor_1.id).withdrawable_bank, Decimal('140'))
+        self.assertEqual(Wallet.objects.get(id=self.bettor_2.id).withdrawable_bank, Decimal('100'))
+        self.assertEqual(Wallet.objects.get(id=self.player_a.id).withdrawable_bank, Decimal('100'))
+
+    def test_3_match_marked_as_paid(self):
+        self.decide(Match.a_winner)
+
+        settle_match(self.match)
+
+        self.assertEqual(self.match.status, Match.finished_paid)
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_paid)
+
+    def test_4_refund_when_nobody_backed_winner(self):
+        self.bet_3.delete()
+        self.decide(Match.b_winner)
+
+        settle_match(self.match)
+
+        for bet in Bet.objects.filter(match_betting_group=self.mbg):
+            self.assertEqual(bet.status, Bet.paid)
+            self.assertEqual(bet.winnings, bet.amount)
+
+        self.assertEqual(Wallet.objects.get(id=self.bettor_1.id).withdrawable_bank, Decimal('110'))
+        self.assertEqual(Wallet.objects.get(id=self.bettor_2.id).withdrawable_bank, Decimal('120'))
+
+    def test_5_settling_twice(self):
+        self.decide(Match.a_winner)
+
+        settle_match(self.match)
+        with self.assertRaises(SettlementError):
+            settle_match(self.match)
+
+        self.assertEqual(Wallet.objects.get(id=self.bettor_2.id).withdrawable_bank, Decimal('126.67'))
+
+    def test_6_undecided_match(self):
+        self.assertEqual(self.match.winner, Match.not_decided)
+
+        with self.assertRaises(SettlementError):
+            settle_match(self.match)
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 3)
+
+    def test_7_constant_number_of_queries(self):
+        for x in range(50):
+            Bet.objects.create(match_betting_group=self.mbg, wallet=self.wallets[x % 4], amount=1,
+                               chosen_user=self.player_b)
+        self.decide(Match.a_winner)
+
+        # 2 savepoints each side of: betting groups, lock, pool totals, open bets, winners, losers, wallets,
+        # pool paid out, match status
+        with self.assertNumQueries(13):
+            settle_match(self.match)
+
+    def test_8_unconfirmed_match(self):
+        self.decide(Match.a_winner)
+        Match.objects.filter(id=self.match.id).update(status=Match.finished_not_confirmed)
+        self.match.refresh_from_db()
+
+        with self.assertRaises(SettlementError):
+            settle_match(self.match)
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 3)
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_not_confirmed)
+
+    def test_9_settling_group_again(self):
+        self.decide(Match.a_winner)
+        settle_match(self.match)
+        Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_1, amount=10, chosen_user=self.player_a)
+
+        # The new bet is settled on its own, whatever the timestamps of the bets paid before it
+        settled = settle_betting_group(self.mbg, self.match)
+
+        self.assertEqual(settled, 1)
+        self.assertEqual(Wallet.objects.get(id=self.bettor_2.id).withdrawable_bank, Decimal('126.67'))
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 0)
+
+
+class SettlementTaskTests(TestCase):
+    # Confirming the result of a finished match queues a settlement task, which pays the pools out in chunks and moves
+    # the match from confirmed to paid
+    # ----
+    # Test 1: Test that settling in chunks pays the same as settling in one go
+    # Test 2: Test that the match stays confirmed while chunks remain and is paid once they're done
+    # Test 3: Test that the task settles a decided match
+    # Test 4: Test that the task ignores a match whose winner has been unset since it was queued
+    # Test 5: Test that changing the result queues settlement only once, and only for a confirmed match
+    # Test 6: Test that a match whose winner hasn't been confirmed is never paid out
+    # Test 7: Test that matches loaded without their result can be read and saved
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor_1, self.bettor_2 = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        for x in range(1, 11):
+            Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_1, amount=x,
+                               chosen_user=self.player_a)
+            Bet.objects.create(match_betting_group=self.mbg, wallet=self.bettor_2, amount=x,
+                               chosen_user=self.player_b)
+
+        self.match.winner = Match.a_winner
+        self.match.status = Match.finished_confirmed
+        self.match.save()
+
+    def test_1_chunks_pay_the_same(self):
+        while not settle_match_chunk(self.match, 3):
+            pass
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).exists())
+        # The whole pool of 110 goes to bettor 1, who staked 55 of it
+        self.assertEqual(Wallet.objects.get(id=self.bettor_1.id).withdrawable_bank, Decimal('210'))
+        self.assertEqual(Wallet.objects.get(id=self.bettor_2.id).withdrawable_bank, Decimal('100'))
+
+    def test_2_status_progression(self):
+        self.assertFalse(settle_match_chunk(self.match, 5))
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_confirmed)
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 15)
+
+        self.assertTrue(settle_match_chunk(self.match, 20))
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_paid)
+
+    @override_settings(SETTLEMENT_CHUNK_SIZE=100)
+    def test_3_task_settles_match(self):
+        settle_match_task.apply(args=(self.match.id,))
+
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_paid)
+        self.assertEqual(Wallet.objects.get(id=self.bettor_1.id).withdrawable_bank, Decimal('210'))
+
+    def test_4_task_ignores_undecided_match(self):
+        Match.objects.filter(id=self.match.id).update(winner=Match.not_decided)
+
+        settle_match_task.apply(args=(self.match.id,))
+
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_confirmed)
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 20)
+
+    def test_5_result_change_queues_once(self):
+        queued_at = MatchSettlement.objects.get(match=self.match).queued_at
+
+        # Changing the winner of a match that hasn't been confirmed doesn't queue anything
+        for status in (Match.running, Match.finished, Match.finished_not_confirmed):
+            self.match.status = status
+            self.match.winner = Match.b_winner
+            self.match.save()
+            self.assertEqual(MatchSettlement.objects.get(match=self.match).winner, Match.a_winner)
+
+        self.match.status = Match.finished_confirmed
+        self.match.save()
+        settlement = MatchSettlement.objects.get(match=self.match)
+        self.assertEqual(settlement.winner, Match.b_winner)
+        self.assertGreater(settlement.queued_at, queued_at)
+
+        # A second submission of the same result is dropped, whichever process saves it
+        queue_settlement(Match.objects.get(id=self.match.id))
+        self.assertEqual(MatchSettlement.objects.get(match=self.match).queued_at, settlement.queued_at)
+
+        # Once the dedupe window has passed it can be queued again
+        MatchSettlement.objects.filter(match=self.match).update(queued_at=timezone.now() - timezone.timedelta(seconds=61))
+        queue_settlement(Match.objects.get(id=self.match.id))
+        self.assertGreater(MatchSettlement.objects.get(match=self.match).queued_at, settlement.queued_at)
+
+    def test_6_unconfirmed_match_not_paid(self):
+        Match.objects.filter(id=self.match.id).update(status=Match.finished_not_confirmed)
+        match = Match.objects.get(id=self.match.id)
+
+        with self.assertRaises(SettlementError):
+            settle_match_chunk(match, 20)
+        settle_match_task.apply(args=(self.match.id,))
+
+        self.assertEqual(Match.objects.get(id=self.match.id).status, Match.finished_not_confirmed)
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg, status=Bet.open).count(), 20)
+
+    def test_7_deferred_result(self):
+        match = Match.objects.only('id').get(id=self.match.id)
+        self.assertEqual(match.winner, Match.a_winner)
+
+        queued_at = MatchSettlement.objects.get(match=self.match).queued_at
+        match = Match.objects.defer('winner', 'status').get(id=self.match.id)
+        match.save()
+        self.assertEqual(MatchSettlement.objects.get(match=self.match).queued_at, queued_at)
+
+
+class PlacementTests(TestCase):
+    # Placing a bet takes the stake from the wallet with one conditional UPDATE and records the bet in the same
+    # transaction. The non-withdrawable bank is always spent before the withdrawable one
+    # ----
+    # Test 1: Test that a stake covered by the non-withdrawable bank only comes out of it
+    # Test 2: Test that a larger stake is split across both banks
+    # Test 3: Test that a stake larger than the wallet is rejected and nothing changes
+    # Test 4: Test that a stale wallet instance cannot be used to overdraw the wallet
+    # Test 5: Test that a bet repeating a recent one's idempotency key isn't placed again
+    # Test 6: Test that an idempotency key stops counting once it's older than the dedupe window
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 4):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=20,
+                non_withdrawable_bank=10
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+    def test_1_non_withdrawable_first(self):
+        bet = place_bet(self.bettor.id, self.mbg, Decimal('7.50'), chosen_user=self.player_a)
+
+        wallet = Wallet.objects.get(id=self.bettor.id)
+        self.assertEqual(wallet.non_withdrawable_bank, Decimal('2.50'))
+        self.assertEqual(wallet.withdrawable_bank, Decimal('20'))
+        self.assertEqual(Bet.objects.get(id=bet.id).amount, Decimal('7.50'))
+
+    def test_2_split_across_banks(self):
+        place_bet(self.bettor.id, self.mbg, Decimal('25'), chosen_user=self.player_b)
+
+        wallet = Wallet.objects.get(id=self.bettor.id)
+        self.assertEqual(wallet.non_withdrawable_bank, 0)
+        self.assertEqual(wallet.withdrawable_bank, Decimal('5'))
+
+    def test_3_insufficient_funds(self):
+        with self.assertRaises(InsufficientFunds):
+            place_bet(self.bettor.id, self.mbg, Decimal('30.01'), chosen_user=self.player_a)
+
+        wallet = Wallet.objects.get(id=self.bettor.id)
+        self.assertEqual(wallet.bank, Decimal('30'))
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+    def test_4_stale_wallet_cannot_overdraw(self):
+        # Both tabs loaded the wallet with 30 in it
+        stale_wallet = Wallet.objects.get(id=self.bettor.id)
+
+        place_bet(stale_wallet.id, self.mbg, Decimal('20'), chosen_user=self.player_a)
+        self.assertEqual(stale_wallet.bank, Decimal('30'))
+        with self.assertRaises(InsufficientFunds):
+            place_bet(stale_wallet.id, self.mbg, Decimal('20'), chosen_user=self.player_b)
+
+        self.assertEqual(Wallet.objects.get(id=self.bettor.id).bank, Decimal('10'))
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 1)
+
+    def test_5_duplicate_key(self):
+        bet = place_bet(self.bettor.id, self.mbg, Decimal('5'), chosen_user=self.player_a, idempotency_key='bet-1')
+        with self.assertRaises(DuplicateBet) as raised:
+            place_bet(self.bettor.id, self.mbg, Decimal('5'), chosen_user=self.player_a, idempotency_key='bet-1')
+        self.assertEqual(raised.exception.bet, bet)
+
+        # Keys only need to be unique per wallet
+        place_bet(self.player_a.id, self.mbg, Decimal('5'), chosen_user=self.player_b, idempotency_key='bet-1')
+        self.assertEqual(Wallet.objects.get(id=self.bettor.id).bank, Decimal('25'))
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 2)
+
+    def test_6_dedupe_window(self):
+        bet = place_bet(self.bettor.id, self.mbg, Decimal('5'), chosen_user=self.player_a, idempotency_key='bet-1')
+        Bet.objects.filter(id=bet.id).update(created=timezone.now() - timezone.timedelta(seconds=601))
+
+        with override_settings(BET_DEDUPE_SECONDS=600):
+            place_bet(self.bettor.id, self.mbg, Decimal('5'), chosen_user=self.player_a, idempotency_key='bet-1')
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 2)
+
+
+class PoolTotalsTests(TestCase):
+    # Each betting group keeps running totals of its pool which are updated in the same transaction as each bet
+    # and on settlement
+    # ----
+    # Test 1: Test that the totals for each side add up as bets are placed
+    # Test 2: Test that the bettor count only counts each wallet once
+    # Test 3: Test that a failed bet leaves the totals alone
+    # Test 4: Test that settlement adds the winnings to the amount paid out
+    # Test 5: Test that the totals can be rebuilt from the bets
+    # Test 6: Test that the pool is added up per bettor and side with the percentages worked out
+    # Test 7: Test that bettors past the top few on a side are grouped into "Others"
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor_1, self.bettor_2 = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        place_bet(self.bettor_1.id, self.mbg, Decimal('10'), chosen_user=self.player_a)
+        place_bet(self.bettor_1.id, self.mbg, Decimal('5.50'), chosen_user=self.player_b)
+        place_bet(self.bettor_2.id, self.mbg, Decimal('20'), chosen_user=self.player_a)
+
+    def test_1_side_totals(self):
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+
+        self.assertEqual(mbg.total_staked, Decimal('35.50'))
+        self.assertEqual(mbg.side_a_total, Decimal('30'))
+        self.assertEqual(mbg.side_b_total, Decimal('5.50'))
+
+    def test_2_bettor_count(self):
+        self.assertEqual(MatchBettingGroup.objects.get(id=self.mbg.id).bettor_count, 2)
+
+    def test_3_failed_bet(self):
+        with self.assertRaises(InsufficientFunds):
+            place_bet(self.bettor_2.id, self.mbg, Decimal('500'), chosen_user=self.player_b)
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        self.assertEqual(mbg.total_staked, Decimal('35.50'))
+        self.assertEqual(mbg.side_b_total, Decimal('5.50'))
+
+    def test_4_settlement_paid_out(self):
+        self.match.winner = Match.b_winner
+        self.match.status = Match.finished_confirmed
+        self.match.save()
+
+        settle_match(self.match)
+
+        self.assertEqual(MatchBettingGroup.objects.get(id=self.mbg.id).total_paid_out, Decimal('35.50'))
+
+    def test_5_recalculate(self):
+        MatchBettingGroup.objects.filter(id=self.mbg.id).update(total_staked=0, side_a_total=0, bettor_count=0)
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        mbg.recalculate_pool()
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        self.assertEqual(mbg.total_staked, Decimal('35.50'))
+        self.assertEqual(mbg.side_a_total, Decimal('30'))
+        self.assertEqual(mbg.side_b_total, Decimal('5.50'))
+        self.assertEqual(mbg.bettor_count, 2)
+
+    def test_6_bettor_pool(self):
+        place_bet(self.bettor_1.id, self.mbg, Decimal('4.50'), chosen_user=self.player_a)
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        pool = mbg.bettor_pool()
+
+        self.assertEqual([(entry['name'], entry['team'], entry['amount']) for entry in pool], [
+            ('testuser4', 'testuser1', Decimal('20.00')),
+            ('testuser3', 'testuser1', Decimal('14.50')),
+            ('testuser3', 'testuser2', Decimal('5.50'))
+        ])
+        self.assertEqual([entry['percent'] for entry in pool], [50.0, 36.25, 13.75])
+
+    def test_7_bettor_pool_others(self):
+        place_bet(self.bettor_1.id, self.mbg, Decimal('4.50'), chosen_user=self.player_a)
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        pool = mbg.bettor_pool(top=1)
+
+        self.assertEqual([(entry['name'], entry['team'], entry['amount']) for entry in pool], [
+            ('testuser4', 'testuser1', Decimal('20.00')),
+            ('testuser3', 'testuser2', Decimal('5.50')),
+            ('Others', 'testuser1', Decimal('14.50'))
+        ])
+        self.assertEqual(pool[2]['percent'], 36.25)
+
+
+class BatchPlacementTests(TestCase):
+    # Bets arriving together can be placed as a batch, with the wallets debited and the bets inserted in bulk. Each
+    # bet is still accepted or refused on its own
+    # ----
+    # Test 1: Test that each wallet is debited, non-withdrawable bank first
+    # Test 2: Test that a bet the wallet can no longer cover is refused without affecting the rest
+    # Test 3: Test that the pool totals and bettor count are updated
+    # Test 4: Test that the number of queries doesn't grow with the batch
+    # Test 5: Test that bets repeating an idempotency key, already placed or earlier in the batch, aren't placed again
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 7):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=20,
+                non_withdrawable_bank=10
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b = self.wallets[:2]
+        self.bettors = self.wallets[2:]
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.select_related('match').get(match=self.match, group=self.group_object)
+
+        # The first bettor has already bet on this match
+        place_bet(self.bettors[0].id, self.mbg, Decimal('1'), chosen_user=self.player_a)
+
+    def test_1_wallets_debited(self):
+        results = place_bets(self.mbg, [
+            (self.bettors[1].id, Decimal('5'), {'chosen_user': self.player_a}),
+            (self.bettors[2].id, Decimal('15'), {'chosen_user': self.player_b})
+        ])
+
+        self.assertTrue(all(isinstance(result, Bet) for result in results))
+        wallet = Wallet.objects.get(id=self.bettors[1].id)
+        self.assertEqual((wallet.non_withdrawable_bank, wallet.withdrawable_bank), (Decimal('5'), Decimal('20')))
+        wallet = Wallet.objects.get(id=self.bettors[2].id)
+        self.assertEqual((wallet.non_withdrawable_bank, wallet.withdrawable_bank), (Decimal('0'), Decimal('15')))
+
+    def test_2_refused_bet(self):
+        results = place_bets(self.mbg, [
+            (self.bettors[1].id, Decimal('25'), {'chosen_user': self.player_a}),
+            (self.bettors[1].id, Decimal('10'), {'chosen_user': self.player_a}),
+            (self.bettors[2].id, Decimal('10'), {'chosen_user': self.player_b})
+        ])
+
+        self.assertIsInstance(results[0], Bet)
+        self.assertIsInstance(results[1], InsufficientFunds)
+        self.assertIsInstance(results[2], Bet)
+        self.assertEqual(Bet.objects.filter(wallet=self.bettors[1]).count(), 1)
+        wallet = Wallet.objects.get(id=self.bettors[1].id)
+        self.assertEqual(wallet.withdrawable_bank + wallet.non_withdrawable_bank, Decimal('5'))
+
+    def test_3_pool_totals(self):
+        place_bets(self.mbg, [
+            (self.bettors[0].id, Decimal('4'), {'chosen_user': self.player_a}),
+            (self.bettors[1].id, Decimal('5'), {'chosen_user': self.player_a}),
+            (self.bettors[2].id, Decimal('6.50'), {'chosen_user': self.player_b})
+        ])
+
+        mbg = MatchBettingGroup.objects.get(id=self.mbg.id)
+        self.assertEqual(mbg.total_staked, Decimal('16.50'))
+        self.assertEqual(mbg.side_a_total, Decimal('10'))
+        self.assertEqual(mbg.side_b_total, Decimal('6.50'))
+        self.assertEqual(mbg.bettor_count, 3)
+
+    def test_4_constant_number_of_queries(self):
+        with self.assertNumQueries(8):
+            place_bets(self.mbg, [
+                (self.bettors[1].id, Decimal('1'), {'chosen_user': self.player_a}),
+                (self.bettors[2].id, Decimal('1'), {'chosen_user': self.player_b})
+            ])
+        with self.assertNumQueries(8):
+            place_bets(self.mbg, [
+                (bettor.id, Decimal('1'), {'chosen_user': side})
+                for bettor in self.bettors for side in (self.player_a, self.player_b)
+            ])
+
+    def test_5_duplicate_keys(self):
+        placed = place_bet(self.bettors[1].id, self.mbg, Decimal('5'), chosen_user=self.player_a, idempotency_key='a')
+        results = place_bets(self.mbg, [
+            (self.bettors[1].id, Decimal('5'), {'chosen_user': self.player_a}),
+            (self.bettors[2].id, Decimal('5'), {'chosen_user': self.player_a}),
+            (self.bettors[2].id, Decimal('5'), {'chosen_user': self.player_a}),
+            (self.bettors[3].id, Decimal('5'), {'chosen_user': self.player_a})
+        ], ['a', 'b', 'b', None])
+
+        self.assertIsInstance(results[0], DuplicateBet)
+        self.assertEqual(results[0].bet, placed)
+        self.assertIsInstance(results[1], Bet)
+        self.assertIsInstance(results[2], DuplicateBet)
+        self.assertIs(results[2].bet, results[1])
+        self.assertIsInstance(results[3], Bet)
+        self.assertEqual(Bet.objects.filter(wallet=self.bettors[2]).count(), 1)
+        self.assertEqual(Wallet.objects.get(id=self.bettors[2].id).bank, Decimal('25'))
+
+
+class MarketTests(TestCase):
+    # Open betting groups are kept in memory as arrays of their bets, so the pool can be worked on without the ORM
+    # ----
+    # Test 1: Test that the totals, bettor count and each bettor's stakes match the bets
+    # Test 2: Test that the pool split per bettor is the same as the one added up by the database
+    # Test 3: Test that the implied probabilities and payout multipliers follow the pool
+    # Test 4: Test that a market only reads the bets placed since it last caught up
+    # Test 5: Test that a market that has skipped over a bet is built again
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 7):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b = self.wallets[:2]
+        self.bettors = self.wallets[2:]
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        for bettor, amount, side in (
+            (self.bettors[0], '10', self.player_a),
+            (self.bettors[0], '5.50', self.player_b),
+            (self.bettors[1], '20', self.player_a),
+            (self.bettors[2], '2.25', self.player_b),
+            (self.bettors[3], '7', self.player_b)
+        ):
+            place_bet(bettor.id, self.mbg, Decimal(amount), chosen_user=side)
+
+        market._markets.clear()
+
+    def fresh_mbg(self):
+        return MatchBettingGroup.objects.get(id=self.mbg.id)
+
+    def test_1_totals(self):
+        mbg = self.fresh_mbg()
+        bets = get_market(mbg)
+
+        self.assertEqual(bets.total_staked, mbg.total_staked)
+        self.assertEqual(bets.side_total(market.SIDE_A), mbg.side_a_total)
+        self.assertEqual(bets.side_total(market.SIDE_B), mbg.side_b_total)
+        self.assertEqual(bets.bettor_count, mbg.bettor_count)
+        self.assertEqual(bets.stake(self.bettors[0].id), (Decimal('10'), Decimal('5.50')))
+        self.assertEqual(bets.stake(self.player_a.id), (0, 0))
+
+    def test_2_bettor_pool(self):
+        mbg = self.fresh_mbg()
+        bets = get_market(mbg)
+
+        self.assertEqual(bets.bettor_pool(), mbg.bettor_pool())
+        self.assertEqual(bets.bettor_pool(1), mbg.bettor_pool(1))
+        # Names are only read for bettors that haven't been listed before
+        with self.assertNumQueries(0):
+            bets.bettor_pool()
+
+    def test_3_odds(self):
+        bets = get_market(self.fresh_mbg())
+
+        probability_a, probability_b = bets.implied_probabilities()
+        self.assertAlmostEqual(probability_a, 30 / 44.75)
+        self.assertAlmostEqual(probability_a + probability_b, 1)
+        self.assertEqual(bets.payout_multipliers(), (44.75 / 30, 44.75 / 14.75))
+        self.assertIsNone(market.payout_multiplier(0, 10))
+        self.assertIsNone(market.implied_probability(0, 0))
+
+    def test_4_catch_up(self):
+        get_market(self.fresh_mbg())
+        place_bet(self.bettors[3].id, self.mbg, Decimal('3'), chosen_user=self.player_a)
+
+        mbg = self.fresh_mbg()
+        with self.assertNumQueries(1):
+            bets = get_market(mbg)
+        self.assertEqual(bets.total_staked, Decimal('47.75'))
+        self.assertEqual(bets.stake(self.bettors[3].id), (Decimal('3'), Decimal('7')))
+        with self.assertNumQueries(0):
+            get_market(mbg)
+
+    def test_5_rebuilt(self):
+        bets = get_market(self.fresh_mbg())
+        # As if a bet placed after the next one had been committed first
+        bets.last_id += 1
+        place_bet(self.bettors[3].id, self.mbg, Decimal('3'), chosen_user=self.player_a)
+
+        mbg = self.fresh_mbg()
+        rebuilt = get_market(mbg)
+        self.assertIsNot(rebuilt, bets)
+        self.assertEqual(rebuilt.total_staked, mbg.total_staked)
+        self.assertEqual(rebuilt.bettor_pool(), mbg.bettor_pool())
+
+
+class OddsTests(TestCase):
+    # The odds on betting groups are priced from their running totals, with the betting groups already loaded
+    # ----
+    # Test 1: Test that the odds on betting groups that have been loaded are priced without reading anything
+    # Test 3: Test that a betting group without bets splits its card evenly, has no odds yet and pays nothing on nothing
+    # Test 3: Test that a betting group without bets splits its card evenly and has no odds yet
+    # Test 4: Test that a payout preview is what settlement would pay the stake
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor_1, self.bettor_2 = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.matches = []
+        self.mbgs = []
+        for x in range(3):
+            match = Match.objects.create(
+                user_a=self.player_a,
+                user_b=self.player_b,
+                tournament=self.tournament,
+                start_datetime=timezone.now()
+            )
+            self.matches.append(match)
+            self.mbgs.append(MatchBettingGroup.objects.get(match=match, group=self.group_object))
+
+        # 30 on a and 10 on b for the first match, 5 on b for the second and nothing on the third
+        place_bet(self.bettor_1.id, self.mbgs[0], Decimal('10'), chosen_user=self.player_a)
+        place_bet(self.bettor_2.id, self.mbgs[0], Decimal('20'), chosen_user=self.player_a)
+        place_bet(self.bettor_1.id, self.mbgs[0], Decimal('10'), chosen_user=self.player_b)
+        place_bet(self.bettor_2.id, self.mbgs[1], Decimal('5'), chosen_user=self.player_b)
+
+    def test_1_no_queries(self):
+        mbgs = list(MatchBettingGroup.objects.filter(id__in=[mbg.id for mbg in self.mbgs]).order_by('id'))
+
+        with self.assertNumQueries(0):
+            odds = [mbg.odds for mbg in mbgs]
+
+        self.assertEqual([o.betting_group_id for o in odds], [mbg.id for mbg in self.mbgs])
+        self.assertEqual(odds[0].totals, (Decimal('30'), Decimal('10')))
+        self.assertEqual(odds[0].total, Decimal('40'))
+        self.assertEqual(odds[1].totals, (Decimal('0'), Decimal('5')))
+
+    def test_2_odds(self):
+        odds = [MatchBettingGroup.objects.get(id=mbg.id).odds for mbg in self.mbgs[:2]]
+
+        self.assertEqual(odds[0].probabilities, (0.75, 0.25))
+        self.assertEqual(odds[0].multipliers, (40 / 30, 4.0))
+        self.assertEqual(odds[0].percents, (75.0, 25.0))
+
+        self.assertEqual(odds[1].probabilities, (0.0, 1.0))
+        self.assertEqual(odds[1].multipliers, (None, 1.0))
+        self.assertEqual(odds[1].percents, (0.0, 100.0))
+
+    def test_3_no_bets(self):
+        odds = Odds.for_group(MatchBettingGroup.objects.get(id=self.mbgs[2].id))
+
+        self.assertEqual(odds.probabilities, (None, None))
+        self.assertEqual(odds.multipliers, (None, None))
+        self.assertEqual(odds.percents, (50.0, 50.0))
+        # The first stake on a side gets its money back
+        self.assertEqual(odds.payout(market.SIDE_A, Decimal('5')), Decimal('5.00'))
+        # And a stake of nothing gets nothing, rather than dividing by the empty side
+        self.assertEqual(odds.payout(market.SIDE_A, Decimal('0')), Decimal('0.00'))
+
+    def test_4_payout_preview(self):
+        odds = MatchBettingGroup.objects.get(id=self.mbgs[0].id).odds
+        stake = Decimal('7.30')
+        preview = odds.payout(market.SIDE_B, stake)
+        # The stake shortens its own odds, from 4 to 47.3 / 17.3
+        self.assertEqual(preview, Decimal('19.96'))
+
+        bet = place_bet(self.bettor_2.id, self.mbgs[0], stake, chosen_user=self.player_b)
+        self.matches[0].winner = Match.b_winner
+        self.matches[0].status = Match.finished_confirmed
+        self.matches[0].save()
+        settle_match(self.matches[0])
+
+        self.assertEqual(Bet.objects.get(id=bet.id).winnings, preview)
@@ -1,10 +1,11 @@
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from Groups.auth import TokenAuthMiddleware
 import Groups.routing
 
 application = ProtocolTypeRouter({
     # (http->django views is added by default)
-    'websocket': AuthMiddlewareStack(
+    # Sockets are signed in from the token the page was given, or from the session if it doesn't have one
+    'websocket': TokenAuthMiddleware(
         URLRouter(
             Groups.routing.websocket_urlpatterns
         )
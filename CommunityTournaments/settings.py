@@ -180,4 +180,62 @@ CELERY_CACHE_BACKEND = 'django-cache'
 # use json format for everything
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_RESULT_SERIALIZER = 'json'
+# Run by the celery beat process in the Procfile, of which only one should ever be running
+CELERY_BEAT_SCHEDULE = {
+    'purge-chat-history': {
+        'task': 'Groups.tasks.purge_chat_history',
+        'schedule': 60 * 60 * 24,
+    },
+}
+# Settlement
+# Number of bets paid out by each settlement task before it re-queues itself
+SETTLEMENT_CHUNK_SIZE = 500
+# How long a queued settlement blocks an identical one from being queued
+SETTLEMENT_DEDUPE_SECONDS = 60
+# How long a bet's idempotency key stops the same bet being placed again
+BET_DEDUPE_SECONDS = 600
+
+# Live pool
+# Number of bettors on each side shown by name in the match pie before the rest are grouped into "Others"
+POOL_TOP_BETTORS = 20
+# Function used to turn websocket payloads into text. Groups.messages.orjson_dumps is faster if orjson is installed
+WEBSOCKET_JSON_ENCODER = 'Groups.messages.compact_dumps'
+
+# Websockets
+# Number of threads each process gives websocket consumers for database work
+WEBSOCKET_DB_WORKERS = 4
+# Seconds to hold bets on a match for so they can be written together, e.g. 0.05. None writes each bet as it arrives
+BET_BATCH_WINDOW = None
+# Shortest time in seconds between two updates of the same pool sent to its room
+BROADCAST_TICK = 0.25
+# A socket is closed once this many messages, or messages this many seconds old, are waiting to be sent to it
+WEBSOCKET_MAX_QUEUE = 100
+WEBSOCKET_MAX_LAG = 10
+# Range in seconds a dropped socket waits before reconnecting. Each socket is given a random delay from it
+WEBSOCKET_RECONNECT_DELAY = (1, 10)
+# Most match cards one group page socket can follow at once
+WEBSOCKET_MAX_CARDS = 100
+# How often in seconds each process tells the others who it has watching a room, how long one can go quiet before
+# the people it had are no longer counted, and how long changes are gathered up before the count is sent
+PRESENCE_HEARTBEAT = 15
+PRESENCE_EXPIRY = 45
+PRESENCE_DEBOUNCE = 1
+# Chat messages are saved in batches of up to CHAT_FLUSH_SIZE, at most CHAT_FLUSH_INTERVAL seconds after being sent.
+# Pages joining a room are sent its last CHAT_HISTORY_SIZE messages, and messages are kept for CHAT_RETENTION_DAYS
+CHAT_FLUSH_SIZE = 50
+CHAT_FLUSH_INTERVAL = 0.5
+CHAT_HISTORY_SIZE = 50
+# Most messages kept waiting to be saved while the database can't be reached
+CHAT_PENDING_LIMIT = 5000
+CHAT_RETENTION_DAYS = 30
+CHAT_PURGE_CHUNK_SIZE = 5000
+# How often in seconds each process looks for changes to a group's chat filter
+CHAT_FILTER_RELOAD = 30
+# The bet and chat rates for each socket are set on the group. Each user can send this many times as much across
+# all of their sockets, and a socket that has this many messages turned away, recovering one a second, is closed
+WEBSOCKET_USER_RATE_FACTOR = 2
+WEBSOCKET_MAX_VIOLATIONS = 10
+WEBSOCKET_VIOLATION_RATE = 1
+# Seconds the token a match page signs its socket in with is good for. After that reconnects use the session
+WEBSOCKET_TOKEN_MAX_AGE = 300
@@ -3,4 +3,6 @@ from django.contrib import admin
 # Register your models here.
 from .models import *
 
-admin.site.register(CommunityGroup)
\ No newline at end of file
+admin.site.register(CommunityGroup)
+admin.site.register(ChatMessage)
+
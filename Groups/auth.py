@@ -0,0 +1,72 @@
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.core import signing
+from urllib.parse import parse_qs
+from . import metrics
+
+# Match pages are given a short lived signed token saying who the user is and which wallet they bet from, which the
+# page sends when it opens its socket. Checking the signature needs no database, so the rush of sockets opening when a
+# match starts doesn't read the session and user tables once each. The wallet is only checked to still be active, by
+# its id. Sockets without a valid token, from pages loaded before tokens or open longer than WEBSOCKET_TOKEN_MAX_AGE,
+# are signed in from the session as before
+
+_salt = 'Groups.auth.socket'
+
+
+class TokenUser:
+    ''' The user a token was issued to, standing in for the User without loading it. '''
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, id, username):
+        self.id = self.pk = id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+
+def issue_token(user, wallet, betting_group_id):
+    ''' A token for the user's socket on a match, with the wallet they bet from in the match's group. '''
+    return signing.dumps({
+        'user': user.id,
+        'username': user.username,
+        'wallet': wallet.id,
+        'group': wallet.group_id,
+        'betting_group': betting_group_id
+    }, salt=_salt)
+
+
+def read_token(token):
+    ''' The token's contents, or None if it isn't one we signed or it has expired. '''
+    try:
+        return signing.loads(token, salt=_salt, max_age=settings.WEBSOCKET_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def token_wallet_id(token, match_betting_group):
+    ''' The wallet id from the token if it was issued for this match, and so doesn't need to be searched for. '''
+    if token is None or token['betting_group'] != match_betting_group.id:
+        return None
+    if token['group'] != match_betting_group.group_id:
+        return None
+    return token['wallet']
+
+
+class TokenAuthMiddleware:
+    ''' Puts the user from the token in the query string in the scope, or hands over to session auth without one. '''
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    def __call__(self, scope):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+        claims = read_token(token) if token else None
+        if claims is None:
+            metrics.increment('socket_session_auth')
+            return self.session_auth(scope)
+        metrics.increment('socket_token_auth')
+        return self.inner(dict(scope, user=TokenUser(claims['user'], claims['username']), token=claims))
@@ -0,0 +1,76 @@
+from django.conf import settings
+from Bets.models import MatchBettingGroup
+from Bets.placement import place_bets
+from .broadcast import pool_changed
+from .database import run_in_db
+from . import metrics
+import asyncio
+
+# When BET_BATCH_WINDOW is set, bets on the same match are held for that long and then written together, with one
+# change to the pool for the lot. Each betting group has one batcher per process
+
+_batchers = {}
+
+
+class PendingBet:
+
+    def __init__(self, wallet_id, amount, chosen, key=None):
+        self.wallet_id = wallet_id
+        self.amount = amount
+        self.chosen = chosen
+        self.key = key
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class BetBatcher:
+
+    def __init__(self, betting_group_id):
+        self.betting_group_id = betting_group_id
+        self.pending = []
+        self.flushing = None
+
+    def submit(self, wallet_id, amount, chosen, key=None):
+        ''' Add a bet to the next batch. Returns a future for the Bet, or the InsufficientFunds or DuplicateBet it was
+        refused with. '''
+        pending_bet = PendingBet(wallet_id, amount, chosen, key)
+        self.pending.append(pending_bet)
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush_later())
+        return pending_bet.future
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.BET_BATCH_WINDOW)
+        # Bets that arrive while this batch is being written start a new batcher
+        _batchers.pop(self.betting_group_id, None)
+        pending = self.pending
+
+        metrics.observe('bet_batch_size', len(pending))
+        try:
+            results = await run_in_db(self.write, pending)
+        except Exception as error:
+            for pending_bet in pending:
+                pending_bet.future.set_exception(error)
+            return
+
+        # Senders hear back about their own bets before the room hears about them all
+        for pending_bet, result in zip(pending, results):
+            if isinstance(result, Exception):
+                pending_bet.future.set_exception(result)
+            else:
+                pending_bet.future.set_result(result)
+        if not all(isinstance(result, Exception) for result in results):
+            pool_changed(self.betting_group_id)
+
+    def write(self, pending):
+        # Runs in the database pool
+        match_betting_group = MatchBettingGroup.objects.select_related('match').get(id=self.betting_group_id)
+        return place_bets(match_betting_group, [
+            (pending_bet.wallet_id, pending_bet.amount, pending_bet.chosen) for pending_bet in pending
+        ], [pending_bet.key for pending_bet in pending])
+
+
+def get_batcher(betting_group_id):
+    batcher = _batchers.get(betting_group_id)
+    if batcher is None:
+        batcher = _batchers[betting_group_id] = BetBatcher(betting_group_id)
+    return batcher
@@ -0,0 +1,90 @@
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError
+from .database import run_in_db
+from Bets.market import get_market, load_group
+from .messages import encode, pool_update, card_update
+from .room import room_group_name, card_group_name
+from . import metrics
+import asyncio
+
+# Changes to a pool are sent to its room at most once every BROADCAST_TICK seconds. The first change after a quiet
+# spell goes out straight away, and anything after it waits for the end of the tick and goes out as one update
+# carrying the pool as it is then. The same update goes, cut down to the totals, to group pages showing the match's
+# card. Each betting group has one broadcaster per process
+
+_broadcasters = {}
+
+
+def read_updates(betting_group_id):
+    # The pool is read once for the match's room and the cards. Only the running totals come from the database, the
+    # split per bettor comes from the market kept in memory, which reads just the bets placed since the last update
+    match_betting_group = load_group(betting_group_id)
+    pool = get_market(match_betting_group).bettor_pool(settings.POOL_TOP_BETTORS)
+    return (
+        match_betting_group.pool_version,
+        encode(pool_update(match_betting_group, pool)),
+        encode(card_update(match_betting_group))
+    )
+
+
+class RoomBroadcaster:
+
+    def __init__(self, betting_group_id):
+        self.betting_group_id = betting_group_id
+        self.dirty = False
+        self.sending = None
+
+    def changed(self):
+        ''' Note that the pool has changed, sending it now if nothing has been sent in the last tick. '''
+        if self.sending is None:
+            self.sending = asyncio.ensure_future(self.send_ticks())
+        else:
+            self.dirty = True
+            metrics.increment('broadcasts_merged')
+
+    async def send_ticks(self):
+        self.dirty = True
+        try:
+            while self.dirty:
+                self.dirty = False
+                try:
+                    await self.send()
+                except DatabaseError:
+                    # Try again at the end of the tick rather than leave the room on an old state
+                    metrics.increment('broadcast_errors')
+                    self.dirty = True
+                await asyncio.sleep(settings.BROADCAST_TICK or 0)
+        finally:
+            self.sending = None
+            _broadcasters.pop(self.betting_group_id, None)
+
+    async def send(self):
+        # The pool is read when the update is sent, so it has every change made before then
+        seq, text, card_text = await run_in_db(read_updates, self.betting_group_id)
+        metrics.increment('broadcasts_sent')
+        channel_layer = get_channel_layer()
+        await channel_layer.group_send(
+            room_group_name(self.betting_group_id),
+            {
+                'type': 'send_update',
+                'seq': seq,
+                'text': text
+            }
+        )
+        await channel_layer.group_send(
+            card_group_name(self.betting_group_id),
+            {
+                'type': 'send_card',
+                'id': self.betting_group_id,
+                'seq': seq,
+                'text': card_text
+            }
+        )
+
+
+def pool_changed(betting_group_id):
+    broadcaster = _broadcasters.get(betting_group_id)
+    if broadcaster is None:
+        broadcaster = _broadcasters[betting_group_id] = RoomBroadcaster(betting_group_id)
+    broadcaster.changed()
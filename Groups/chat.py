@@ -0,0 +1,190 @@
+from collections import deque
+from django.conf import settings
+from django.db import DatabaseError, OperationalError, transaction
+from .database import run_in_db
+from .messages import encode, chat_message
+from .models import ChatMessage
+from . import metrics
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Chat messages are sent to the room straight away, but written to the database in batches, once CHAT_FLUSH_SIZE of
+# them are waiting or CHAT_FLUSH_INTERVAL seconds after the first. Each room with sockets in the process also keeps
+# its last CHAT_HISTORY_SIZE messages in memory, so pages joining are sent the recent chat without a database read
+#
+# While the database can't be reached, messages wait for the next batch, but no more than CHAT_PENDING_LIMIT of them
+
+_writer = None
+_histories = {}
+_loading = {}
+_subscribers = {}
+
+
+class ChatWriter:
+
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+
+    def add(self, message):
+        self.pending.append(message)
+        self.trim()
+        if len(self.pending) >= settings.CHAT_FLUSH_SIZE:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            asyncio.ensure_future(self.flush())
+        elif self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_later())
+
+    def retry(self, messages):
+        # Put them back to go with the next batch
+        self.pending[:0] = messages
+        self.trim()
+        if self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_later())
+
+    def trim(self):
+        # The oldest are dropped first. They have already been sent to the room
+        dropped = len(self.pending) - settings.CHAT_PENDING_LIMIT
+        if dropped > 0:
+            del self.pending[:dropped]
+            metrics.increment('chat_dropped', dropped)
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.CHAT_FLUSH_INTERVAL)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        metrics.observe('chat_batch_size', len(pending))
+        try:
+            await run_in_db(ChatMessage.objects.bulk_create, pending)
+        except OperationalError:
+            # The database may be back by the next batch
+            metrics.increment('chat_write_errors')
+            self.retry(pending)
+        except DatabaseError:
+            # Something in the batch can't ever be saved, so the rest are saved one at a time without it
+            metrics.increment('chat_write_errors')
+            try:
+                dropped, unsaved = await run_in_db(write_each, pending)
+            except OperationalError:
+                dropped, unsaved = 0, pending
+            metrics.increment('chat_dropped', dropped)
+            if unsaved:
+                self.retry(unsaved)
+
+
+def write_each(messages):
+    # Runs in the database pool. Returns how many of the messages were dropped, and the ones left to save if the
+    # database stopped answering part way through
+    dropped = 0
+    for index, message in enumerate(messages):
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+        except OperationalError:
+            return dropped, messages[index:]
+        except DatabaseError:
+            logger.exception("Dropped chat message %s that couldn't be saved", message.key)
+            dropped += 1
+    return dropped, []
+
+
+def write(message):
+    ''' Queue a ChatMessage to be saved with the next batch. '''
+    global _writer
+    if _writer is None:
+        _writer = ChatWriter()
+    _writer.add(message)
+
+
+class RoomHistory:
+    ''' The last CHAT_HISTORY_SIZE messages sent to a room, oldest first, as (key, text). '''
+
+    def __init__(self):
+        self.entries = deque()
+        self.keys = set()
+        self.loaded = False
+
+    def record(self, key, text):
+        # Every socket in the room hears the same message, but it only needs keeping once
+        if key in self.keys:
+            return
+        self.entries.append((key, text))
+        self.keys.add(key)
+        while len(self.entries) > settings.CHAT_HISTORY_SIZE:
+            self.keys.discard(self.entries.popleft()[0])
+
+    def load(self, entries):
+        # Messages heard while the database was being read go after the ones it had, which may include them
+        heard = list(self.entries)
+        self.entries.clear()
+        self.keys.clear()
+        for key, text in entries + heard:
+            self.record(key, text)
+        self.loaded = True
+
+    def since(self, key):
+        ''' The messages after the one with the key, or all of them if it isn't one of them. '''
+        texts = []
+        for entry_key, text in reversed(self.entries):
+            if entry_key == key:
+                break
+            texts.append(text)
+        texts.reverse()
+        return texts
+
+
+def read_history(betting_group_id):
+    # The newest messages in the database, oldest first
+    messages = ChatMessage.objects.filter(
+        match_betting_group_id=betting_group_id
+    ).order_by('-created', '-id').values_list('key', 'username', 'message')[:settings.CHAT_HISTORY_SIZE]
+    return [(key.hex, encode(chat_message(username, message, key.hex))) for key, username, message in reversed(messages)]
+
+
+def record(betting_group_id, key, text):
+    history = _histories.get(betting_group_id)
+    if history is not None:
+        history.record(key, text)
+
+
+def subscribe(betting_group_id):
+    _subscribers[betting_group_id] = _subscribers.get(betting_group_id, 0) + 1
+    if betting_group_id not in _histories:
+        _histories[betting_group_id] = RoomHistory()
+
+
+def unsubscribe(betting_group_id):
+    # Once nobody here is in the room, nothing keeps the history up to date
+    _subscribers[betting_group_id] -= 1
+    if not _subscribers[betting_group_id]:
+        del _subscribers[betting_group_id]
+        _histories.pop(betting_group_id, None)
+
+
+async def history(betting_group_id, key=None):
+    ''' Chat sent to a room the caller is subscribed to since the message with the key, reading the database only the
+    first time the room is joined here. '''
+    room_history = _histories[betting_group_id]
+    if room_history.loaded:
+        metrics.increment('chat_history_hits')
+        return room_history.since(key)
+
+    # Sockets joining at the same time share one read
+    loading = _loading.get(betting_group_id)
+    if loading is None:
+        metrics.increment('chat_history_reads')
+        loading = _loading[betting_group_id] = asyncio.ensure_future(run_in_db(read_history, betting_group_id))
+        loading.add_done_callback(lambda future: _loading.pop(betting_group_id, None))
+    entries = await asyncio.shield(loading)
+    if not room_history.loaded:
+        room_history.load(entries)
+    return room_history.since(key)
@@ -1,164 +1,317 @@
-from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
-from Games.models import Match, Team
-from Bets.models import Bet, MatchBettingGroup as BettingGameGroup
-from Profiles.models import Wallet, Profile
-from django.shortcuts import get_object_or_404
+from Bets.placement import place_bet, InsufficientFunds, DuplicateBet
+from urllib.parse import parse_qs
+import asyncio
 import json
-from .forms import BetForm, ChatForm
+import logging
+import random
+import uuid
+from django.utils import timezone
+from .database import run_in_db
+from .auth import token_wallet_id
+from .room import room_group_name, card_group_name, read_cards, is_group_member, find_wallet, check_wallet
+from .batching import get_batcher
+from .broadcast import pool_changed
+from .outbound import Outbound
+from . import chat, fanout, metrics, moderation, presence, protocol, registry, snapshots
+from .models import ChatMessage
+from .messages import encode, welcome, bet_ack, bet_reject, cards_reject, chat_reject, rate_limited, chat_message as chat_message_payload
+from .ratelimit import Limiter
 from django import forms
+from django.conf import settings
 from django.contrib.auth import get_user_model
 User = get_user_model()
-
-def remove_funds(user_wallet, amountBid):
-    if user_wallet.non_withdrawable_bank >= amountBid:
-        user_wallet.non_withdrawable_bank = user_wallet.non_withdrawable_bank - amountBid
-        user_wallet.save()
-    else:
-        amountBid = amountBid - user_wallet.non_withdrawable_bank
-        user_wallet.non_withdrawable_bank = 0
-        user_wallet.withdrawable_bank = user_wallet.withdrawable_bank - amountBid
-        user_wallet.save()
+logger = logging.getLogger(__name__)
 
 class DataConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         self.betting_group_id = self.scope['url_route']['kwargs']['betting_group_id']
-        self.room_group_name = 'chat_%s' % self.betting_group_id
+        self.room_group_name = room_group_name(self.betting_group_id)
         self.user = self.scope["user"]
-        print(self.betting_group_id)
-        self.match_betting_group = get_object_or_404(BettingGameGroup, pk=self.betting_group_id)
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        logger.debug('Socket connecting to betting group %s', self.betting_group_id)
+        # The match is shared with every other socket on it in this process, and only read by the first of them
+        registry.subscribe(self.betting_group_id)
+        try:
+            room = await registry.get(self.betting_group_id)
+            self.wallet_id = await self.find_wallet(room)
+        except BaseException:
+            registry.unsubscribe(self.betting_group_id)
+            raise
+        self.group_id = room.group_id
+        self.outbound = Outbound(self.send)
+        self.limiter = Limiter(self.user, self.group_id, room.rates)
+        snapshots.subscribe(self.betting_group_id)
+        chat.subscribe(self.betting_group_id)
+        # Join room group, which this process hears on once for all of its sockets in the room
+        await fanout.join(self.betting_group_id, self)
 
         await self.accept()
+        presence.join(self.betting_group_id, self)
+
+        # The page says which version of the pool it last saw, and only needs sending the pool if it has changed
+        # since
+        self.seq = self.last_seen_seq()
+        self.outbound.put(encode(welcome(self.seq, int(random.uniform(*settings.WEBSOCKET_RECONNECT_DELAY) * 1000))))
+        # The room may have been read a while ago, but then the updates heard since are newer
+        pool_version = max(room.match_betting_group.pool_version, snapshots.seq(self.betting_group_id))
+        if self.seq < pool_version:
+            seq, text = await snapshots.latest(self.betting_group_id, pool_version)
+            self.seq = seq
+            self.outbound.put_state(text)
+
+        # Then the chat it missed, which for a page that has just been opened is the recent history
+        for text in await chat.history(self.betting_group_id, self.last_seen_chat()):
+            self.outbound.put(text)
+        # Then whatever the room has heard since it joined
+        await fanout.ready(self.betting_group_id, self)
+
+    def last_seen_seq(self):
+        try:
+            return int(parse_qs(self.scope['query_string'].decode())['seq'][0])
+        except (KeyError, ValueError):
+            return 0
+
+    def last_seen_chat(self):
+        return parse_qs(self.scope['query_string'].decode()).get('chat', [None])[0]
+
+    async def find_wallet(self, room):
+        # A user signed in with a token for this match already has their wallet, but it may have been closed since
+        # the token was issued, so it is checked by its id
+        wallet_id = token_wallet_id(self.scope.get('token'), room.match_betting_group)
+        if wallet_id is not None:
+            return await run_in_db(check_wallet, wallet_id, room.group_id)
+        if self.user.is_authenticated:
+            wallet_id = await run_in_db(self.load_wallet, room.group_id)
+        return wallet_id
+
+    def load_wallet(self, group_id):
+        # Runs in the database pool, so a session user's profile isn't lazily loaded later on the event loop. A user
+        # from a token has no profile, and only their id is needed to find the wallet
+        if 'token' not in self.scope:
+            self.user.profile
+        return find_wallet(group_id, self.user)
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+        if hasattr(self, 'outbound'):
+            # Leave room group
+            fanout.leave(self.betting_group_id, self)
+            presence.leave(self.betting_group_id, self)
+            self.outbound.close()
+            self.limiter.close()
+            registry.unsubscribe(self.betting_group_id)
+            snapshots.unsubscribe(self.betting_group_id)
+            chat.unsubscribe(self.betting_group_id)
+
+    async def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        message_type = protocol.message_type(text_data_json)
+        if message_type not in ('bet', 'chat'):
+            logger.debug('Ignored a message of unknown type %r', message_type)
+            return
+        if not await self.within_limit(message_type):
+            return
+
+        if message_type == 'bet':
+            # Every bet is answered with an ack or a reject carrying the key the page sent with it
+            try:
+                cleaned_data = protocol.bet.clean(text_data_json)
+            except forms.ValidationError as error:
+                self.outbound.put(encode(bet_reject(error.message, error.code, protocol.bet_key(text_data_json))))
+                return
+            await self.receive_bet(cleaned_data['chosen_team'], cleaned_data['amount'], cleaned_data['key'])
+        else:
+            try:
+                chat_message = protocol.chat.clean(text_data_json)['chat_message']
+            except forms.ValidationError as error:
+                self.outbound.put(encode(chat_reject(error.message, error.code)))
+                return
+            logger.debug('Chat message in betting group %s: %s', self.betting_group_id, chat_message)
+            chat_filter = await moderation.get_filter(self.group_id)
+            if chat_filter.blocks(chat_message):
+                metrics.increment('chat_blocked')
+                self.outbound.put(encode(chat_reject("That message isn't allowed in this group", 'blocked')))
+                return
+            key = uuid.uuid4()
+            # Saved with the next batch of messages rather than on its own
+            chat.write(ChatMessage(
+                match_betting_group_id=self.betting_group_id,
+                user_id=self.user.id,
+                username=self.user.username,
+                message=chat_message,
+                key=key,
+                created=timezone.now()
+            ))
+            # Send message to room group
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'send_chat_message',
+                    'key': key.hex,
+                    'text': encode(chat_message_payload(self.user.username, chat_message, key.hex))
+                }
+            )
+
+    async def within_limit(self, kind):
+        # Checked before anything else is done with the message
+        if self.limiter.allow(kind):
+            return True
+
+        metrics.increment('rate_limited')
+        if self.limiter.abusive():
+            metrics.increment('rate_limit_closed')
+            self.outbound.close()
+            await self.close(code=4029)
+        else:
+            retry_after = self.limiter.retry_after(kind)
+            if retry_after is not None:
+                retry_after = int(retry_after * 1000)
+            self.outbound.put(encode(rate_limited(kind, retry_after)))
+        return False
+
+    async def receive_bet(self, chosenTeam, amountBid, key):
+        logger.debug('Bet on %s in betting group %s', chosenTeam, self.betting_group_id)
+        room = await registry.get(self.betting_group_id)
+        try:
+            chosen, bet_for = room.check_bet(chosenTeam, self.wallet_id)
+        except forms.ValidationError as error:
+            self.outbound.put(encode(bet_reject(error.message, error.code, key)))
+            return
+
+        if settings.BET_BATCH_WINDOW:
+            # The bet is written along with any others placed on the match in the same window. The answer to the
+            # sender is waited for separately, so their next bet can go in the same batch
+            placed = get_batcher(self.betting_group_id).submit(self.wallet_id, amountBid, chosen, key)
+            asyncio.ensure_future(self.answer_bet(placed, bet_for, key))
+            return
+
+        # The balance check happens inside the debit itself, so two bets from the same wallet can't both spend the
+        # same money
+        placed = run_in_db(
+            place_bet, self.wallet_id, room.match_betting_group, amountBid, idempotency_key=key, **chosen
         )
+        if await self.answer_bet(placed, bet_for, key):
+            # The room is sent the pool as it is now, or at the end of the tick if it was sent one recently
+            pool_changed(self.betting_group_id)
+
+    async def answer_bet(self, placed, bet_for, key):
+        # Returns whether a new bet was placed
+        try:
+            bet = await placed
+        except InsufficientFunds:
+            reject = bet_reject("User does not have the money to make this bet", 'insufficient_funds', key)
+            self.outbound.put(encode(reject))
+            placed = False
+        except DuplicateBet as duplicate:
+            self.outbound.put(encode(bet_ack(duplicate.bet, bet_for, key, True)))
+            placed = False
+        except Exception:
+            # Nothing else waits on a batched bet, and a bet placed directly would take the socket down with it, so
+            # the error is logged here. The sender is still answered so the page isn't left waiting on the key
+            logger.exception("Bet on betting group %s could not be placed", self.betting_group_id)
+            metrics.increment('bet_errors')
+            reject = bet_reject("The bet could not be placed, please try again", 'server_error', key)
+            self.outbound.put(encode(reject))
+            placed = False
+        else:
+            self.outbound.put(encode(bet_ack(bet, bet_for, key)))
+            placed = True
+        await self.close_if_behind()
+        return placed
+
+    async def send_update(self, seq, text):
+        # Only the newest state of the pool is worth sending, and updates from other processes can arrive late
+        if seq <= self.seq:
+            return
+        self.seq = seq
+        self.outbound.put_state(text)
+        await self.close_if_behind()
+
+    async def send_chat_message(self, text):
+        self.outbound.put(text)
+        await self.close_if_behind()
+
+    def send_viewers(self, text):
+        self.outbound.put_state(text, key='viewers')
+
+    async def close_if_behind(self):
+        # Rather than let messages for a slow client build up here and in the channel layer, drop the connection.
+        # The page can reconnect and start again from the current state
+        if self.outbound.behind():
+            metrics.increment('slow_consumers_closed')
+            self.outbound.close()
+            await self.close(code=4008)
+
+
+class GroupConsumer(AsyncWebsocketConsumer):
+    # One socket for the group page, following the pools of whichever match cards the page is showing. The page
+    # subscribes to cards as it loads them and is sent each card's totals whenever its pool changes
+
+    async def connect(self):
+        self.group_id = self.scope['url_route']['kwargs']['group_id']
+        self.user = self.scope["user"]
+        if not await run_in_db(is_group_member, self.group_id, self.user):
+            await self.close()
+            return
+        # The newest version of the pool sent for each card
+        self.cards = {}
+        self.outbound = Outbound(self.send)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'outbound'):
+            return
+        for betting_group_id in self.cards:
+            await self.channel_layer.group_discard(card_group_name(betting_group_id), self.channel_name)
+        self.outbound.close()
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
-        if "amountBid" in text_data_json:
-            chosenTeamJson = text_data_json['chosenTeam']
-            amountBidJson = text_data_json['amountBid']
-
-            form_data = {
-                "chosen_team": chosenTeamJson,
-                "amount": amountBidJson
-                         }
-            form = BetForm(form_data)
-            if form.is_valid():
-                print("form valid")
-                chosenTeam = form.cleaned_data['chosen_team']
-                amountBid = form.cleaned_data['amount']
-                message = "nothing"
-                print(chosenTeam)
-                try:
-                    team = Wallet.objects.get(id=chosenTeam)
-                    # TODO: Teams might not work
-                except:
-                    team = get_object_or_404(Team, name=chosenTeam)
-                user_wallet = Wallet.objects.get(profile=self.user.profile, group=self.match_betting_group.group)
-                if amountBid <= user_wallet.bank:
-                    if self.match_betting_group.match.user_a == team or self.match_betting_group.match.user_b == team:
-
-                        remove_funds(user_wallet, amountBid)
-                        newBet = Bet(wallet=user_wallet, match_betting_group=self.match_betting_group, chosen_user=team, amount=amountBid)
-                        newBet.save()
-
-                        # Send message to room group
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'send_update',
-                                # 'username': self.user,
-                                'message': message
-                            }
-                        )
-                    elif self.match_betting_group.match.team_a == team or self.match_betting_group.match.team_b == team:
-                        remove_funds(user_wallet, amountBid)
-                        newBet = Bet(wallet=user_wallet, match_betting_group=self.match_betting_group, chosen_team=team, amount=amountBid)
-                        newBet.save()
-
-                        # Send message to room group
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'send_update',
-                                # 'username': self.user,
-                                'message': message
-                            }
-                        )
-                    else:
-                        raise forms.ValidationError("Team Value is not valid")
-                else:
-                    raise forms.ValidationError("User does not have the money to make this bet")
-            else:
-                raise forms.ValidationError("Form is not valid")
-        elif "chat_message" in text_data_json:
-            chat_message = text_data_json['chat_message']
-
-            form_data = {
-                "chat_message": chat_message
-            }
-            form = ChatForm(form_data)
-            if form.is_valid():
-                chat_message = form.cleaned_data['chat_message']
-                print(chat_message)
-                chat_message = chat_message
-                # Send message to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'send_chat_message',
-                        'username': self.user.username,
-                        'message': chat_message
-                    }
-                )
-            else:
-                raise forms.ValidationError("Form is not valid")
+        message_type = protocol.message_type(text_data_json)
+        if message_type not in ('subscribe', 'unsubscribe'):
+            self.outbound.put(encode(cards_reject("Form is not valid", 'invalid')))
+            return
+        # A frame that can't be read is answered rather than dropping the socket, which the page would only reconnect
+        try:
+            ids = protocol.cards.clean(text_data_json)['ids']
+        except forms.ValidationError as error:
+            self.outbound.put(encode(cards_reject(error.message, error.code)))
+            return
+        if message_type == 'subscribe':
+            await self.subscribe(ids)
         else:
-            print("Not correct form")
-
-    async def send_update(self, event):
-        message = event['message']
-        self.match_betting_group = get_object_or_404(BettingGameGroup, pk=self.betting_group_id)
-        data = '['
-        qs = self.match_betting_group.mbg_bets.all()
-        total_bet = 0
-        count = 0
-        for bet in qs:
-            total_bet += bet.amount
-        for bet in qs:
-            if bet.chosen_team:
-                chosen = bet.chosen_team
-            else:
-                chosen = bet.chosen_user
-            data += '{"name": "'+ str(bet.wallet.profile.user) + '", "amount": ' + str(bet.amount) + ', "percent": ' + str((bet.amount / total_bet)*100) + ', "team": "' + str(chosen) + '", "colour": "' + "#"+ str(bet.wallet.profile.colour) + '"}'
-            count += 1
-            if count != qs.count():
-                data += ","
-        data += ']'
-        total_bet = str(total_bet)
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': data,
-            'total_bet': total_bet
-        }))
-
-    async def send_chat_message(self, event):
-        message = event['message']
-        chat_user = event['username']
-        # user_colour = event.user.profile.colour
-        await self.send(text_data=json.dumps({
-            'message': str(message),
-            'chat_user': chat_user,
-            # 'user_colour': user_colour
-        }))
\ No newline at end of file
+            for betting_group_id in ids:
+                if self.cards.pop(betting_group_id, None) is not None:
+                    await self.channel_layer.group_discard(card_group_name(betting_group_id), self.channel_name)
+
+    async def subscribe(self, ids):
+        # Matches from other groups, and any past the limit, are left out
+        ids = [id for id in dict.fromkeys(ids) if id not in self.cards]
+        ids = ids[:max(settings.WEBSOCKET_MAX_CARDS - len(self.cards), 0)]
+        if not ids:
+            return
+        # Join the cards' groups before reading them so no change in between is missed. Changes heard meanwhile wait
+        # behind this message, and are dropped if the read already has them
+        for betting_group_id in ids:
+            await self.channel_layer.group_add(card_group_name(betting_group_id), self.channel_name)
+        for betting_group_id, seq, text in await run_in_db(read_cards, self.group_id, ids):
+            self.cards[betting_group_id] = seq
+            self.outbound.put_state(text, key=betting_group_id)
+        for betting_group_id in ids:
+            if betting_group_id not in self.cards:
+                await self.channel_layer.group_discard(card_group_name(betting_group_id), self.channel_name)
+        await self.close_if_behind()
+
+    async def send_card(self, event):
+        # Like the match page, only the newest state of each card is worth sending
+        if event['id'] not in self.cards or event['seq'] <= self.cards[event['id']]:
+            return
+        self.cards[event['id']] = event['seq']
+        self.outbound.put_state(event['text'], key=event['id'])
+        await self.close_if_behind()
+
+    async def close_if_behind(self):
+        if self.outbound.behind():
+            metrics.increment('slow_consumers_closed')
+            self.outbound.close()
+            await self.close(code=4008)
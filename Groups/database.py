@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from functools import partial
+from threading import Lock
+from . import metrics
+import asyncio
+import time
+
+# Websocket consumers run on the event loop, so anything that touches the database is handed to a small pool of
+# threads of its own. A slow query then holds up one of these threads rather than every socket in the process
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.WEBSOCKET_DB_WORKERS,
+                thread_name_prefix='websocket-db'
+            )
+        return _executor
+
+
+def _run(func, queued_at):
+    metrics.observe('db_queue_wait', time.monotonic() - queued_at)
+    # Each thread keeps its own connection between jobs, so drop it if it has gone stale or past CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def run_in_db(func, *args, **kwargs):
+    ''' Run func in the websocket database pool and wait for the result without blocking the event loop. '''
+    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    result = await loop.run_in_executor(get_executor(), _run, partial(func, *args, **kwargs), started)
+    metrics.observe('db_call', time.monotonic() - started)
+    return result
@@ -0,0 +1,129 @@
+from channels.layers import get_channel_layer
+from . import chat, metrics, registry, snapshots
+from .room import room_group_name
+import asyncio
+import logging
+
+# Updates, chat and edits to the match are sent to the match's room group. Rather than every socket in the room
+# joining the group, and each of them being delivered and decoding its own copy of every message, each process joins
+# it once per room on a channel of its own and hands what it hears to its sockets here. The room's snapshot and chat
+# history are kept up to date once per message, before any socket sends it
+#
+# A room's channel is opened by the first socket to join it here and closed once the last one leaves. A socket joins
+# before it reads the pool, so nothing is missed in between, but what it hears is held until it has finished connecting
+
+logger = logging.getLogger(__name__)
+
+_rooms = {}
+
+
+class RoomFanout:
+
+    def __init__(self, betting_group_id):
+        self.betting_group_id = betting_group_id
+        # Each socket here, with what it has heard while connecting, or None once it has connected
+        self.sockets = {}
+        self.channel = None
+        self.subscribed = asyncio.ensure_future(self.subscribe())
+        self.listener = None
+
+    async def subscribe(self):
+        layer = get_channel_layer()
+        self.channel = await layer.new_channel('room.')
+        await layer.group_add(room_group_name(self.betting_group_id), self.channel)
+        self.listener = asyncio.ensure_future(self.listen(layer))
+
+    async def listen(self, layer):
+        while True:
+            event = await layer.receive(self.channel)
+            metrics.increment('room_events')
+            handler = getattr(self, event['type'], None)
+            if handler is None:
+                continue
+            # The rest of the room still needs to hear what comes next
+            try:
+                await handler(event)
+            except Exception:
+                logger.exception("Room %s couldn't handle %s", self.betting_group_id, event['type'])
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        try:
+            await asyncio.shield(self.subscribed)
+        except Exception:
+            return
+        await get_channel_layer().group_discard(room_group_name(self.betting_group_id), self.channel)
+
+    async def deliver(self, name, *args):
+        for consumer, held in list(self.sockets.items()):
+            metrics.increment('room_deliveries')
+            if held is not None:
+                held.append((name, args))
+            else:
+                await self.send_to(consumer, name, args)
+
+    async def send_to(self, consumer, name, args):
+        # Returns whether the socket is still here
+        try:
+            await getattr(consumer, name)(*args)
+            return True
+        except Exception:
+            # A socket that can't be sent to is dropped, rather than holding up the others
+            logger.exception("Dropped a socket in room %s that couldn't be sent %s", self.betting_group_id, name)
+            metrics.increment('room_delivery_errors')
+            if _rooms.get(self.betting_group_id) is self:
+                leave(self.betting_group_id, consumer)
+            else:
+                self.sockets.pop(consumer, None)
+            return False
+
+    async def send_update(self, event):
+        snapshots.record(self.betting_group_id, event['seq'], event['text'])
+        await self.deliver('send_update', event['seq'], event['text'])
+
+    async def send_chat_message(self, event):
+        chat.record(self.betting_group_id, event['key'], event['text'])
+        await self.deliver('send_chat_message', event['text'])
+
+    async def match_changed(self, event):
+        # The match was edited, so load it again before the next bet is checked
+        registry.changed(self.betting_group_id, event.get('change'))
+
+
+async def join(betting_group_id, consumer):
+    ''' Start handing the room's messages to the socket, once this process is in the room's group. '''
+    room = _rooms.get(betting_group_id)
+    if room is None:
+        room = _rooms[betting_group_id] = RoomFanout(betting_group_id)
+    room.sockets[consumer] = []
+    try:
+        await asyncio.shield(room.subscribed)
+    except BaseException:
+        leave(betting_group_id, consumer)
+        raise
+
+
+async def ready(betting_group_id, consumer):
+    ''' The socket has connected, so send it what it heard meanwhile, and from now on what it hears straight away. '''
+    room = _rooms.get(betting_group_id)
+    if room is None:
+        return
+    held = room.sockets.get(consumer)
+    # Anything heard while these are sent goes on the end
+    while held:
+        name, args = held.pop(0)
+        if not await room.send_to(consumer, name, args):
+            return
+    if consumer in room.sockets:
+        room.sockets[consumer] = None
+
+
+def leave(betting_group_id, consumer):
+    room = _rooms.get(betting_group_id)
+    if room is None or consumer not in room.sockets:
+        return
+    del room.sockets[consumer]
+    if not room.sockets:
+        del _rooms[betting_group_id]
+        asyncio.ensure_future(room.close())
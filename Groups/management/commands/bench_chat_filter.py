@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from Groups.moderation import ChatFilter, normalise
+import random
+import string
+import timeit
+
+
+def random_word(length):
+    return ''.join(random.choice(string.ascii_lowercase) for x in range(length))
+
+
+class Command(BaseCommand):
+    help = 'Times the chat filter compiling a large word list and checking messages against it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--terms', type=int, default=10000, help='Number of banned words in the list')
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        terms = [random_word(random.randint(4, 10)) for x in range(options['terms'])]
+        # Phrases of a few words as well as single words
+        terms += [' '.join(random_word(random.randint(3, 6)) for x in range(2)) for x in range(options['terms'] // 10)]
+        vocabulary = [random_word(random.randint(2, 9)) for x in range(2000)]
+
+        clean = [
+            ' '.join(random.choice(vocabulary) for x in range(random.randint(3, 20)))
+            for x in range(options['messages'])
+        ]
+        # Banned words dressed up the usual ways, in the middle of otherwise clean messages
+        dirty = []
+        for message in clean:
+            word = random.choice(terms).replace('o', '0').replace('a', '@').upper()
+            words = message.split()
+            words.insert(len(words) // 2, word)
+            dirty.append(' '.join(words))
+
+        seconds = min(timeit.repeat(lambda: ChatFilter('', terms, True), number=1, repeat=options['repeat']))
+        self.stdout.write('compiled %d terms in %.1f ms' % (len(terms), seconds * 1000))
+
+        chat_filter = ChatFilter('', terms, True)
+        self.stdout.write('%-10s %12s %12s %12s' % ('messages', 'blocked', 'us/message', 'normalise'))
+        for name, messages in (('clean', clean), ('dirty', dirty)):
+            blocked = sum(chat_filter.blocks(message) for message in messages)
+            seconds = min(timeit.repeat(
+                lambda: [chat_filter.blocks(message) for message in messages], number=1, repeat=options['repeat']
+            ))
+            normalise_seconds = min(timeit.repeat(
+                lambda: [normalise(message) for message in messages], number=1, repeat=options['repeat']
+            ))
+            self.stdout.write('%-10s %12d %12.2f %12.2f' % (
+                name, blocked, seconds / len(messages) * 1e6, normalise_seconds / len(messages) * 1e6
+            ))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from Bets.market import Market, SIDE_A, SIDE_B
+import random
+import sys
+import timeit
+
+
+class Command(BaseCommand):
+    help = 'Times the in-memory market: adding bets, the totals, the split per bettor and the odds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bets', type=int, default=100000)
+        parser.add_argument('--bettors', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        bets = [
+            (x + 1, random.randint(1, options['bettors']), random.choice((SIDE_A, SIDE_B)), random.randint(1, 50000))
+            for x in range(options['bets'])
+        ]
+
+        def build():
+            market = Market(1, 'chosen_team_id', {1: SIDE_A, 2: SIDE_B}, ('team a', 'team b'))
+            for bet in bets:
+                market.append(*bet)
+            return market
+
+        seconds = min(timeit.repeat(build, number=1, repeat=options['repeat']))
+        self.stdout.write('append          %10.2f us/bet' % (seconds / len(bets) * 1e6))
+
+        market = build()
+        # Names would come from the database the first time each bettor is listed
+        market.names = {wallet_id: ('bettor %d' % wallet_id, 'FFFFFF') for wallet_id in market.bettors}
+        for name, query in (
+            ('side totals', lambda: (market.side_total(SIDE_A), market.side_total(SIDE_B))),
+            ('stake', lambda: market.stake(1)),
+            ('odds', lambda: (market.implied_probabilities(), market.payout_multipliers())),
+            ('bettor pool', lambda: market.bettor_pool(20)),
+        ):
+            number = 10 if name == 'bettor pool' else 10000
+            seconds = min(timeit.repeat(query, number=number, repeat=options['repeat'])) / number
+            self.stdout.write('%-15s %10.2f us' % (name, seconds * 1e6))
+
+        arrays = (market.bet_ids, market.wallets, market.bet_sides, market.amounts, market.bettors) + market.stakes
+        size = sum(sys.getsizeof(array) for array in arrays) + sys.getsizeof(market.positions)
+        self.stdout.write('memory          %10.1f MB for %d bets' % (size / 1e6, len(bets)))
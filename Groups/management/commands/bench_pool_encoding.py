@@ -0,0 +1,100 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from decimal import Decimal
+from Bets.models import pool_amount, pool_percent
+from Groups.messages import get_encoder
+import json
+import random
+import timeit
+
+
+def legacy_encode(bets):
+    # The old send_update: one JSON object per bet joined up by hand, then wrapped in another json.dumps.
+    # qs.count() is stood in for by len(), so this leaves out the extra query it made for each bet
+    total_bet = 0
+    count = 0
+    for bet in bets:
+        total_bet += bet['amount']
+    data = '['
+    for bet in bets:
+        data += '{"name": "' + bet['name'] + '", "amount": ' + str(bet['amount']) + ', "percent": ' + \
+                str((bet['amount'] / total_bet) * 100) + ', "team": "' + bet['team'] + '", "colour": "' + \
+                bet['colour'] + '"}'
+        count += 1
+        if count != len(bets):
+            data += ","
+    data += ']'
+    return json.dumps({'message': data, 'total_bet': str(total_bet)})
+
+
+def pool_payload(bets, top):
+    # What pool_update sends for the same bets: one slice per bettor and side, as bettor_pool builds it from the
+    # rows the database has already added up
+    totals = {}
+    for bet in bets:
+        key = (bet['name'], bet['team'], bet['colour'])
+        totals[key] = totals.get(key, 0) + bet['amount']
+    total = sum(totals.values())
+
+    pool = []
+    listed = {}
+    others = {}
+    for (name, team, colour), amount in sorted(totals.items(), key=lambda item: -item[1]):
+        if listed.get(team, 0) >= top:
+            others[team] = others.get(team, 0) + amount
+            continue
+        listed[team] = listed.get(team, 0) + 1
+        pool.append({'name': name, 'amount': pool_amount(amount), 'percent': pool_percent(amount, total),
+                     'team': team, 'colour': colour})
+    for team, amount in others.items():
+        pool.append({'name': 'Others', 'amount': pool_amount(amount), 'percent': pool_percent(amount, total),
+                     'team': team, 'colour': '#D3D3D3'})
+
+    return {
+        'totals': {'total_bet': total, 'side_a_total': total, 'side_b_total': Decimal('0.00'),
+                   'bettor_count': len(totals)},
+        'pool': pool,
+        'total_bet': total
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares the size and encode time of the match pool update against the old per-bet encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 50000])
+        parser.add_argument('--bettors', type=int, default=100, help='Number of people placing the bets')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        encoders = ['Groups.messages.compact_dumps']
+        try:
+            import orjson
+            encoders.append('Groups.messages.orjson_dumps')
+        except ImportError:
+            self.stdout.write('orjson is not installed, skipping Groups.messages.orjson_dumps')
+
+        random.seed(0)
+        bettors = [('user%d' % x, '#%06X' % random.randrange(0x1000000)) for x in range(options['bettors'])]
+        self.stdout.write('%8s  %-32s %12s %12s' % ('bets', 'encoder', 'bytes', 'ms'))
+        for size in options['sizes']:
+            bets = []
+            for x in range(size):
+                name, colour = random.choice(bettors)
+                bets.append({
+                    'name': name,
+                    'amount': Decimal(random.randint(100, 5000)) / 100,
+                    'team': random.choice(['team_a', 'team_b']),
+                    'colour': colour
+                })
+
+            self.report(size, 'legacy', lambda: legacy_encode(bets), options['repeat'])
+            payload = pool_payload(bets, settings.POOL_TOP_BETTORS)
+            for path in encoders:
+                encoder = get_encoder(path)
+                self.report(size, path, lambda: encoder(payload), options['repeat'])
+
+    def report(self, size, name, encode, repeat):
+        encoded = encode()
+        seconds = min(timeit.repeat(encode, number=1, repeat=repeat))
+        self.stdout.write('%8d  %-32s %12d %12.3f' % (size, name, len(encoded.encode()), seconds * 1000))
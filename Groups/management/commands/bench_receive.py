@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from Groups import protocol
+from Groups.forms import BetForm, ChatForm
+import json
+import random
+import timeit
+
+
+def form_receive(text_data):
+    # The old receive: keys sniffed out of the frame, then a form built and cleaned for it
+    text_data_json = json.loads(text_data)
+    if "amountBid" in text_data_json:
+        form = BetForm({"chosen_team": text_data_json['chosenTeam'], "amount": text_data_json['amountBid']})
+    elif "chat_message" in text_data_json:
+        form = ChatForm({"chat_message": text_data_json['chat_message']})
+    else:
+        return None
+    form.is_valid()
+    return form.cleaned_data
+
+
+def schema_receive(text_data):
+    text_data_json = json.loads(text_data)
+    message_type = protocol.message_type(text_data_json)
+    if message_type == 'bet':
+        return protocol.bet.clean(text_data_json)
+    if message_type == 'chat':
+        return protocol.chat.clean(text_data_json)
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Compares parsing and checking websocket frames with the protocol schemas against the old Django forms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        frames = []
+        for x in range(options['messages']):
+            # Mostly chat, as in a busy room
+            if random.random() < 0.2:
+                frames.append(json.dumps({'type': 'bet', 'chosenTeam': 'team_%d' % random.randint(1, 2),
+                                          'amountBid': '%d.%02d' % (random.randint(1, 500), random.randint(0, 99))}))
+            else:
+                frames.append(json.dumps({'type': 'chat', 'chat_message': 'message %d' % x}))
+
+        self.stdout.write('%-8s %12s %12s' % ('receive', 'us/message', 'messages/s'))
+        for name, receive in (('forms', form_receive), ('schema', schema_receive)):
+            seconds = min(timeit.repeat(
+                lambda: [receive(frame) for frame in frames], number=1, repeat=options['repeat']
+            ))
+            self.stdout.write('%-8s %12.2f %12d' % (name, seconds / len(frames) * 1e6, len(frames) / seconds))
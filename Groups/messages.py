@@ -0,0 +1,139 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+from functools import lru_cache
+import json
+
+
+def compact_dumps(payload):
+    ''' The standard library encoder without the whitespace, using Django's handling of Decimals and datetimes. '''
+    return json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+
+def orjson_dumps(payload):
+    ''' orjson, for when it is installed. Anything it can't encode itself goes through Django's encoder. '''
+    import orjson
+    return orjson.dumps(payload, default=DjangoJSONEncoder().default).decode()
+
+
+@lru_cache(maxsize=None)
+def get_encoder(path):
+    return import_string(path)
+
+
+def encode(payload):
+    ''' Turn a websocket payload into text once, with the encoder named in WEBSOCKET_JSON_ENCODER. '''
+    return get_encoder(settings.WEBSOCKET_JSON_ENCODER)(payload)
+
+
+def pool_update(match_betting_group, pool=None):
+    # The state of the pool, sent to the whole room whenever it changes. The pool split per bettor can be passed in if
+    # it has already been worked out
+    if pool is None:
+        pool = match_betting_group.bettor_pool(settings.POOL_TOP_BETTORS)
+    return {
+        'seq': match_betting_group.pool_version,
+        'totals': match_betting_group.pool_totals(),
+        'pool': pool,
+        'total_bet': match_betting_group.total_staked
+    }
+
+
+def card_update(match_betting_group):
+    # Just enough of the pool to draw a match's card on the group page
+    return {
+        'card': {
+            'id': match_betting_group.id,
+            'seq': match_betting_group.pool_version,
+            'total_bet': match_betting_group.total_staked,
+            'side_a_total': match_betting_group.side_a_total,
+            'side_b_total': match_betting_group.side_b_total,
+            'bettor_count': match_betting_group.bettor_count
+        }
+    }
+
+
+def welcome(seq, reconnect_after):
+    # Sent when a socket connects. reconnect_after is how long in milliseconds the page should wait before connecting
+    # again if the socket drops, picked at random so a whole room doesn't come back at once
+    return {
+        'welcome': {
+            'seq': seq,
+            'reconnect_after': reconnect_after
+        }
+    }
+
+
+def bet_ack(bet, team, key=None, duplicate=False):
+    # Sent only to the person who placed the bet. key is the idempotency key the page sent with it, and duplicate
+    # says the bet had already been placed under that key and this was a retry
+    return {
+        'ack': {
+            'key': key,
+            'amount': bet.amount,
+            'team': team,
+            'duplicate': duplicate
+        }
+    }
+
+
+def bet_reject(reason, code, key=None):
+    # code is one of invalid, not_member, betting_closed, invalid_team, insufficient_funds or server_error
+    return {
+        'reject': {
+            'key': key,
+            'code': code,
+            'reason': reason
+        }
+    }
+
+
+def viewers(count):
+    # How many people are watching the match, sent when it changes
+    return {
+        'viewers': {
+            'count': count
+        }
+    }
+
+
+def chat_reject(reason, code):
+    # Sent only to the person whose message was kept out of the chat. code is invalid or blocked
+    return {
+        'reject': {
+            'code': code,
+            'reason': reason
+        }
+    }
+
+
+def cards_reject(reason, code):
+    # Sent to the group page when it asks to follow or stop following cards with a frame that can't be read. code is
+    # invalid
+    return {
+        'reject': {
+            'code': code,
+            'reason': reason
+        }
+    }
+
+
+def rate_limited(kind, retry_after):
+    # Sent instead of acting on a bet or chat message sent too soon after the last ones. retry_after is in milliseconds,
+    # or None if the group has stopped them altogether
+    return {
+        'error': {
+            'code': 'rate_limited',
+            'kind': kind,
+            'retry_after': retry_after
+        }
+    }
+
+
+def chat_message(username, message, key):
+    # key identifies the message, so a page reconnecting can say which it saw last
+    return {
+        'message': str(message),
+        'chat_user': username,
+        'id': key
+    }
@@ -0,0 +1,40 @@
+from threading import Lock
+
+# Counters and timings for the websocket side of this process. They live in memory, so each daphne process
+# reports on its own sockets only
+
+_lock = Lock()
+_metrics = {}
+
+
+def observe(name, value):
+    ''' Record one measurement, e.g. how long a job waited for a database thread. '''
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        metric['count'] += 1
+        metric['total'] += value
+        if value > metric['max']:
+            metric['max'] = value
+
+
+def increment(name, amount=1):
+    with _lock:
+        _metrics[name] = _metrics.get(name, 0) + amount
+
+
+def snapshot():
+    ''' A copy of every metric, with the mean worked out for measurements. '''
+    with _lock:
+        metrics = {}
+        for name, metric in _metrics.items():
+            if isinstance(metric, dict):
+                metric = dict(metric, mean=metric['total'] / metric['count'])
+            metrics[name] = metric
+        return metrics
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Bets', '0003_pool_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('Groups', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(blank=True, max_length=150)),
+                ('message', models.CharField(max_length=1024)),
+                ('key', models.UUIDField(editable=False, unique=True)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('match_betting_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='Bets.MatchBettingGroup')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'index_together': {('match_betting_group', 'created')},
+            },
+        ),
+    ]
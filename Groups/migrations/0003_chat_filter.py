@@ -0,0 +1,28 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Groups', '0002_chat_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='communitygroup',
+            name='chat_banned_words',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='communitygroup',
+            name='chat_block_links',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='communitygroup',
+            name='chat_filter_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+    ]
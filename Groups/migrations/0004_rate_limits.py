@@ -0,0 +1,33 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Groups', '0003_chat_filter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='communitygroup',
+            name='bet_burst',
+            field=models.PositiveIntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name='communitygroup',
+            name='bet_rate',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='communitygroup',
+            name='chat_burst',
+            field=models.PositiveIntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name='communitygroup',
+            name='chat_rate',
+            field=models.FloatField(default=1),
+        ),
+    ]
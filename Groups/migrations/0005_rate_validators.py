@@ -0,0 +1,24 @@
+# Generated by Django 2.2.1 on 2026-10-18 15:55
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Groups', '0004_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='communitygroup',
+            name='bet_rate',
+            field=models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AlterField(
+            model_name='communitygroup',
+            name='chat_rate',
+            field=models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+    ]
@@ -1,6 +1,9 @@
+from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+import hashlib
 
 # Create your models here.
 class CommunityGroup(models.Model):
@@ -26,6 +29,43 @@ class CommunityGroup(models.Model):
                               null=False,
                               blank=False)
 
+    # Chat moderation. Banned words and phrases go one to a line. The version changes whenever the filter does, which
+    # is how the websocket processes know to load it again
+    chat_banned_words = models.TextField(blank=True, default="")
+    chat_block_links = models.BooleanField(default=False)
+    chat_filter_version = models.CharField(max_length=16, blank=True, default="", editable=False)
+
+    # How many bets and chat messages a second each socket on a match page can send, and how many at once. Each user
+    # gets WEBSOCKET_USER_RATE_FACTOR times this across all of their sockets. A rate of 0 stops them once the burst is
+    # used up
+    bet_rate = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    bet_burst = models.PositiveIntegerField(default=5)
+    chat_rate = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    chat_burst = models.PositiveIntegerField(default=5)
+
+    def save(self, *args, **kwargs):
+        filter_settings = '%s\n%s' % (self.chat_block_links, self.chat_banned_words)
+        self.chat_filter_version = hashlib.sha1(filter_settings.encode()).hexdigest()[:16]
+        return super(CommunityGroup, self).save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
+
+class ChatMessage(models.Model):
+    # Chat on a match page. Messages are written in batches by the websocket consumers, so one may not be here until
+    # a moment after it was sent, and are deleted after CHAT_RETENTION_DAYS
+    match_betting_group = models.ForeignKey('Bets.MatchBettingGroup', related_name='chat_messages', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    # Kept as it was sent so the history can be replayed without looking users up
+    username = models.CharField(max_length=150, blank=True)
+    message = models.CharField(max_length=1024)
+    # Sent with the message, so pages can say which they have already seen
+    key = models.UUIDField(unique=True, editable=False)
+    created = models.DateTimeField(db_index=True)
+
+    class Meta:
+        index_together = ('match_betting_group', 'created')
+
+    def __str__(self):
+        return self.username + ": " + self.message
@@ -0,0 +1,169 @@
+from django.conf import settings
+from .database import run_in_db
+from .models import CommunityGroup
+from . import metrics
+import asyncio
+import re
+import string
+import time
+import unicodedata
+
+# Chat is checked against the group's banned words with an Aho-Corasick automaton, so a message is read once whatever
+# the length of the list. Messages and words are normalised the same way first, to catch the usual ways of dressing a
+# word up: capitals, accents, digits for letters, punctuation between the letters and letters held down
+#
+# Each process compiles a group's list the first time it is needed, and looks every CHAT_FILTER_RELOAD seconds to see
+# whether it has been changed, so edits to the list take effect without restarting anything
+
+_filters = {}
+_loading = {}
+
+# Digits and symbols that stand in for letters
+_lookalikes = str.maketrans({
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', '9': 'g',
+    '@': 'a', '$': 's', '!': 'i', '|': 'l', '+': 't', '€': 'e', '£': 'l'
+})
+# Punctuation at the start or end of a word, apart from what could be standing in for a letter
+_edges = re.compile(r'(?<!\S)[%(edges)s]+|[%(edges)s]+(?!\S)' % {
+    'edges': re.escape(''.join(character for character in string.punctuation if character not in '@$|+'))
+})
+_separators = re.compile(r'[^\w\s]|_')
+# Three or more of a letter in a row is a letter held down. Two is just a double letter, and is left alone so that
+# "as" or "bob" aren't read as "ass" or "boob"
+_held_down = re.compile(r'(.)\1{2,}')
+_links = re.compile(r'(https?://|www\.|\b[a-z0-9-]+\.(com|net|org|io|gg|co|uk|ly|tv|me|xyz|info|biz)\b)', re.IGNORECASE)
+
+
+def _plain(text):
+    # Lower case letters with the lookalikes read as letters and the punctuation taken out
+    text = text.casefold()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(character for character in text if not unicodedata.combining(character))
+    # Punctuation around a word is just punctuation, but inside it is standing in for a letter or hiding the word
+    text = _edges.sub('', text).translate(_lookalikes)
+    return _separators.sub('', text)
+
+
+def _padded(text):
+    words = text.split()
+
+    # Words spelt out a letter at a time are put back together
+    if any(len(word) == 1 for word in words):
+        joined = []
+        spelt_out = []
+        for word in words + ['']:
+            if len(word) == 1:
+                spelt_out.append(word)
+                continue
+            joined.extend(spelt_out if len(spelt_out) < 3 else [''.join(spelt_out)])
+            spelt_out = []
+            joined.append(word)
+        words = joined[:-1]
+    return ' %s ' % ' '.join(words)
+
+
+def normalise(text, held_down=r'\1'):
+    ''' Text as the filter sees it: plain lower case letters, with single spaces between words and at either end. '''
+    return _padded(_held_down.sub(held_down, _plain(text)))
+
+
+class WordMatcher:
+    ''' An Aho-Corasick automaton over a list of normalised words. '''
+    # Words are padded with spaces like the text, so they only match whole words and phrases, and a word hidden inside
+    # another one ("class" in "classic") doesn't count
+
+    def __init__(self, words):
+        # State 0 is the root. Each state has its transitions, the state to fall back to, and whether a word ends
+        # there or at any state it falls back to
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+
+        for word in words:
+            word = normalise(word)
+            if not word.strip():
+                continue
+            state = 0
+            for character in word:
+                next_state = self.goto[state].get(character)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][character] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                state = next_state
+            self.output[state] = True
+
+        # Breadth first, so every state's fallback is worked out before its children's
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                fallback = self.goto[fallback].get(character, 0)
+                self.fail[next_state] = fallback if fallback != next_state else 0
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+
+    def search(self, text):
+        ''' Whether any of the words appear in already normalised text. '''
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if output[state]:
+                return True
+        return False
+
+
+class ChatFilter:
+
+    def __init__(self, version, words, block_links):
+        self.version = version
+        self.matcher = WordMatcher(words)
+        self.block_links = block_links
+        self.checked_at = time.monotonic()
+
+    def blocks(self, message):
+        ''' Whether the message should be kept out of the chat. '''
+        if self.block_links and _links.search(message):
+            return True
+        plain = _plain(message)
+        collapsed, held_down = _held_down.subn(r'\1', plain)
+        if self.matcher.search(_padded(collapsed)):
+            return True
+        # A letter held down may be a double letter in the word ("asssss"), so it is tried again as two
+        return held_down > 0 and self.matcher.search(_padded(_held_down.sub(r'\1\1', plain)))
+
+
+def load_filter(group_id, chat_filter):
+    # Runs in the database pool. The word list is only read and compiled again if it has changed
+    version = CommunityGroup.objects.filter(id=group_id).values_list('chat_filter_version', flat=True).get()
+    if chat_filter is not None and chat_filter.version == version:
+        chat_filter.checked_at = time.monotonic()
+        return chat_filter
+    words, block_links = CommunityGroup.objects.filter(id=group_id).values_list(
+        'chat_banned_words', 'chat_block_links'
+    ).get()
+    metrics.increment('chat_filter_compiles')
+    return ChatFilter(version, words.splitlines(), block_links)
+
+
+async def get_filter(group_id):
+    ''' The group's chat filter, checking for changes to its list if it hasn't been checked for a while. '''
+    chat_filter = _filters.get(group_id)
+    if chat_filter is not None and time.monotonic() - chat_filter.checked_at < settings.CHAT_FILTER_RELOAD:
+        return chat_filter
+
+    # Sockets in the same group share one check
+    loading = _loading.get(group_id)
+    if loading is None:
+        loading = _loading[group_id] = asyncio.ensure_future(run_in_db(load_filter, group_id, chat_filter))
+        loading.add_done_callback(lambda future: _loading.pop(group_id, None))
+    chat_filter = _filters[group_id] = await asyncio.shield(loading)
+    return chat_filter
@@ -0,0 +1,62 @@
+from collections import deque
+from django.conf import settings
+from . import metrics
+import asyncio
+import time
+
+
+class Outbound:
+    ''' Messages waiting to go out on one socket, written in order by a task of their own. '''
+    # Updates to the pool only matter until the next one, so while one is still waiting to go out a newer one takes
+    # its place rather than queueing behind it. Everything else, like chat, is sent in the order it arrived. A socket
+    # following several pools keeps one waiting update for each, by key
+
+    def __init__(self, send):
+        self.send = send
+        # Each entry is [text, time queued, key]
+        self.queue = deque()
+        self.states = {}
+        self.ready = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.write())
+
+    def put(self, text):
+        self.queue.append([text, time.monotonic(), None])
+        self.queued()
+
+    def put_state(self, text, key=None):
+        state = self.states.get(key)
+        if state is not None:
+            state[0] = text
+            metrics.increment('outbound_state_replaced')
+            return
+        state = self.states[key] = [text, time.monotonic(), key]
+        self.queue.append(state)
+        self.queued()
+
+    def queued(self):
+        metrics.observe('outbound_queue_depth', len(self.queue))
+        self.ready.set()
+
+    def lag(self):
+        # How long the oldest message still waiting has been waiting
+        if not self.queue:
+            return 0
+        return time.monotonic() - self.queue[0][1]
+
+    def behind(self):
+        ''' Whether the socket has fallen too far behind to be worth keeping open. '''
+        return len(self.queue) > settings.WEBSOCKET_MAX_QUEUE or self.lag() > settings.WEBSOCKET_MAX_LAG
+
+    async def write(self):
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                entry = self.queue.popleft()
+                if self.states.get(entry[2]) is entry:
+                    del self.states[entry[2]]
+                await self.send(text_data=entry[0])
+            self.ready.clear()
+
+    def close(self):
+        self.writer.cancel()
+        metrics.increment('outbound_dropped', len(self.queue))
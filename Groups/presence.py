@@ -0,0 +1,225 @@
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .messages import encode, viewers
+from . import metrics
+import asyncio
+import time
+import uuid
+
+# Who is watching each match room. Each process counts its own sockets, and tells the other processes with sockets in
+# the room who it has by sending its members to the room's presence group. Processes repeat this every
+# PRESENCE_HEARTBEAT seconds, and one not heard from for PRESENCE_EXPIRY seconds, say because it crashed, is taken to
+# have nobody. Changes are gathered up for PRESENCE_DEBOUNCE seconds, so a room filling up sends a few counts rather
+# than one per socket
+#
+# Only one channel in each process joins a room's presence group, rather than every socket in the room, so each
+# heartbeat is delivered once to each process
+
+_process = uuid.uuid4().hex
+_rooms = {}
+# The channel this process hears the others on, shared by all of its rooms, and the task reading it
+_channel = None
+_listener = None
+
+
+def presence_group_name(betting_group_id):
+    return 'presence_%s' % betting_group_id
+
+
+def get_channel():
+    ''' The channel this process hears presence on, opened when the first room here needs it. '''
+    global _channel
+    if _channel is None:
+        _channel = asyncio.ensure_future(open_channel())
+    return _channel
+
+
+async def open_channel():
+    global _listener
+    layer = get_channel_layer()
+    channel = await layer.new_channel('presence.')
+    _listener = asyncio.ensure_future(listen(layer, channel))
+    return channel
+
+
+async def listen(layer, channel):
+    while True:
+        event = await layer.receive(channel)
+        heard(event['betting_group_id'], event)
+
+
+def close_channel():
+    # The last room here has gone, so there's nothing left to hear about
+    global _channel, _listener
+    if _channel is not None:
+        _channel.cancel()
+    if _listener is not None:
+        _listener.cancel()
+    _channel = _listener = None
+
+
+class RoomPresence:
+
+    def __init__(self, betting_group_id):
+        self.betting_group_id = betting_group_id
+        # Sockets here, and how many of them each signed in user has open
+        self.sockets = set()
+        self.members = {}
+        self.anonymous = 0
+        # Started from the clock rather than 0, so a room rebuilt here after everyone left and someone came back carries
+        # on from above the versions the other processes heard from the last one, and isn't ignored
+        self.version = time.time_ns()
+        # What the other processes last said, by process: (version, members, anonymous, time heard)
+        self.remote = {}
+        self.viewers = 0
+        self.announce = False
+        self.pending = None
+        self.channel = get_channel()
+        self.subscribed = asyncio.ensure_future(self.subscribe())
+        self.heartbeat = asyncio.ensure_future(self.beat())
+
+    def join(self, consumer):
+        self.sockets.add(consumer)
+        user = consumer.user
+        if user.is_authenticated:
+            self.members[user.id] = self.members.get(user.id, 0) + 1
+        else:
+            self.anonymous += 1
+        self.changed(announce=True)
+        # Everyone else in the room already has the count, but the new socket needs it now
+        if self.viewers:
+            consumer.send_viewers(self.text)
+
+    def leave(self, consumer):
+        self.sockets.discard(consumer)
+        user = consumer.user
+        if user.is_authenticated:
+            self.members[user.id] -= 1
+            if not self.members[user.id]:
+                del self.members[user.id]
+        else:
+            self.anonymous -= 1
+
+        if not self.sockets:
+            # Nothing here to keep up to date, so tell the others straight away and stop
+            _rooms.pop(self.betting_group_id, None)
+            self.heartbeat.cancel()
+            if self.pending is not None:
+                self.pending.cancel()
+            self.version += 1
+            asyncio.ensure_future(self.close())
+            if not _rooms:
+                close_channel()
+        else:
+            self.changed(announce=True)
+
+    def heard(self, event):
+        ''' Another process has said who it has in the room. '''
+        if event['process'] == _process:
+            return
+        # Anything older than what was last heard from the process is out of date
+        heard = self.remote.get(event['process'])
+        if heard is not None and heard[0] >= event['version']:
+            return
+        self.remote[event['process']] = (event['version'], set(event['members']), event['anonymous'], time.monotonic())
+        # A process that has only just joined doesn't know who is here yet
+        self.changed(announce=heard is None)
+
+    def changed(self, announce=False):
+        self.announce = self.announce or announce
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.settle())
+        else:
+            metrics.increment('presence_merged')
+
+    async def settle(self):
+        await asyncio.sleep(settings.PRESENCE_DEBOUNCE or 0)
+        self.pending = None
+        if self.announce:
+            self.announce = False
+            self.version += 1
+            await self.send()
+        self.count()
+
+    async def beat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            now = time.monotonic()
+            expired = [
+                process for process, heard in self.remote.items() if now - heard[3] > settings.PRESENCE_EXPIRY
+            ]
+            for process in expired:
+                del self.remote[process]
+            if expired:
+                metrics.increment('presence_expired', len(expired))
+            self.version += 1
+            await self.send()
+            self.count()
+
+    async def subscribe(self):
+        channel = await asyncio.shield(self.channel)
+        await get_channel_layer().group_add(presence_group_name(self.betting_group_id), channel)
+
+    async def close(self):
+        await self.send()
+        # Unless the room has been opened here again on the same channel
+        if _rooms.get(self.betting_group_id) is None or _channel is not self.channel:
+            await get_channel_layer().group_discard(presence_group_name(self.betting_group_id), self.channel.result())
+
+    async def send(self):
+        # Nothing is heard from the others until this process is in the group, so there's no point telling them before
+        await self.subscribed
+        await get_channel_layer().group_send(
+            presence_group_name(self.betting_group_id),
+            {
+                'type': 'presence_heard',
+                'betting_group_id': self.betting_group_id,
+                'process': _process,
+                'version': self.version,
+                'members': list(self.members),
+                'anonymous': self.anonymous
+            }
+        )
+
+    def count(self):
+        # Only send the count on when it has changed
+        members = set(self.members)
+        anonymous = self.anonymous
+        for version, remote_members, remote_anonymous, heard_at in self.remote.values():
+            members |= remote_members
+            anonymous += remote_anonymous
+        viewer_count = len(members) + anonymous
+        if viewer_count == self.viewers:
+            return
+        self.viewers = viewer_count
+        text = self.text
+        for consumer in self.sockets:
+            consumer.send_viewers(text)
+
+    @property
+    def text(self):
+        return encode(viewers(self.viewers))
+
+
+def join(betting_group_id, consumer):
+    presence = _rooms.get(betting_group_id)
+    if presence is None:
+        presence = _rooms[betting_group_id] = RoomPresence(betting_group_id)
+    presence.join(consumer)
+
+
+def leave(betting_group_id, consumer):
+    presence = _rooms.get(betting_group_id)
+    if presence is not None and consumer in presence.sockets:
+        presence.leave(consumer)
+
+
+def heard(betting_group_id, event):
+    presence = _rooms.get(betting_group_id)
+    if presence is not None:
+        presence.heard(event)
+
+
+def viewer_counts():
+    ''' How many people are watching each room with sockets in this process, as of the last count. '''
+    return {betting_group_id: presence.viewers for betting_group_id, presence in list(_rooms.items())}
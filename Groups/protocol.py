@@ -0,0 +1,146 @@
+from decimal import Decimal, InvalidOperation
+from django import forms
+import re
+
+# What the pages can send over their websockets, and the checks each field gets. These do the same checks as the
+# Django form fields they replace, with the same error, without building a form for every frame
+#
+# Every frame says what it is in its 'type'. Pages loaded before the type was added are still told apart by their keys
+
+_key = re.compile(r'[A-Za-z0-9_-]+')
+
+
+class Text:
+    ''' A required string, stripped of surrounding whitespace, like a CharField. '''
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def clean(self, value):
+        if value is None:
+            raise invalid()
+        value = str(value).strip()
+        if not value or len(value) > self.max_length:
+            raise invalid()
+        return value
+
+
+class Amount:
+    ''' A required Decimal with at most max_digits digits, decimal_places of them after the point, like a DecimalField. '''
+
+    def __init__(self, max_digits, decimal_places, min_value):
+        self.max_digits = max_digits
+        self.decimal_places = decimal_places
+        self.min_value = min_value
+
+    def clean(self, value):
+        if value is None or isinstance(value, bool):
+            raise invalid()
+        try:
+            amount = Decimal(str(value).strip())
+        except InvalidOperation:
+            raise invalid()
+        if not amount.is_finite():
+            raise invalid()
+
+        # Counted the way Django's DecimalValidator counts them
+        sign, digit_tuple, exponent = amount.as_tuple()
+        if exponent >= 0:
+            digits = len(digit_tuple) + exponent
+            decimals = 0
+        elif abs(exponent) > len(digit_tuple):
+            digits = decimals = abs(exponent)
+        else:
+            digits = len(digit_tuple)
+            decimals = abs(exponent)
+        if digits > self.max_digits or decimals > self.decimal_places:
+            raise invalid()
+        if digits - decimals > self.max_digits - self.decimal_places:
+            raise invalid()
+
+        if amount < self.min_value:
+            raise invalid()
+        return amount
+
+
+class Key:
+    ''' An optional idempotency key made up by the page, of letters, digits and dashes. '''
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def clean(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, str) or not 0 < len(value) <= self.max_length or not _key.fullmatch(value):
+            raise invalid()
+        return value
+
+
+class IdList:
+    ''' A list of up to max_length whole numbers. '''
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def clean(self, value):
+        if not isinstance(value, list) or len(value) > self.max_length:
+            raise invalid()
+        # bool is an int too
+        if not all(type(id) is int for id in value):
+            raise invalid()
+        return value
+
+
+class Schema:
+    ''' The fields of one type of frame, as name=(key in the frame, field). '''
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def clean(self, data):
+        return {name: field.clean(data.get(key)) for name, (key, field) in self.fields.items()}
+
+
+def invalid():
+    return forms.ValidationError("Form is not valid", code='invalid')
+
+
+_bet_key = Key(64)
+bet = Schema(
+    key=('key', _bet_key),
+    chosen_team=('chosenTeam', Text(200)),
+    amount=('amountBid', Amount(7, 2, Decimal('0.01')))
+)
+chat = Schema(
+    chat_message=('chat_message', Text(1024))
+)
+cards = Schema(
+    ids=('ids', IdList(1000))
+)
+
+# What frames without a type are taken to be, from the key that marks each of them
+_untyped = (
+    ('amountBid', 'bet'),
+    ('chat_message', 'chat'),
+)
+
+
+def bet_key(data):
+    ''' The frame's idempotency key if it has a usable one, to send back with a rejection. '''
+    try:
+        return _bet_key.clean(data.get('key'))
+    except forms.ValidationError:
+        return None
+
+
+def message_type(data):
+    ''' The type of a frame, or None if it isn't one the sockets know. '''
+    if not isinstance(data, dict):
+        return None
+    if 'type' in data:
+        return data['type']
+    for key, message_type in _untyped:
+        if key in data:
+            return message_type
+    return None
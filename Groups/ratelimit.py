@@ -0,0 +1,90 @@
+from django.conf import settings
+import time
+
+# Bets and chat sent over a match socket are each limited by two token buckets, one for the socket and one shared by
+# all of the user's sockets in the group on this process, with the rates set on the CommunityGroup. Everything here is
+# in memory, so a message over the limit is turned away before any database work is done for it
+
+_users = {}
+
+
+class TokenBucket:
+    ''' Allows rate messages a second on average, and bursts of up to burst at once. '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        ''' Seconds until there is a token to take, or None if there won't be one because the rate is 0. '''
+        if self.tokens >= 1:
+            return 0.0
+        if not self.rate:
+            return None
+        return (1 - self.tokens) / self.rate
+
+
+class Limiter:
+    ''' The buckets one socket's messages are taken from. rates is {kind: (rate, burst)}. '''
+
+    def __init__(self, user, group_id, rates):
+        self.buckets = {}
+        self.user_keys = []
+        factor = settings.WEBSOCKET_USER_RATE_FACTOR
+        for kind, (rate, burst) in rates.items():
+            buckets = [TokenBucket(rate, burst)]
+            if user.is_authenticated:
+                key = (user.id, group_id, kind)
+                shared = _users.get(key)
+                if shared is None:
+                    shared = _users[key] = [TokenBucket(rate * factor, burst * factor), 0]
+                shared[1] += 1
+                self.user_keys.append(key)
+                buckets.append(shared[0])
+            self.buckets[kind] = buckets
+        # Every message turned away takes one of these, and a socket that runs out is closed
+        self.violations = TokenBucket(settings.WEBSOCKET_VIOLATION_RATE, settings.WEBSOCKET_MAX_VIOLATIONS)
+
+    def allow(self, kind):
+        ''' Whether a message can be sent now, taking it from the allowances if so. '''
+        buckets = self.buckets[kind]
+        # A message turned away by one bucket shouldn't use up the others
+        for bucket in buckets:
+            bucket.refill()
+        if any(bucket.tokens < 1 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+    def retry_after(self, kind):
+        waits = [bucket.wait() for bucket in self.buckets[kind]]
+        if None in waits:
+            return None
+        return max(waits)
+
+    def abusive(self):
+        ''' Note a message turned away, returning whether the socket has had too many turned away to keep open. '''
+        return not self.violations.take()
+
+    def close(self):
+        for key in self.user_keys:
+            shared = _users[key]
+            shared[1] -= 1
+            if not shared[1]:
+                del _users[key]
+        self.user_keys = []
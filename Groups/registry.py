@@ -0,0 +1,65 @@
+from Bets import market
+from .database import run_in_db
+from .room import BettingRoom
+from . import metrics
+import asyncio
+
+# The BettingRoom for each match with sockets in this process, shared by all of them. It is read from the database by
+# the first socket to join, and once more each time the match is edited, however many sockets are watching. Rooms
+# aren't changed once loaded, an edit replaces the room, so a socket can keep using the one it has while it's in use.
+# The match's market goes when its last socket does
+
+_rooms = {}
+_loading = {}
+_subscribers = {}
+# The last change to each match this process has loaded again for
+_changes = {}
+
+
+def subscribe(betting_group_id):
+    _subscribers[betting_group_id] = _subscribers.get(betting_group_id, 0) + 1
+
+
+def unsubscribe(betting_group_id):
+    # Once nobody here is in the room there's no need to keep it
+    _subscribers[betting_group_id] -= 1
+    if not _subscribers[betting_group_id]:
+        del _subscribers[betting_group_id]
+        _rooms.pop(betting_group_id, None)
+        _changes.pop(betting_group_id, None)
+        market.forget(betting_group_id)
+
+
+def loaded(betting_group_id, loading):
+    # Only kept if the match wasn't edited while it was being read
+    if _loading.get(betting_group_id) is not loading:
+        return
+    del _loading[betting_group_id]
+    if not loading.cancelled() and loading.exception() is None and betting_group_id in _subscribers:
+        _rooms[betting_group_id] = loading.result()
+
+
+async def get(betting_group_id):
+    ''' The room for a match the caller is subscribed to, reading it only if nobody here has since it last changed. '''
+    room = _rooms.get(betting_group_id)
+    if room is not None:
+        metrics.increment('room_hits')
+        return room
+
+    # Sockets joining at the same time share one read
+    loading = _loading.get(betting_group_id)
+    if loading is None:
+        metrics.increment('room_reads')
+        loading = _loading[betting_group_id] = asyncio.ensure_future(run_in_db(BettingRoom.load, betting_group_id))
+        loading.add_done_callback(lambda future: loaded(betting_group_id, future))
+    return await asyncio.shield(loading)
+
+
+def changed(betting_group_id, change):
+    ''' The match was edited, so the room is read again when it's next needed. '''
+    # A change already acted on here is ignored if it's heard again
+    if change is not None and _changes.get(betting_group_id) == change:
+        return
+    _changes[betting_group_id] = change
+    _rooms.pop(betting_group_id, None)
+    _loading.pop(betting_group_id, None)
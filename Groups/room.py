@@ -0,0 +1,110 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django import forms
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from Bets.models import MatchBettingGroup
+from Profiles.models import Wallet
+from .messages import encode, card_update
+import uuid
+
+
+def room_group_name(betting_group_id):
+    return 'chat_%s' % betting_group_id
+
+
+def card_group_name(betting_group_id):
+    # Group pages following the match's card, as opposed to the match page's own room
+    return 'card_%s' % betting_group_id
+
+
+class BettingRoom:
+    ''' Everything the match consumers need to check a bet. One is shared by every socket on the match in a process,
+    so it isn't changed once loaded. '''
+
+    def __init__(self, match_betting_group):
+        match = match_betting_group.match
+        self.match_betting_group = match_betting_group
+        self.group_id = match_betting_group.group_id
+        # Bets are taken until the match starts
+        self.closes_at = match.start_datetime
+        group = match_betting_group.group
+        self.rates = {
+            'bet': (group.bet_rate, group.bet_burst),
+            'chat': (group.chat_rate, group.chat_burst)
+        }
+
+        # The match page sends the team's name, or the wallet id for matches between users
+        self.sides = {}
+        if match.team_a_id:
+            for team in (match.team_a, match.team_b):
+                self.sides[team.name] = ({'chosen_team': team}, team.name)
+        else:
+            for wallet in (match.user_a, match.user_b):
+                self.sides[str(wallet.id)] = ({'chosen_user': wallet}, wallet.profile.user.username)
+
+    @classmethod
+    def load(cls, betting_group_id):
+        match_betting_group = get_object_or_404(
+            MatchBettingGroup.objects.select_related(
+                'group',
+                'match__team_a',
+                'match__team_b',
+                'match__user_a__profile__user',
+                'match__user_b__profile__user'
+            ),
+            pk=betting_group_id
+        )
+        return cls(match_betting_group)
+
+    def check_bet(self, chosen, wallet_id):
+        ''' Returns the side a bet from the wallet is for, and its name, if the bet can be placed. '''
+        if wallet_id is None:
+            raise forms.ValidationError("User is not a member of this group", code='not_member')
+        if timezone.now() >= self.closes_at:
+            raise forms.ValidationError("Betting on this match has closed", code='betting_closed')
+        if chosen not in self.sides:
+            raise forms.ValidationError("Team Value is not valid", code='invalid_team')
+        return self.sides[chosen]
+
+
+def match_changed(match_id):
+    ''' Tell every socket watching the match to load it again. '''
+    channel_layer = get_channel_layer()
+    for betting_group_id in MatchBettingGroup.objects.filter(match_id=match_id).values_list('id', flat=True):
+        async_to_sync(channel_layer.group_send)(room_group_name(betting_group_id), {
+            'type': 'match_changed',
+            # Identifies the change, so a process that hears it more than once only loads the match again once
+            'change': uuid.uuid4().hex
+        })
+
+
+def find_wallet(group_id, user):
+    ''' The id of the user's active wallet in the group, or None if they don't have one. '''
+    return Wallet.objects.filter(
+        profile__user_id=user.id, group_id=group_id, status=Wallet.active
+    ).values_list('id', flat=True).first()
+
+
+def check_wallet(wallet_id, group_id):
+    ''' The wallet's id if it is still active in the group, or None if it has been closed since. '''
+    return Wallet.objects.filter(
+        id=wallet_id, group_id=group_id, status=Wallet.active
+    ).values_list('id', flat=True).first()
+
+
+def read_cards(group_id, betting_group_ids):
+    ''' The cards for those of the matches that are in the group, as (id, seq, update to send). '''
+    match_betting_groups = MatchBettingGroup.objects.filter(group_id=group_id, id__in=betting_group_ids).only(
+        'id', 'pool_version', 'total_staked', 'side_a_total', 'side_b_total', 'bettor_count'
+    )
+    return [
+        (match_betting_group.id, match_betting_group.pool_version, encode(card_update(match_betting_group)))
+        for match_betting_group in match_betting_groups
+    ]
+
+
+def is_group_member(group_id, user):
+    if not user.is_authenticated:
+        return False
+    return Wallet.objects.filter(profile__user_id=user.id, group_id=group_id, status=Wallet.active).exists()
@@ -5,4 +5,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     path('ws/<int:betting_group_id>/', consumers.DataConsumer),
+    path('ws/group/<int:group_id>/', consumers.GroupConsumer),
 ]
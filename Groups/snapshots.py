@@ -0,0 +1,65 @@
+from Bets.market import get_market, load_group
+from django.conf import settings
+from .database import run_in_db
+from .messages import encode, pool_update
+from . import metrics
+import asyncio
+
+# The latest update sent to each room with sockets in this process, along with its sequence number (the betting
+# group's pool_version). Every update carries the whole pool, so a socket that missed some only needs the newest one,
+# and when a process restarts and all of its sockets come back at once only one of them has to read the pool
+
+_snapshots = {}
+_loading = {}
+_subscribers = {}
+
+
+def read_pool(betting_group_id):
+    ''' The pool as it is now in the database, as its sequence number and the update to send. '''
+    match_betting_group = load_group(betting_group_id)
+    pool = get_market(match_betting_group).bettor_pool(settings.POOL_TOP_BETTORS)
+    return match_betting_group.pool_version, encode(pool_update(match_betting_group, pool))
+
+
+def record(betting_group_id, seq, text):
+    ''' Keep an update heard by the room, if it's newer than the one kept. '''
+    # Updates from different processes can arrive out of order, so only keep the newest
+    snapshot = _snapshots.get(betting_group_id)
+    if betting_group_id in _subscribers and (snapshot is None or seq > snapshot[0]):
+        _snapshots[betting_group_id] = (seq, text)
+
+
+def seq(betting_group_id):
+    ''' The sequence number of the newest update kept for the room, or 0 if there isn't one. '''
+    snapshot = _snapshots.get(betting_group_id)
+    return snapshot[0] if snapshot is not None else 0
+
+
+def subscribe(betting_group_id):
+    _subscribers[betting_group_id] = _subscribers.get(betting_group_id, 0) + 1
+
+
+def unsubscribe(betting_group_id):
+    # Once nobody here is in the room, nothing keeps the snapshot up to date
+    _subscribers[betting_group_id] -= 1
+    if not _subscribers[betting_group_id]:
+        del _subscribers[betting_group_id]
+        _snapshots.pop(betting_group_id, None)
+
+
+async def latest(betting_group_id, seq):
+    ''' The newest update for the room, reading it from the database only if nothing here has one as new as seq. '''
+    snapshot = _snapshots.get(betting_group_id)
+    if snapshot is not None and snapshot[0] >= seq:
+        metrics.increment('snapshot_hits')
+        return snapshot
+
+    # Sockets coming back at the same time share one read
+    loading = _loading.get(betting_group_id)
+    if loading is None:
+        metrics.increment('snapshot_reads')
+        loading = _loading[betting_group_id] = asyncio.ensure_future(run_in_db(read_pool, betting_group_id))
+        loading.add_done_callback(lambda future: _loading.pop(betting_group_id, None))
+    snapshot = await asyncio.shield(loading)
+    record(betting_group_id, *snapshot)
+    return snapshot
@@ -61,3 +61,31 @@ function InitialPie(team_dataset, chartID) {
 
 };
 
+// The pies on the page by betting group, so the group page's socket can redraw them as their pools change. The
+// script is loaded again with each page of cards, so keep the ones already drawn
+var cardPies = window.cardPies || {};
+
+function TrackPie(bettingGroupId, team_dataset, chartID) {
+	cardPies[bettingGroupId] = {dataset: team_dataset, chartID: chartID};
+};
+
+function UpdatePie(bettingGroupId, teamdata_a_amount, teamdata_b_amount) {
+	var card = cardPies[bettingGroupId];
+	if (card === undefined) {
+		return;
+	}
+	if (teamdata_a_amount + teamdata_b_amount == 0){
+		teamdata_a_amount = 1;
+		teamdata_b_amount = 1;
+	};
+	var total_ab_amount = teamdata_a_amount + teamdata_b_amount;
+
+	// The dataset has team b first
+	card.dataset[0].amount = teamdata_b_amount;
+	card.dataset[0].percent = (teamdata_b_amount / total_ab_amount) * 100;
+	card.dataset[1].amount = teamdata_a_amount;
+	card.dataset[1].percent = (teamdata_a_amount / total_ab_amount) * 100;
+
+	d3.select("#chart" + card.chartID).select("svg").remove();
+	InitialPie(card.dataset, card.chartID);
+};
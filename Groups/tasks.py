@@ -0,0 +1,18 @@
+from CommunityTournaments.celery import app
+from django.conf import settings
+from django.utils import timezone
+from .models import ChatMessage
+
+
+@app.task(ignore_result=True)
+def purge_chat_history():
+    ''' Delete chat messages older than CHAT_RETENTION_DAYS, a chunk at a time. '''
+    cutoff = timezone.now() - timezone.timedelta(days=settings.CHAT_RETENTION_DAYS)
+    ids = list(ChatMessage.objects.filter(created__lt=cutoff).values_list('id', flat=True)[:settings.CHAT_PURGE_CHUNK_SIZE])
+    if not ids:
+        return
+    ChatMessage.objects.filter(id__in=ids).delete()
+
+    # Hand whatever is left to a fresh task rather than hold the worker and the table for one long delete
+    if len(ids) == settings.CHAT_PURGE_CHUNK_SIZE:
+        purge_chat_history.delay()
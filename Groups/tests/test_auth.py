@@ -0,0 +1,235 @@
+from django.test import TransactionTestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from decimal import Decimal
+from CommunityTournaments.routing import application
+from Groups.auth import TokenAuthMiddleware, TokenUser, issue_token, read_token, token_wallet_id
+from Groups.models import CommunityGroup
+from Groups import batching, broadcast, chat, database, fanout, metrics, presence, ratelimit, registry, snapshots
+from Games.models import Tournament, Match
+from Profiles.models import Wallet
+from Bets import market
+from Bets.models import MatchBettingGroup, Bet
+User = get_user_model()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE=60
+)
+class TokenAuthTests(TransactionTestCase):
+    # Match page sockets sign in with a signed token from the page instead of the session
+    # ----
+    # Test 1: Test that a token is read back into a user without touching the database
+    # Test 2: Test that tokens that have expired or been tampered with aren't accepted
+    # Test 3: Test that the wallet is taken from a token for the match without looking it up
+    # Test 4: Test that a token issued for another match or group doesn't give its wallet
+    # Test 5: Test that a socket signed in with a token can bet from the token's wallet
+    # Test 6: Test that a socket without a token is signed in from the session
+    # Test 7: Test that a socket with a token issued for another match looks its wallet up and can bet
+    # Test 8: Test that a token's wallet that has been closed since the token was issued can't bet
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+        self.other_group = CommunityGroup.objects.create(name="test_group_2")
+
+        self.users = []
+        self.wallets = []
+        for x in range(1, 4):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.users.append(user)
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor = self.wallets
+        self.other_wallet = Wallet.objects.create(
+            profile=self.users[2].profile,
+            group=self.other_group,
+            status=Wallet.active,
+            withdrawable_bank=100
+        )
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        broadcast._broadcasters.clear()
+        batching._batchers.clear()
+        snapshots._snapshots.clear()
+        market._markets.clear()
+        registry._rooms.clear()
+        fanout._rooms.clear()
+        registry._subscribers.clear()
+        registry._changes.clear()
+        presence._rooms.clear()
+        presence._channel = None
+        presence._listener = None
+        chat._histories.clear()
+        chat._subscribers.clear()
+        chat._writer = None
+        ratelimit._users.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        # The sockets' reads may still be running in the database pool, so let them finish before the data is flushed
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_token_user(self):
+        token = issue_token(self.users[2], self.bettor, self.mbg.id)
+        scopes = []
+        middleware = TokenAuthMiddleware(scopes.append)
+
+        with self.assertNumQueries(0):
+            middleware({'type': 'websocket', 'query_string': ('seq=3&token=%s' % token).encode()})
+
+        user = scopes[0]['user']
+        self.assertIsInstance(user, TokenUser)
+        self.assertEqual((user.id, user.username), (self.users[2].id, 'testuser3'))
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(scopes[0]['token']['wallet'], self.bettor.id)
+        self.assertEqual(metrics.snapshot()['socket_token_auth'], 1)
+
+    def test_2_bad_tokens(self):
+        token = issue_token(self.users[2], self.bettor, self.mbg.id)
+        self.assertIsNone(read_token(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+        self.assertIsNone(read_token('not a token'))
+        with override_settings(WEBSOCKET_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(read_token(token))
+
+    def test_3_wallet_from_token(self):
+        token = read_token(issue_token(self.users[2], self.bettor, self.mbg.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(token_wallet_id(token, self.mbg), self.bettor.id)
+
+    def test_4_token_for_elsewhere(self):
+        other_match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        other_mbg = MatchBettingGroup.objects.get(match=other_match, group=self.group_object)
+
+        # Issued for another match, so the wallet is looked up as usual
+        token = read_token(issue_token(self.users[2], self.bettor, other_mbg.id))
+        self.assertIsNone(token_wallet_id(token, self.mbg))
+
+        # A wallet from another group can't be used on this group's match
+        token = read_token(issue_token(self.users[2], self.other_wallet, self.mbg.id))
+        self.assertIsNone(token_wallet_id(token, self.mbg))
+        self.assertIsNone(token_wallet_id(None, self.mbg))
+
+    def test_5_bet_with_token(self):
+        token = issue_token(self.users[2], self.bettor, self.mbg.id)
+
+        async def run():
+            communicator = WebsocketCommunicator(application, '/ws/%s/?seq=0&token=%s' % (self.mbg.id, token))
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertIn('welcome', await communicator.receive_json_from())
+
+            await communicator.send_json_to({
+                'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'
+            })
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['ack']['key'], 'bet-1')
+            # The pool is read for the update after the bet, so wait for it before the test's data goes
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['totals']['total_bet'], '12.50')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.get(match_betting_group=self.mbg).wallet_id, self.bettor.id)
+        self.assertEqual(Wallet.objects.get(id=self.bettor.id).bank, Decimal('87.50'))
+
+    def test_6_session_fallback(self):
+        self.client.force_login(self.users[2])
+        cookie = 'sessionid=%s' % self.client.cookies['sessionid'].value
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                application, '/ws/%s/?seq=0&token=expired' % self.mbg.id, headers=[(b'cookie', cookie.encode())]
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertIn('welcome', await communicator.receive_json_from())
+
+            await communicator.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': '5'})
+            response = await communicator.receive_json_from()
+            self.assertIn('ack', response)
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['totals']['total_bet'], '5.00')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.get(match_betting_group=self.mbg).wallet_id, self.bettor.id)
+        self.assertEqual(metrics.snapshot()['socket_session_auth'], 1)
+
+    def test_7_token_for_another_match(self):
+        other_match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        other_mbg = MatchBettingGroup.objects.get(match=other_match, group=self.group_object)
+        token = issue_token(self.users[2], self.bettor, other_mbg.id)
+
+        async def run():
+            communicator = WebsocketCommunicator(application, '/ws/%s/?seq=0&token=%s' % (self.mbg.id, token))
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertIn('welcome', await communicator.receive_json_from())
+
+            await communicator.send_json_to({
+                'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '5'
+            })
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['ack']['key'], 'bet-1')
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['totals']['total_bet'], '5.00')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.get(match_betting_group=self.mbg).wallet_id, self.bettor.id)
+
+    def test_8_wallet_closed_since_token(self):
+        token = issue_token(self.users[2], self.bettor, self.mbg.id)
+        Wallet.objects.filter(id=self.bettor.id).update(status=Wallet.deactivated)
+
+        async def run():
+            communicator = WebsocketCommunicator(application, '/ws/%s/?seq=0&token=%s' % (self.mbg.id, token))
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertIn('welcome', await communicator.receive_json_from())
+
+            await communicator.send_json_to({
+                'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '5'
+            })
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['reject']['code'], 'not_member')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
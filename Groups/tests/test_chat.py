@@ -0,0 +1,180 @@
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.db import OperationalError
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from asgiref.sync import async_to_sync
+from unittest import mock
+from Groups import metrics
+from Groups.chat import ChatWriter, RoomHistory
+from Groups.models import CommunityGroup, ChatMessage
+from Groups.tasks import purge_chat_history
+from Games.models import Tournament, Match
+from Profiles.models import Wallet
+from Bets.models import MatchBettingGroup
+import uuid
+User = get_user_model()
+
+
+@override_settings(CHAT_HISTORY_SIZE=3)
+class RoomHistoryTests(SimpleTestCase):
+    # Each room keeps its last few chat messages in memory
+    # ----
+    # Test 1: Test that only the newest CHAT_HISTORY_SIZE messages are kept
+    # Test 2: Test that a message heard twice is only kept once
+    # Test 3: Test that messages heard while the database was read go after the ones read
+
+    def test_1_ring(self):
+        history = RoomHistory()
+        for x in range(5):
+            history.record(str(x), 'text %s' % x)
+
+        self.assertEqual(history.since(None), ['text 2', 'text 3', 'text 4'])
+        self.assertEqual(history.since('3'), ['text 4'])
+        # A key that has dropped out of the history gets all of it
+        self.assertEqual(history.since('0'), ['text 2', 'text 3', 'text 4'])
+
+    def test_2_duplicates(self):
+        history = RoomHistory()
+        history.record('1', 'text 1')
+        history.record('1', 'text 1')
+
+        self.assertEqual(history.since(None), ['text 1'])
+
+    def test_3_load(self):
+        history = RoomHistory()
+        history.record('3', 'text 3')
+        history.load([('1', 'text 1'), ('2', 'text 2'), ('3', 'text 3')])
+
+        self.assertTrue(history.loaded)
+        self.assertEqual(history.since(None), ['text 1', 'text 2', 'text 3'])
+
+
+@override_settings(CHAT_RETENTION_DAYS=30, CHAT_PURGE_CHUNK_SIZE=10)
+class PurgeChatHistoryTests(TestCase):
+    # Chat older than CHAT_RETENTION_DAYS is deleted by a periodic task
+    # ----
+    # Test 1: Test that only messages past the retention period are deleted
+
+    def setUp(self):
+        group_object = CommunityGroup.objects.create(name="test_group_1")
+        wallets = []
+        for x in range(1, 3):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallets.append(Wallet.objects.create(profile=user.profile, group=group_object, status=Wallet.active))
+        tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=group_object,
+            start_datetime=timezone.now()
+        )
+        match = Match.objects.create(
+            user_a=wallets[0],
+            user_b=wallets[1],
+            tournament=tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=match, group=group_object)
+
+    def test_1_purge(self):
+        for days in (40, 31, 29, 1):
+            ChatMessage.objects.create(
+                match_betting_group=self.mbg,
+                username='testuser1',
+                message='%s days ago' % days,
+                key=uuid.uuid4(),
+                created=timezone.now() - timezone.timedelta(days=days)
+            )
+
+        purge_chat_history.apply()
+
+        self.assertEqual(
+            sorted(ChatMessage.objects.values_list('message', flat=True)),
+            ['1 days ago', '29 days ago']
+        )
+
+
+@override_settings(CHAT_FLUSH_SIZE=100, CHAT_FLUSH_INTERVAL=60, CHAT_PENDING_LIMIT=3)
+class ChatWriterTests(TransactionTestCase):
+    # Messages are saved in batches, and kept for the next batch only while the database can't be reached
+    # ----
+    # Test 1: Test that a message that can't be saved is dropped and the rest of its batch is saved
+    # Test 2: Test that a batch is kept for the next one while the database can't be reached
+    # Test 3: Test that no more than CHAT_PENDING_LIMIT messages are kept waiting, dropping the oldest
+
+    def setUp(self):
+        group_object = CommunityGroup.objects.create(name="test_group_1")
+        wallets = []
+        for x in range(1, 3):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallets.append(Wallet.objects.create(profile=user.profile, group=group_object, status=Wallet.active))
+        tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=group_object,
+            start_datetime=timezone.now()
+        )
+        match = Match.objects.create(
+            user_a=wallets[0],
+            user_b=wallets[1],
+            tournament=tournament,
+            start_datetime=timezone.now()
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=match, group=group_object)
+        metrics.reset()
+
+    def message(self, text, key=None):
+        return ChatMessage(
+            match_betting_group_id=self.mbg.id,
+            username='testuser1',
+            message=text,
+            key=key or uuid.uuid4(),
+            created=timezone.now()
+        )
+
+    def write(self, writer, messages, bulk_create=None):
+        async def run():
+            for message in messages:
+                writer.add(message)
+            if bulk_create is None:
+                await writer.flush()
+            else:
+                with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=bulk_create):
+                    await writer.flush()
+            if writer.timer is not None:
+                writer.timer.cancel()
+                writer.timer = None
+
+        async_to_sync(run)()
+
+    def test_1_bad_row_dropped(self):
+        key = uuid.uuid4()
+        ChatMessage.objects.create(
+            match_betting_group=self.mbg, username='testuser1', message='first', key=key, created=timezone.now()
+        )
+        writer = ChatWriter()
+
+        # Sent again with a key that's already saved
+        with self.assertLogs('Groups.chat', 'ERROR'):
+            self.write(writer, [self.message('before'), self.message('again', key), self.message('after')])
+
+        self.assertEqual(sorted(ChatMessage.objects.values_list('message', flat=True)), ['after', 'before', 'first'])
+        self.assertEqual(writer.pending, [])
+        self.assertEqual(metrics.snapshot()['chat_dropped'], 1)
+
+    def test_2_unreachable(self):
+        writer = ChatWriter()
+
+        self.write(writer, [self.message('one'), self.message('two')], bulk_create=OperationalError('gone away'))
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertEqual([message.message for message in writer.pending], ['one', 'two'])
+
+        self.write(writer, [self.message('three')])
+        self.assertEqual(sorted(ChatMessage.objects.values_list('message', flat=True)), ['one', 'three', 'two'])
+        self.assertEqual(writer.pending, [])
+
+    def test_3_pending_limit(self):
+        writer = ChatWriter()
+
+        self.write(writer, [self.message(str(x)) for x in range(2)], bulk_create=OperationalError('gone away'))
+        self.write(writer, [self.message(str(x)) for x in range(2, 5)], bulk_create=OperationalError('gone away'))
+
+        self.assertEqual([message.message for message in writer.pending], ['2', '3', '4'])
+        self.assertEqual(metrics.snapshot()['chat_dropped'], 2)
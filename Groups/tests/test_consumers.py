@@ -0,0 +1,1097 @@
+from django.test import TransactionTestCase, override_settings
+from django.db import OperationalError
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from decimal import Decimal
+from unittest import mock
+import asyncio
+import uuid
+from Groups.models import CommunityGroup
+from Groups.routing import websocket_urlpatterns
+from Groups import batching, broadcast, chat, database, fanout, metrics, moderation, presence, ratelimit, registry, snapshots
+from Groups.models import ChatMessage
+from Groups.room import room_group_name
+from channels.layers import get_channel_layer
+from Games.models import Tournament, Match
+from Profiles.models import Wallet
+from Bets import market
+from Bets.models import MatchBettingGroup, Bet
+from Bets.placement import place_bet
+User = get_user_model()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE=60
+)
+class DataConsumerTests(TransactionTestCase):
+    # The match page's websocket takes bets and chat messages and pushes changes to the pool out to everyone
+    # watching the match
+    # ----
+    # Test 1: Test that a bet is broadcast to the room as the pool totals and per-bettor pool
+    # Test 2: Test that a chat message is broadcast to the room
+    # Test 3: Test that a bet is refused once the match has started
+    # Test 4: Test that sockets already watching a match pick up changes made to it
+    # Test 5: Test that with batching on, bets placed together go out as one update and each sender gets an answer
+    # Test 6: Test that a burst of bets is sent to the room as the first bet straight away and then the latest pool
+    #       once per tick
+    # Test 7: Test that a page reconnecting with the latest version of the pool isn't sent it again
+    # Test 8: Test that pages reconnecting with an old version are sent the newest pool from a single read
+    # Test 9: Test that an update older than one already sent is dropped
+    # Test 10: Test that bets over the group's rate are turned away with an error before any database work
+    # Test 11: Test that a socket that keeps going over the rate is closed
+    # Test 12: Test that frames from pages loaded before frames had a type still work
+    # Test 13: Test that a bet sent again with the same key after reconnecting is acknowledged but only placed once
+    # Test 14: Test that a frame that isn't valid is answered with a reject rather than closing the socket
+    # Test 15: Test that sockets on the same match share one read of it, and one more once it's edited
+    # Test 16: Test that an update is delivered to the process once, however many of its sockets are in the room
+    # Test 17: Test that a group with betting stopped turns bets away without a time to retry and keeps the socket
+    # Test 18: Test that a member whose wallet isn't active can't bet
+    # Test 19: Test that every bet in a batch that fails to write is rejected, and the socket stays open
+    # Test 20: Test that a bet placed directly that fails to write is rejected, and the socket stays open
+    # Test 21: Test that a socket that can't be sent an update is dropped and the rest of the room still gets it
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.users = []
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.users.append(user)
+            self.wallets.append(wallet)
+
+        self.player_a, self.player_b, self.bettor_1, self.bettor_2 = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        # Ids are reused between tests, so don't let a room carry over from an earlier one
+        broadcast._broadcasters.clear()
+        batching._batchers.clear()
+        snapshots._snapshots.clear()
+        market._markets.clear()
+        registry._rooms.clear()
+        fanout._rooms.clear()
+        registry._subscribers.clear()
+        registry._changes.clear()
+        presence._rooms.clear()
+        presence._channel = None
+        presence._listener = None
+        chat._histories.clear()
+        chat._subscribers.clear()
+        chat._writer = None
+        ratelimit._users.clear()
+        metrics.reset()
+
+    async def connect(self, user, seq=0):
+        # Stands in for the auth middleware
+        def application(scope):
+            return URLRouter(websocket_urlpatterns)(dict(scope, user=user))
+
+        communicator = WebsocketCommunicator(application, '/ws/%s/?seq=%s' % (self.mbg.id, seq))
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        welcome = await communicator.receive_json_from()
+        self.assertIn('reconnect_after', welcome['welcome'])
+        return communicator
+
+    def tearDown(self):
+        # The sockets' reads may still be running in the database pool, so let them finish before the data is flushed
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_bet_broadcasts_pool(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+
+            await bettor.send_json_to({
+                'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'
+            })
+            self.assertEqual(await bettor.receive_json_from(), {
+                'ack': {'key': 'bet-1', 'amount': '12.50', 'team': 'testuser1', 'duplicate': False}
+            })
+
+            for communicator in (bettor, watcher):
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['totals']['total_bet'], '12.50')
+                self.assertEqual(response['totals']['side_a_total'], '12.50')
+                self.assertEqual(response['totals']['bettor_count'], 1)
+                self.assertEqual(response['pool'], [{
+                    'name': 'testuser3',
+                    'amount': '12.50',
+                    'percent': 100.0,
+                    'team': 'testuser1',
+                    'colour': '#' + self.users[2].profile.colour
+                }])
+
+            await bettor.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.get(match_betting_group=self.mbg).amount, Decimal('12.50'))
+
+    def test_2_chat_message(self):
+        async def run():
+            sender = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+
+            await sender.send_json_to({'type': 'chat', 'chat_message': 'good luck'})
+
+            for communicator in (sender, watcher):
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['message'], 'good luck')
+                self.assertEqual(response['chat_user'], 'testuser3')
+
+            await sender.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_3_betting_closed(self):
+        Match.objects.filter(id=self.match.id).update(start_datetime=timezone.now() - timezone.timedelta(minutes=1))
+
+        async def run():
+            bettor = await self.connect(self.users[2])
+
+            await bettor.send_json_to({
+                'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'
+            })
+            self.assertEqual(await bettor.receive_json_from(), {
+                'reject': {'key': 'bet-1', 'code': 'betting_closed', 'reason': 'Betting on this match has closed'}
+            })
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+    def test_4_match_edited(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+
+            self.match.start_datetime = timezone.now() - timezone.timedelta(minutes=1)
+            await sync_to_async(self.match.save)()
+            # Give the consumer a moment to hear about the change
+            await asyncio.sleep(0.1)
+
+            await bettor.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'})
+            response = await bettor.receive_json_from()
+            self.assertEqual(response['reject']['code'], 'betting_closed')
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+    @override_settings(BET_BATCH_WINDOW=0.05)
+    def test_5_batched_bets(self):
+        self.wallets[3].withdrawable_bank = 5
+        self.wallets[3].save()
+
+        async def run():
+            bettor_1 = await self.connect(self.users[2])
+            bettor_2 = await self.connect(self.users[3])
+
+            await bettor_1.send_json_to({
+                'type': 'bet', 'key': 'a', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'
+            })
+            await bettor_2.send_json_to({
+                'type': 'bet', 'key': 'b', 'chosenTeam': str(self.player_b.id), 'amountBid': '7.50'
+            })
+            await bettor_1.send_json_to({
+                'type': 'bet', 'key': 'c', 'chosenTeam': str(self.player_b.id), 'amountBid': '2.50'
+            })
+            # Sent again before the first one was answered
+            await bettor_1.send_json_to({
+                'type': 'bet', 'key': 'c', 'chosenTeam': str(self.player_b.id), 'amountBid': '2.50'
+            })
+
+            responses = [await bettor_1.receive_json_from() for x in range(4)]
+            self.assertEqual(responses[0], {'ack': {'key': 'a', 'amount': '12.50', 'team': 'testuser1', 'duplicate': False}})
+            self.assertEqual(responses[1], {'ack': {'key': 'c', 'amount': '2.50', 'team': 'testuser2', 'duplicate': False}})
+            self.assertEqual(responses[2], {'ack': {'key': 'c', 'amount': '2.50', 'team': 'testuser2', 'duplicate': True}})
+            responses = responses[1:]
+            self.assertEqual(responses[2]['totals']['bettor_count'], 1)
+            self.assertEqual(responses[2]['totals']['total_bet'], '15.00')
+
+            responses = [await bettor_2.receive_json_from() for x in range(2)]
+            self.assertEqual(responses[0], {'reject': {
+                'key': 'b', 'code': 'insufficient_funds', 'reason': 'User does not have the money to make this bet'
+            }})
+            self.assertEqual(responses[1]['totals']['total_bet'], '15.00')
+
+            self.assertTrue(await bettor_1.receive_nothing())
+            await bettor_1.disconnect()
+            await bettor_2.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 2)
+
+    @override_settings(BROADCAST_TICK=1)
+    def test_6_throttled_broadcasts(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+
+            for amount in ('10.00', '5.00', '2.50', '2.50'):
+                await bettor.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': amount})
+
+            # The first bet is sent straight away and the rest are merged into the update at the end of the tick.
+            # The tick is long enough for all four bets to be placed in it, and the wait for each update longer still
+            updates = [await watcher.receive_json_from(timeout=5)]
+            while updates[-1]['totals']['total_bet'] != '20.00':
+                updates.append(await watcher.receive_json_from(timeout=5))
+            self.assertLessEqual(len(updates), 2)
+            self.assertGreaterEqual(metrics.snapshot()['broadcasts_merged'], 2)
+
+            await bettor.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_7_resume_up_to_date(self):
+        place_bet(self.wallets[2].id, self.mbg, Decimal('10'), chosen_user=self.player_a)
+
+        async def run():
+            watcher = await self.connect(self.users[3], seq=1)
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_8_resume_behind(self):
+        place_bet(self.wallets[2].id, self.mbg, Decimal('10'), chosen_user=self.player_a)
+        place_bet(self.wallets[2].id, self.mbg, Decimal('5'), chosen_user=self.player_b)
+
+        async def run():
+            watchers = await asyncio.gather(*[self.connect(self.users[3], seq=1) for x in range(3)])
+            for watcher in watchers:
+                response = await watcher.receive_json_from()
+                self.assertEqual(response['seq'], 2)
+                self.assertEqual(response['totals']['total_bet'], '15.00')
+                await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['snapshot_reads'], 1)
+
+    def test_9_stale_update_dropped(self):
+        async def run():
+            watcher = await self.connect(self.users[3])
+            layer = get_channel_layer()
+            await layer.group_send(room_group_name(self.mbg.id), {
+                'type': 'send_update', 'seq': 2, 'text': '{"seq": 2}'
+            })
+            self.assertEqual(await watcher.receive_json_from(), {'seq': 2})
+
+            # Updates heard together are handed to the socket together, and only the newest of them is sent
+            for seq in (1, 3, 4):
+                await layer.group_send(room_group_name(self.mbg.id), {
+                    'type': 'send_update', 'seq': seq, 'text': '{"seq": %s}' % seq
+                })
+            self.assertEqual(await watcher.receive_json_from(), {'seq': 4})
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_10_rate_limited(self):
+        CommunityGroup.objects.filter(id=self.group_object.id).update(bet_rate=0.01, bet_burst=2)
+
+        async def run():
+            bettor = await self.connect(self.users[2])
+            for x in range(3):
+                await bettor.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'})
+
+            # The update for the bets that went through may come first
+            response = await bettor.receive_json_from()
+            while 'error' not in response:
+                response = await bettor.receive_json_from()
+            self.assertEqual(response['error']['code'], 'rate_limited')
+            self.assertEqual(response['error']['kind'], 'bet')
+            self.assertGreater(response['error']['retry_after'], 0)
+
+            # Chat has its own allowance
+            await bettor.send_json_to({'type': 'chat', 'chat_message': 'hello'})
+            while 'message' not in await bettor.receive_json_from():
+                pass
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 2)
+        self.assertEqual(metrics.snapshot()['rate_limited'], 1)
+
+    @override_settings(WEBSOCKET_MAX_VIOLATIONS=2)
+    def test_11_abusive_closed(self):
+        CommunityGroup.objects.filter(id=self.group_object.id).update(chat_rate=0.01, chat_burst=1)
+
+        async def run():
+            sender = await self.connect(self.users[2])
+            for x in range(4):
+                await sender.send_json_to({'type': 'chat', 'chat_message': 'spam'})
+
+            responses = []
+            while True:
+                response = await sender.receive_output()
+                if response['type'] == 'websocket.close':
+                    break
+                responses.append(response)
+            self.assertEqual(response['code'], 4029)
+            self.assertEqual(len(responses), 3)
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['rate_limit_closed'], 1)
+
+    def test_12_untyped_frames(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+            await bettor.send_json_to({'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'})
+            self.assertEqual(await bettor.receive_json_from(), {
+                'ack': {'key': None, 'amount': '12.50', 'team': 'testuser1', 'duplicate': False}
+            })
+            response = await bettor.receive_json_from()
+            self.assertEqual(response['totals']['total_bet'], '12.50')
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+    def test_13_retried_bet(self):
+        frame = {'type': 'bet', 'key': 'retry-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '12.50'}
+
+        async def run():
+            # The connection drops before the answer gets back to the page
+            bettor = await self.connect(self.users[2])
+            await bettor.send_json_to(frame)
+            await bettor.disconnect()
+
+            bettor = await self.connect(self.users[2])
+            await bettor.send_json_to(frame)
+            response = await bettor.receive_json_from()
+            while 'ack' not in response:
+                response = await bettor.receive_json_from()
+            self.assertEqual(response['ack'], {'key': 'retry-1', 'amount': '12.50', 'team': 'testuser1', 'duplicate': True})
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 1)
+        self.wallets[2].refresh_from_db()
+        self.assertEqual(self.wallets[2].withdrawable_bank, Decimal('87.50'))
+
+    def test_14_invalid_frames(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+            await bettor.send_json_to({'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': 'x'})
+            self.assertEqual(await bettor.receive_json_from(), {
+                'reject': {'key': 'bet-1', 'code': 'invalid', 'reason': 'Form is not valid'}
+            })
+            await bettor.send_json_to({'type': 'bet', 'key': 'not a key', 'chosenTeam': 'nobody', 'amountBid': '1'})
+            self.assertEqual((await bettor.receive_json_from())['reject']['key'], None)
+            await bettor.send_json_to({'type': 'bet', 'chosenTeam': 'nobody', 'amountBid': '1'})
+            self.assertEqual((await bettor.receive_json_from())['reject']['code'], 'invalid_team')
+            await bettor.send_json_to({'type': 'chat', 'chat_message': ''})
+            self.assertEqual((await bettor.receive_json_from())['reject']['code'], 'invalid')
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+    def test_15_shared_room(self):
+        async def run():
+            bettors = await asyncio.gather(*[self.connect(self.users[2]) for x in range(3)])
+            self.assertEqual(metrics.snapshot()['room_reads'], 1)
+
+            self.match.start_datetime = timezone.now() - timezone.timedelta(minutes=1)
+            await sync_to_async(self.match.save)()
+            await asyncio.sleep(0.1)
+
+            for bettor in bettors:
+                await bettor.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': '1'})
+                response = await bettor.receive_json_from()
+                self.assertEqual(response['reject']['code'], 'betting_closed')
+                await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['room_reads'], 2)
+        self.assertEqual(registry._rooms, {})
+
+    def test_16_shared_update(self):
+        async def run():
+            watchers = [await self.connect(self.users[3]) for x in range(3)]
+            await get_channel_layer().group_send(room_group_name(self.mbg.id), {
+                'type': 'send_update', 'seq': 5, 'text': '{"seq": 5}'
+            })
+            for watcher in watchers:
+                self.assertEqual(await watcher.receive_json_from(), {'seq': 5})
+                await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        # Three sockets used to be three deliveries through the channel layer, each one decoded separately
+        self.assertEqual(metrics.snapshot()['room_events'], 1)
+        self.assertEqual(metrics.snapshot()['room_deliveries'], 3)
+
+    def test_17_rate_of_zero(self):
+        CommunityGroup.objects.filter(id=self.group_object.id).update(bet_rate=0, bet_burst=0)
+
+        async def run():
+            bettor = await self.connect(self.users[2])
+            await bettor.send_json_to({'type': 'bet', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'})
+            self.assertEqual(await bettor.receive_json_from(), {
+                'error': {'code': 'rate_limited', 'kind': 'bet', 'retry_after': None}
+            })
+
+            await bettor.send_json_to({'type': 'chat', 'chat_message': 'hello'})
+            while 'message' not in await bettor.receive_json_from():
+                pass
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+    def test_18_inactive_wallet(self):
+        async def run():
+            for status in (Wallet.sent, Wallet.deactivated, Wallet.blocked_by_group):
+                await sync_to_async(Wallet.objects.filter(id=self.bettor_1.id).update)(status=status)
+
+                bettor = await self.connect(self.users[2])
+                await bettor.send_json_to({
+                    'type': 'bet', 'key': 'bet-1', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'
+                })
+                self.assertEqual((await bettor.receive_json_from())['reject']['code'], 'not_member')
+                await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(Bet.objects.filter(match_betting_group=self.mbg).exists())
+
+
+    @override_settings(BET_BATCH_WINDOW=0.05)
+    def test_19_batch_write_fails(self):
+        async def run():
+            bettor_1 = await self.connect(self.users[2])
+            bettor_2 = await self.connect(self.users[3])
+
+            with mock.patch.object(batching.BetBatcher, 'write', side_effect=OperationalError('gone away')):
+                await bettor_1.send_json_to({
+                    'type': 'bet', 'key': 'a', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'
+                })
+                await bettor_2.send_json_to({
+                    'type': 'bet', 'key': 'b', 'chosenTeam': str(self.player_b.id), 'amountBid': '1.00'
+                })
+                with self.assertLogs('Groups.consumers', 'ERROR'):
+                    for bettor, key in ((bettor_1, 'a'), (bettor_2, 'b')):
+                        self.assertEqual(await bettor.receive_json_from(), {'reject': {
+                            'key': key, 'code': 'server_error', 'reason': 'The bet could not be placed, please try again'
+                        }})
+
+            # The next bet goes through as normal
+            await bettor_1.send_json_to({'type': 'bet', 'key': 'c', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'})
+            self.assertEqual((await bettor_1.receive_json_from())['ack']['key'], 'c')
+            await bettor_1.disconnect()
+            await bettor_2.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 1)
+        self.assertEqual(metrics.snapshot()['bet_errors'], 2)
+
+
+    def test_20_write_fails(self):
+        async def run():
+            bettor = await self.connect(self.users[2])
+
+            with mock.patch('Groups.consumers.place_bet', side_effect=OperationalError('gone away')):
+                await bettor.send_json_to({
+                    'type': 'bet', 'key': 'a', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'
+                })
+                with self.assertLogs('Groups.consumers', 'ERROR'):
+                    self.assertEqual((await bettor.receive_json_from())['reject'], {
+                        'key': 'a', 'code': 'server_error', 'reason': 'The bet could not be placed, please try again'
+                    })
+
+            await bettor.send_json_to({'type': 'bet', 'key': 'b', 'chosenTeam': str(self.player_a.id), 'amountBid': '1.00'})
+            self.assertEqual((await bettor.receive_json_from())['ack']['key'], 'b')
+            await bettor.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(Bet.objects.filter(match_betting_group=self.mbg).count(), 1)
+
+
+    def test_21_delivery_fails(self):
+        async def run():
+            broken = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+            sockets = fanout._rooms[self.mbg.id].sockets
+            # Both have finished connecting once nothing is being held for them
+            while any(held is not None for held in sockets.values()):
+                await asyncio.sleep(0.01)
+            consumer = next(consumer for consumer in sockets if consumer.user == self.users[2])
+            layer = get_channel_layer()
+
+            with mock.patch.object(consumer, 'send_update', side_effect=RuntimeError('socket gone')):
+                with self.assertLogs('Groups.fanout', 'ERROR'):
+                    await layer.group_send(room_group_name(self.mbg.id), {
+                        'type': 'send_update', 'seq': 2, 'text': '{"seq": 2}'
+                    })
+                    self.assertEqual(await watcher.receive_json_from(), {'seq': 2})
+
+            self.assertNotIn(consumer, fanout._rooms[self.mbg.id].sockets)
+            await layer.group_send(room_group_name(self.mbg.id), {
+                'type': 'send_update', 'seq': 3, 'text': '{"seq": 3}'
+            })
+            self.assertEqual(await watcher.receive_json_from(), {'seq': 3})
+            await broken.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['room_delivery_errors'], 1)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class GroupConsumerTests(TransactionTestCase):
+    # The group page's websocket follows the pools of the match cards on the page
+    # ----
+    # Test 1: Test that subscribing sends each card's totals, and bets on the match are sent on to the card
+    # Test 2: Test that matches from other groups can't be subscribed to
+    # Test 3: Test that an unsubscribed card stops being sent updates
+    # Test 4: Test that someone outside the group can't connect
+    # Test 5: Test that a socket can only follow so many cards
+    # Test 6: Test that frames that can't be read are answered with a reject and the socket stays open
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+        self.other_group = CommunityGroup.objects.create(name="test_group_2")
+
+        self.users = []
+        self.wallets = []
+        for x in range(1, 4):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.users.append(user)
+            self.wallets.append(wallet)
+        self.outsider = User.objects.create(username='testuser4')
+
+        self.player_a, self.player_b, self.bettor = self.wallets
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.mbgs = []
+        for x in range(3):
+            match = Match.objects.create(
+                user_a=self.player_a,
+                user_b=self.player_b,
+                tournament=self.tournament,
+                start_datetime=timezone.now() + timezone.timedelta(hours=1)
+            )
+            self.mbgs.append(MatchBettingGroup.objects.get(match=match, group=self.group_object))
+
+        broadcast._broadcasters.clear()
+        market._markets.clear()
+        metrics.reset()
+
+    async def connect(self, user):
+        def application(scope):
+            return URLRouter(websocket_urlpatterns)(dict(scope, user=user))
+
+        return WebsocketCommunicator(application, '/ws/group/%s/' % self.group_object.id)
+
+    def tearDown(self):
+        # The sockets' reads may still be running in the database pool, so let them finish before the data is flushed
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_card_updates(self):
+        place_bet(self.bettor.id, self.mbgs[0], Decimal('10'), chosen_user=self.player_a)
+
+        async def run():
+            watcher = await self.connect(self.users[2])
+            connected, subprotocol = await watcher.connect()
+            self.assertTrue(connected)
+
+            await watcher.send_json_to({'type': 'subscribe', 'ids': [self.mbgs[0].id, self.mbgs[1].id]})
+            responses = [await watcher.receive_json_from() for x in range(2)]
+            self.assertEqual(responses[0], {'card': {
+                'id': self.mbgs[0].id,
+                'seq': 1,
+                'total_bet': '10.00',
+                'side_a_total': '10.00',
+                'side_b_total': '0.00',
+                'bettor_count': 1
+            }})
+            self.assertEqual(responses[1]['card']['id'], self.mbgs[1].id)
+            self.assertEqual(responses[1]['card']['total_bet'], '0.00')
+
+            await sync_to_async(place_bet)(self.bettor.id, self.mbgs[1], Decimal('5'), chosen_user=self.player_b)
+            broadcast.pool_changed(self.mbgs[1].id)
+            response = await watcher.receive_json_from()
+            self.assertEqual(response['card']['id'], self.mbgs[1].id)
+            self.assertEqual(response['card']['side_b_total'], '5.00')
+            self.assertEqual(response['card']['seq'], 1)
+
+            # Bets on a card that isn't on the page aren't sent
+            await sync_to_async(place_bet)(self.bettor.id, self.mbgs[2], Decimal('5'), chosen_user=self.player_b)
+            broadcast.pool_changed(self.mbgs[2].id)
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_2_other_group(self):
+        other_tournament = Tournament.objects.create(
+            name="tournament_2",
+            owning_group=self.other_group,
+            start_datetime=timezone.now()
+        )
+        match = Match.objects.create(
+            user_a=self.player_a,
+            user_b=self.player_b,
+            tournament=other_tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        other_mbg = MatchBettingGroup.objects.get(match=match, group=self.other_group)
+
+        async def run():
+            watcher = await self.connect(self.users[2])
+            await watcher.connect()
+            await watcher.send_json_to({'type': 'subscribe', 'ids': [other_mbg.id]})
+            self.assertTrue(await watcher.receive_nothing())
+
+            broadcast.pool_changed(other_mbg.id)
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_3_unsubscribe(self):
+        async def run():
+            watcher = await self.connect(self.users[2])
+            await watcher.connect()
+            await watcher.send_json_to({'type': 'subscribe', 'ids': [self.mbgs[0].id]})
+            await watcher.receive_json_from()
+            await watcher.send_json_to({'type': 'unsubscribe', 'ids': [self.mbgs[0].id]})
+
+            await sync_to_async(place_bet)(self.bettor.id, self.mbgs[0], Decimal('5'), chosen_user=self.player_b)
+            broadcast.pool_changed(self.mbgs[0].id)
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_4_not_a_member(self):
+        async def run():
+            outsider = await self.connect(self.outsider)
+            connected, subprotocol = await outsider.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(run)()
+
+    @override_settings(WEBSOCKET_MAX_CARDS=2)
+    def test_5_card_limit(self):
+        async def run():
+            watcher = await self.connect(self.users[2])
+            await watcher.connect()
+            await watcher.send_json_to({'type': 'subscribe', 'ids': [mbg.id for mbg in self.mbgs]})
+            responses = [await watcher.receive_json_from() for x in range(2)]
+            self.assertEqual(
+                [response['card']['id'] for response in responses],
+                [self.mbgs[0].id, self.mbgs[1].id]
+            )
+            self.assertTrue(await watcher.receive_nothing())
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_6_invalid_frames(self):
+        async def run():
+            watcher = await self.connect(self.users[2])
+            await watcher.connect()
+            for frame in (
+                {'type': 'subscribe', 'ids': 'not a list'},
+                {'type': 'unsubscribe'},
+                {'type': 'something else'}
+            ):
+                await watcher.send_json_to(frame)
+                self.assertEqual(await watcher.receive_json_from(), {
+                    'reject': {'code': 'invalid', 'reason': 'Form is not valid'}
+                })
+
+            await watcher.send_json_to({'type': 'subscribe', 'ids': [self.mbgs[0].id]})
+            response = await watcher.receive_json_from()
+            self.assertEqual(response['card']['id'], self.mbgs[0].id)
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE=0.1,
+    PRESENCE_HEARTBEAT=0.1,
+    PRESENCE_EXPIRY=0.3
+)
+class PresenceTests(TransactionTestCase):
+    # Each match room keeps count of who is watching it, across every process serving its sockets
+    # ----
+    # Test 1: Test that people joining together are sent one count
+    # Test 2: Test that someone with the match open twice is counted once
+    # Test 3: Test that people leaving are taken off the count
+    # Test 4: Test that people watching through another process are counted until it stops being heard from
+    # Test 5: Test that a process whose room empties and fills again is still heard by the others
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.users = []
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.users.append(user)
+            self.wallets.append(wallet)
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.wallets[0],
+            user_b=self.wallets[1],
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        presence._rooms.clear()
+        presence._channel = None
+        presence._listener = None
+        snapshots._snapshots.clear()
+        market._markets.clear()
+        registry._rooms.clear()
+        fanout._rooms.clear()
+        registry._subscribers.clear()
+        registry._changes.clear()
+        metrics.reset()
+
+    async def connect(self, user):
+        def application(scope):
+            return URLRouter(websocket_urlpatterns)(dict(scope, user=user))
+
+        communicator = WebsocketCommunicator(application, '/ws/%s/' % self.mbg.id)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        return communicator
+
+    def tearDown(self):
+        # The sockets' reads may still be running in the database pool, so let them finish before the data is flushed
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_debounced(self):
+        async def run():
+            watchers = [await self.connect(user) for user in self.users[2:]]
+            for watcher in watchers:
+                self.assertEqual(await watcher.receive_json_from(), {'viewers': {'count': 2}})
+                self.assertTrue(await watcher.receive_nothing(timeout=0.3))
+            for watcher in watchers:
+                await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['presence_merged'], 1)
+
+    def test_2_same_user(self):
+        async def run():
+            watchers = [await self.connect(self.users[2]) for x in range(2)]
+            self.assertEqual(await watchers[0].receive_json_from(), {'viewers': {'count': 1}})
+            for watcher in watchers:
+                await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_3_leave(self):
+        async def run():
+            staying = await self.connect(self.users[2])
+            leaving = await self.connect(self.users[3])
+            self.assertEqual(await staying.receive_json_from(), {'viewers': {'count': 2}})
+
+            await leaving.disconnect()
+            self.assertEqual(await staying.receive_json_from(), {'viewers': {'count': 1}})
+            await staying.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(presence._rooms, {})
+
+    def test_4_other_process(self):
+        async def run():
+            watcher = await self.connect(self.users[2])
+            self.assertEqual(await watcher.receive_json_from(), {'viewers': {'count': 1}})
+
+            # Another process has one person in the room who is also watching here, and one more
+            await get_channel_layer().group_send(presence.presence_group_name(self.mbg.id), {
+                'type': 'presence_heard',
+                'betting_group_id': self.mbg.id,
+                'process': 'other',
+                'version': 1,
+                'members': [self.users[2].id, self.users[3].id],
+                'anonymous': 0
+            })
+            self.assertEqual(await watcher.receive_json_from(), {'viewers': {'count': 2}})
+
+            # It stops being heard from
+            self.assertEqual(await watcher.receive_json_from(timeout=1), {'viewers': {'count': 1}})
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['presence_expired'], 1)
+
+    def test_5_rejoin(self):
+        async def run():
+            layer = get_channel_layer()
+            # Listen in on what this process tells the others
+            listener = await layer.new_channel()
+            await layer.group_add(presence.presence_group_name(self.mbg.id), listener)
+
+            async def announced(members):
+                while True:
+                    event = await layer.receive(listener)
+                    if event['members'] == members:
+                        return event
+
+            watcher = await self.connect(self.users[2])
+            joined = await announced([self.users[2].id])
+            await watcher.disconnect()
+            left = await announced([])
+            # The room is built again from scratch
+            watcher = await self.connect(self.users[2])
+            rejoined = await announced([self.users[2].id])
+            await watcher.disconnect()
+            self.assertGreater(rejoined['version'], left['version'])
+
+            # Another process hearing the same leave and rejoin still counts the person who came back
+            other = await self.connect(self.users[3])
+            self.assertEqual(await other.receive_json_from(), {'viewers': {'count': 1}})
+            for event, count in ((joined, 2), (left, 1), (rejoined, 2)):
+                await layer.group_send(presence.presence_group_name(self.mbg.id), dict(event, process='other'))
+                self.assertEqual(await other.receive_json_from(), {'viewers': {'count': count}})
+            await other.disconnect()
+
+        async_to_sync(run)()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE=60,
+    CHAT_FLUSH_SIZE=3,
+    CHAT_FLUSH_INTERVAL=0.1,
+    CHAT_HISTORY_SIZE=3
+)
+class ChatHistoryTests(TransactionTestCase):
+    # Chat is saved in batches, and pages joining a room are sent the recent messages
+    # ----
+    # Test 1: Test that messages are saved in batches of CHAT_FLUSH_SIZE, or after CHAT_FLUSH_INTERVAL
+    # Test 2: Test that a page joining is sent the messages already sent to the room without reading the database
+    # Test 3: Test that the first page joining a room here is sent the newest messages from the database
+    # Test 4: Test that a page reconnecting is only sent the messages after the last one it saw
+    # Test 5: Test that a message the group's filter blocks is only answered with a rejection, and isn't kept
+
+    def setUp(self):
+        self.group_object = CommunityGroup.objects.create(name="test_group_1")
+
+        self.users = []
+        self.wallets = []
+        for x in range(1, 5):
+            user = User.objects.create(username='testuser{0}'.format(x))
+            wallet = Wallet.objects.create(
+                profile=user.profile,
+                group=self.group_object,
+                status=Wallet.active,
+                withdrawable_bank=100
+            )
+            self.users.append(user)
+            self.wallets.append(wallet)
+
+        self.tournament = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now()
+        )
+        self.match = Match.objects.create(
+            user_a=self.wallets[0],
+            user_b=self.wallets[1],
+            tournament=self.tournament,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        self.mbg = MatchBettingGroup.objects.get(match=self.match, group=self.group_object)
+
+        presence._rooms.clear()
+        presence._channel = None
+        presence._listener = None
+        snapshots._snapshots.clear()
+        market._markets.clear()
+        registry._rooms.clear()
+        fanout._rooms.clear()
+        registry._subscribers.clear()
+        registry._changes.clear()
+        chat._histories.clear()
+        chat._subscribers.clear()
+        chat._writer = None
+        ratelimit._users.clear()
+        moderation._filters.clear()
+        metrics.reset()
+
+    async def connect(self, user, query=''):
+        def application(scope):
+            return URLRouter(websocket_urlpatterns)(dict(scope, user=user))
+
+        communicator = WebsocketCommunicator(application, '/ws/%s/?%s' % (self.mbg.id, query))
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        return communicator
+
+    async def receive_chat(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing():
+            messages.append((await communicator.receive_json_from())['message'])
+        return messages
+
+    def tearDown(self):
+        # The sockets' reads may still be running in the database pool, so let them finish before the data is flushed
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_batched_writes(self):
+        async def run():
+            sender = await self.connect(self.users[2])
+            for x in range(4):
+                await sender.send_json_to({'type': 'chat', 'chat_message': 'message %s' % x})
+            self.assertEqual(len(await self.receive_chat(sender)), 4)
+            await asyncio.sleep(0.2)
+            await sender.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('created').values_list('message', 'username')),
+            [('message %s' % x, 'testuser3') for x in range(4)]
+        )
+        self.assertEqual(metrics.snapshot()['chat_batch_size']['count'], 2)
+
+    def test_2_replay_from_memory(self):
+        async def run():
+            sender = await self.connect(self.users[2])
+            for x in range(4):
+                await sender.send_json_to({'type': 'chat', 'chat_message': 'message %s' % x})
+            await self.receive_chat(sender)
+
+            joiner = await self.connect(self.users[3])
+            self.assertEqual(await self.receive_chat(joiner), ['message 1', 'message 2', 'message 3'])
+            await sender.disconnect()
+            await joiner.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertEqual(metrics.snapshot()['chat_history_reads'], 1)
+        self.assertEqual(metrics.snapshot()['chat_history_hits'], 1)
+
+    def test_3_replay_from_database(self):
+        for x in range(4):
+            ChatMessage.objects.create(
+                match_betting_group=self.mbg,
+                user=self.users[2],
+                username='testuser3',
+                message='message %s' % x,
+                key=uuid.uuid4(),
+                created=timezone.now() + timezone.timedelta(seconds=x)
+            )
+
+        async def run():
+            joiner = await self.connect(self.users[3])
+            self.assertEqual(await self.receive_chat(joiner), ['message 1', 'message 2', 'message 3'])
+            await joiner.disconnect()
+
+        async_to_sync(run)()
+
+    def test_4_reconnect(self):
+        async def run():
+            sender = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+            await sender.send_json_to({'type': 'chat', 'chat_message': 'seen'})
+            seen = await watcher.receive_json_from()
+            await watcher.disconnect()
+
+            await sender.send_json_to({'type': 'chat', 'chat_message': 'missed'})
+            watcher = await self.connect(self.users[3], 'chat=%s' % seen['id'])
+            self.assertEqual(await self.receive_chat(watcher), ['missed'])
+            await sender.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+    def test_5_blocked(self):
+        self.group_object.chat_banned_words = 'rude'
+        self.group_object.save()
+
+        async def run():
+            sender = await self.connect(self.users[2])
+            watcher = await self.connect(self.users[3])
+            await sender.send_json_to({'type': 'chat', 'chat_message': 'R U D E'})
+            self.assertEqual(await sender.receive_json_from(), {
+                'reject': {'code': 'blocked', 'reason': "That message isn't allowed in this group"}
+            })
+            self.assertTrue(await watcher.receive_nothing(timeout=0.2))
+            await sender.disconnect()
+            await watcher.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertEqual(metrics.snapshot()['chat_blocked'], 1)
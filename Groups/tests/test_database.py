@@ -0,0 +1,72 @@
+from django.test import TransactionTestCase, override_settings
+from django.contrib.auth import get_user_model
+from asgiref.sync import async_to_sync
+from Groups import database, metrics
+from Groups.models import CommunityGroup
+import asyncio
+import threading
+import time
+User = get_user_model()
+
+
+@override_settings(WEBSOCKET_DB_WORKERS=2)
+class RunInDbTests(TransactionTestCase):
+    # Database work from the websocket consumers is run in a bounded pool of threads so it never blocks the event
+    # loop
+    # ----
+    # Test 1: Test that the result of the query is returned
+    # Test 2: Test that the work runs off the event loop's thread
+    # Test 3: Test that no more than the configured number of jobs run at once
+    # Test 4: Test that the time spent waiting for a thread is recorded
+
+    def setUp(self):
+        database._executor = None
+        metrics.reset()
+        CommunityGroup.objects.create(name="test_group_1")
+
+    def tearDown(self):
+        database.get_executor().shutdown()
+        database._executor = None
+
+    def test_1_returns_result(self):
+        async def run():
+            return await database.run_in_db(CommunityGroup.objects.values_list('name', flat=True).get)
+
+        self.assertEqual(async_to_sync(run)(), 'test_group_1')
+
+    def test_2_runs_off_the_loop(self):
+        async def run():
+            return threading.get_ident(), await database.run_in_db(threading.get_ident)
+
+        loop_thread, db_thread = async_to_sync(run)()
+        self.assertNotEqual(loop_thread, db_thread)
+
+    def test_3_bounded(self):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def job():
+            with lock:
+                running.append(1)
+                most.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        async def run():
+            await asyncio.gather(*[database.run_in_db(job) for x in range(6)])
+
+        async_to_sync(run)()
+        self.assertEqual(max(most), 2)
+
+    def test_4_queue_wait_recorded(self):
+        async def run():
+            await asyncio.gather(*[database.run_in_db(time.sleep, 0.02) for x in range(4)])
+
+        async_to_sync(run)()
+
+        queue_wait = metrics.snapshot()['db_queue_wait']
+        self.assertEqual(queue_wait['count'], 4)
+        # Two of the jobs had to wait for the first two to finish
+        self.assertGreaterEqual(queue_wait['max'], 0.015)
@@ -0,0 +1,49 @@
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from decimal import Decimal
+from unittest import skipIf
+from Groups.messages import encode, compact_dumps, orjson_dumps
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def upper_dumps(payload):
+    return json.dumps(payload).upper()
+
+
+class EncodeTests(SimpleTestCase):
+    # Websocket payloads are built as plain structures and turned into text once, by whichever encoder is set in
+    # WEBSOCKET_JSON_ENCODER
+    # ----
+    # Test 1: Test that Decimals and datetimes are encoded
+    # Test 2: Test that orjson gives the same result as the standard library encoder
+    # Test 3: Test that the encoder can be swapped in the settings
+
+    def setUp(self):
+        self.payload = {
+            'amount': Decimal('12.50'),
+            'created': timezone.datetime(2019, 5, 1, 12, 30, tzinfo=timezone.utc),
+            'bettor_count': 3
+        }
+
+    def test_1_decimal_and_datetime(self):
+        self.assertEqual(json.loads(compact_dumps(self.payload)), {
+            'amount': '12.50',
+            'created': '2019-05-01T12:30:00Z',
+            'bettor_count': 3
+        })
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_2_orjson_matches(self):
+        payload = dict(self.payload)
+        del payload['created']
+
+        self.assertEqual(json.loads(orjson_dumps(payload)), json.loads(compact_dumps(payload)))
+
+    @override_settings(WEBSOCKET_JSON_ENCODER='Groups.tests.test_messages.upper_dumps')
+    def test_3_pluggable_encoder(self):
+        self.assertEqual(encode({'chat_user': 'testuser1'}), '{"CHAT_USER": "TESTUSER1"}')
@@ -0,0 +1,126 @@
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from asgiref.sync import async_to_sync
+from Groups.models import CommunityGroup
+from Groups.moderation import ChatFilter, WordMatcher, normalise, get_filter
+from Groups import moderation
+import time
+
+
+class NormaliseTests(SimpleTestCase):
+    # Messages and banned words are put in the same plain form before they are compared
+    # ----
+    # Test 1: Test that case, accents and spacing are evened out
+    # Test 2: Test that digits and symbols standing in for letters are read as letters
+    # Test 3: Test that punctuation between letters, held down letters and spelt out words are undone
+    # Test 4: Test that ordinary punctuation and single letter words are left alone
+
+    def test_1_case_and_accents(self):
+        self.assertEqual(normalise('  Héllo   WORLD '), ' hello world ')
+
+    def test_2_lookalikes(self):
+        self.assertEqual(normalise('h3ll0 w0r1d'), ' hello worid ')
+        self.assertEqual(normalise('@ss $hit'), ' ass shit ')
+
+    def test_3_obfuscation(self):
+        self.assertEqual(normalise('b.a.d'), ' bad ')
+        self.assertEqual(normalise('baaaaad'), ' bad ')
+        self.assertEqual(normalise('b a d word'), ' bad word ')
+        # Held down letters can be read as one or as two
+        self.assertEqual(normalise('noooob'), ' nob ')
+        self.assertEqual(normalise('noooob', held_down=r'\1\1'), ' noob ')
+
+    def test_4_ordinary_text(self):
+        self.assertEqual(normalise('Good game, well played!'), ' good game well played ')
+        self.assertEqual(normalise('I am a fan'), ' i am a fan ')
+
+
+class WordMatcherTests(SimpleTestCase):
+    # Banned words are found with one pass over the message
+    # ----
+    # Test 1: Test that whole words and phrases are found anywhere in a message
+    # Test 2: Test that words inside other words aren't
+    # Test 3: Test that words sharing a start or end with others are all found
+    # Test 4: Test that an empty list finds nothing
+
+    def test_1_words_and_phrases(self):
+        matcher = WordMatcher(['bad', 'very rude'])
+
+        self.assertTrue(matcher.search(normalise('this is bad')))
+        self.assertTrue(matcher.search(normalise('Bad start')))
+        self.assertTrue(matcher.search(normalise('that was VERY rude of you')))
+        self.assertFalse(matcher.search(normalise('very nice')))
+
+    def test_2_inside_other_words(self):
+        matcher = WordMatcher(['ass'])
+
+        self.assertFalse(matcher.search(normalise('a classic pass')))
+        self.assertTrue(matcher.search(normalise('what an ass')))
+
+    def test_3_overlapping(self):
+        words = ['he', 'she', 'his', 'hers', 'shells']
+        matcher = WordMatcher(words)
+
+        for word in words:
+            self.assertTrue(matcher.search(normalise('well %s then' % word)), word)
+        self.assertFalse(matcher.search(normalise('hershe shell ushers')))
+
+    def test_4_empty(self):
+        self.assertFalse(WordMatcher(['', '  ']).search(normalise('anything at all')))
+
+
+class ChatFilterTests(TransactionTestCase):
+    # Each group has its own filter, loaded again when the group's list changes
+    # ----
+    # Test 1: Test that links are only blocked when the group asks for it
+    # Test 2: Test that a change to the list is picked up once CHAT_FILTER_RELOAD has passed, and only then compiled
+    # Test 3: Test that words with a double letter are caught however long it is held down
+    # Test 4: Test that ordinary words with one letter fewer or one more than a banned word are let through
+
+    def setUp(self):
+        moderation._filters.clear()
+        self.group_object = CommunityGroup.objects.create(name="test_group_1", chat_banned_words="bad\nvery rude")
+
+    def test_1_links(self):
+        message = 'have a look at https://example.com'
+
+        self.assertFalse(ChatFilter('', [], False).blocks(message))
+        self.assertTrue(ChatFilter('', [], True).blocks(message))
+        self.assertTrue(ChatFilter('', [], True).blocks('go to www.example.org'))
+
+    @override_settings(CHAT_FILTER_RELOAD=60)
+    def test_2_reload(self):
+        chat_filter = async_to_sync(get_filter)(self.group_object.id)
+        self.assertTrue(chat_filter.blocks('b.a.d'))
+        self.assertFalse(chat_filter.blocks('ugly'))
+
+        self.group_object.chat_banned_words = "ugly"
+        self.group_object.save()
+
+        # Not looked at again until the reload time has passed
+        self.assertIs(async_to_sync(get_filter)(self.group_object.id), chat_filter)
+
+        chat_filter.checked_at = time.monotonic() - 61
+        reloaded = async_to_sync(get_filter)(self.group_object.id)
+        self.assertTrue(reloaded.blocks('UGLY'))
+        self.assertFalse(reloaded.blocks('bad'))
+
+        # Nothing has changed this time, so the same filter is kept
+        reloaded.checked_at = time.monotonic() - 61
+        self.assertIs(async_to_sync(get_filter)(self.group_object.id), reloaded)
+
+    def test_3_held_down(self):
+        chat_filter = ChatFilter('', ['ass', 'noob', 'bad'], False)
+
+        self.assertTrue(chat_filter.blocks('asssss'))
+        self.assertTrue(chat_filter.blocks('what a NOOOOOB'))
+        self.assertTrue(chat_filter.blocks('baaaaad'))
+        self.assertTrue(chat_filter.blocks('@$$$'))
+
+    def test_4_double_letters(self):
+        chat_filter = ChatFilter('', ['ass', 'butt', 'boob', 'god'], False)
+
+        self.assertFalse(chat_filter.blocks('as soon as I can'))
+        self.assertFalse(chat_filter.blocks('but why'))
+        self.assertFalse(chat_filter.blocks('hi bob'))
+        self.assertFalse(chat_filter.blocks('Good game, well played!'))
+        self.assertFalse(chat_filter.blocks('sooo good'))
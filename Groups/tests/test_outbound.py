@@ -0,0 +1,105 @@
+from django.test import SimpleTestCase, override_settings
+from asgiref.sync import async_to_sync
+from Groups.outbound import Outbound
+from Groups import metrics
+import asyncio
+
+
+class SlowSocket:
+    # Stands in for a client that only takes a message when the test lets it
+
+    def __init__(self):
+        self.sent = []
+        self.open = asyncio.Event()
+
+    async def send(self, text_data):
+        await self.open.wait()
+        self.sent.append(text_data)
+
+
+@override_settings(WEBSOCKET_MAX_QUEUE=5, WEBSOCKET_MAX_LAG=10)
+class OutboundTests(SimpleTestCase):
+    # Each socket has its own queue of messages waiting to go out, so a slow client only holds itself up
+    # ----
+    # Test 1: Test that a newer pool update replaces one that hasn't been sent yet
+    # Test 2: Test that chat messages are all sent, in order, around the pool update
+    # Test 3: Test that a socket too far behind is reported
+    # Test 4: Test that the queue depth and replaced updates are counted
+    # Test 5: Test that updates for different pools each keep their own place in the queue
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_1_latest_state_wins(self):
+        async def run():
+            socket = SlowSocket()
+            outbound = Outbound(socket.send)
+            for x in range(3):
+                outbound.put_state('state %s' % x)
+            socket.open.set()
+            await asyncio.sleep(0.01)
+            outbound.close()
+            return socket.sent
+
+        self.assertEqual(async_to_sync(run)(), ['state 2'])
+
+    def test_2_chat_in_order(self):
+        async def run():
+            socket = SlowSocket()
+            outbound = Outbound(socket.send)
+            outbound.put('chat 1')
+            outbound.put_state('state 1')
+            outbound.put('chat 2')
+            outbound.put_state('state 2')
+            outbound.put('chat 3')
+            socket.open.set()
+            await asyncio.sleep(0.01)
+            outbound.close()
+            return socket.sent
+
+        self.assertEqual(async_to_sync(run)(), ['chat 1', 'state 2', 'chat 2', 'chat 3'])
+
+    def test_3_behind(self):
+        async def run():
+            socket = SlowSocket()
+            outbound = Outbound(socket.send)
+            results = []
+            for x in range(7):
+                outbound.put('chat %s' % x)
+                results.append(outbound.behind())
+            outbound.close()
+            return results
+
+        self.assertEqual(async_to_sync(run)(), [False] * 5 + [True, True])
+
+    def test_4_metrics(self):
+        async def run():
+            socket = SlowSocket()
+            outbound = Outbound(socket.send)
+            outbound.put_state('state 1')
+            outbound.put_state('state 2')
+            outbound.put('chat 1')
+            outbound.close()
+
+        async_to_sync(run)()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['outbound_state_replaced'], 1)
+        self.assertEqual(snapshot['outbound_queue_depth']['max'], 2)
+        self.assertEqual(snapshot['outbound_dropped'], 2)
+
+    def test_5_state_by_key(self):
+        async def run():
+            socket = SlowSocket()
+            outbound = Outbound(socket.send)
+            outbound.put_state('card 1 state 1', key=1)
+            outbound.put_state('card 2 state 1', key=2)
+            outbound.put_state('card 1 state 2', key=1)
+            socket.open.set()
+            await asyncio.sleep(0.01)
+            outbound.put_state('card 2 state 2', key=2)
+            await asyncio.sleep(0.01)
+            outbound.close()
+            return socket.sent
+
+        self.assertEqual(async_to_sync(run)(), ['card 1 state 2', 'card 2 state 1', 'card 2 state 2'])
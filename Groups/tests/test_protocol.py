@@ -0,0 +1,74 @@
+from django.test import SimpleTestCase
+from django import forms
+from decimal import Decimal
+from Groups import protocol
+from Groups.forms import BetForm, ChatForm
+
+
+class ProtocolTests(SimpleTestCase):
+    # Frames from the pages are checked against small schemas rather than Django forms, with the same results
+    # ----
+    # Test 1: Test that bets are cleaned the same as by BetForm
+    # Test 2: Test that chat messages are cleaned the same as by ChatForm
+    # Test 3: Test that lists of ids are checked
+    # Test 4: Test that frames are told apart by their type, or by their keys if they have none
+    # Test 5: Test that a bet's idempotency key is optional, and checked when it's there
+
+    def assertSameAsForm(self, form_class, form_data, schema, frame):
+        form = form_class(form_data)
+        if form.is_valid():
+            # The forms never had the bet's idempotency key
+            cleaned_data = schema.clean(frame)
+            cleaned_data.pop('key', None)
+            self.assertEqual(cleaned_data, form.cleaned_data, frame)
+        else:
+            with self.assertRaisesMessage(forms.ValidationError, 'Form is not valid'):
+                schema.clean(frame)
+
+    def test_1_bet(self):
+        amounts = [
+            '12.50', 12.5, 12, '0.01', '0.001', '0', '-1', '99999.99', '100000', '1e2', '1E-2', 'NaN', 'Infinity',
+            '', '  3.10  ', 'abc', None, True, [], '00012.50'
+        ]
+        teams = ['team a', '  team a ', '', '   ', 'x' * 200, 'x' * 201, 5, None]
+        for amount in amounts:
+            self.assertSameAsForm(
+                BetForm, {'chosen_team': 'team a', 'amount': amount},
+                protocol.bet, {'type': 'bet', 'chosenTeam': 'team a', 'amountBid': amount}
+            )
+        for team in teams:
+            self.assertSameAsForm(
+                BetForm, {'chosen_team': team, 'amount': '1'},
+                protocol.bet, {'type': 'bet', 'chosenTeam': team, 'amountBid': '1'}
+            )
+
+        self.assertEqual(protocol.bet.clean({'chosenTeam': 'a', 'amountBid': '1.5'})['amount'], Decimal('1.5'))
+
+    def test_2_chat(self):
+        for message in ['hello', '  hello  ', '', ' ', 'x' * 1024, 'x' * 1025, 42, None]:
+            self.assertSameAsForm(
+                ChatForm, {'chat_message': message},
+                protocol.chat, {'type': 'chat', 'chat_message': message}
+            )
+
+    def test_3_ids(self):
+        self.assertEqual(protocol.cards.clean({'ids': [1, 2]}), {'ids': [1, 2]})
+        for ids in ([1, '2'], [True], 'abc', None, list(range(1001))):
+            with self.assertRaisesMessage(forms.ValidationError, 'Form is not valid'):
+                protocol.cards.clean({'ids': ids})
+
+    def test_4_message_type(self):
+        self.assertEqual(protocol.message_type({'type': 'chat', 'amountBid': '1'}), 'chat')
+        self.assertEqual(protocol.message_type({'chosenTeam': 'a', 'amountBid': '1'}), 'bet')
+        self.assertEqual(protocol.message_type({'chat_message': 'hi'}), 'chat')
+        self.assertIsNone(protocol.message_type({'something': 'else'}))
+        self.assertIsNone(protocol.message_type(['chat_message']))
+
+    def test_5_bet_key(self):
+        frame = {'type': 'bet', 'chosenTeam': 'a', 'amountBid': '1'}
+        self.assertIsNone(protocol.bet.clean(frame)['key'])
+        self.assertEqual(protocol.bet.clean(dict(frame, key='3f2a-9c_1'))['key'], '3f2a-9c_1')
+        for key in ('', 'has space', 'x' * 65, 5, ['a']):
+            with self.assertRaisesMessage(forms.ValidationError, 'Form is not valid'):
+                protocol.bet.clean(dict(frame, key=key))
+            self.assertIsNone(protocol.bet_key(dict(frame, key=key)))
@@ -0,0 +1,101 @@
+from django.test import SimpleTestCase, override_settings
+from django.core.exceptions import ValidationError
+from django.contrib.auth.models import AnonymousUser
+from unittest import mock
+from Groups.models import CommunityGroup
+from Groups.ratelimit import TokenBucket, Limiter
+from Groups import ratelimit
+
+
+class FakeUser:
+    is_authenticated = True
+
+    def __init__(self, id):
+        self.id = id
+
+
+class Clock:
+    # Stands in for time.monotonic so the tests don't have to wait for buckets to refill
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(WEBSOCKET_USER_RATE_FACTOR=2, WEBSOCKET_MAX_VIOLATIONS=3, WEBSOCKET_VIOLATION_RATE=1)
+class RateLimitTests(SimpleTestCase):
+    # Bets and chat are limited per socket and per user with token buckets
+    # ----
+    # Test 1: Test that a bucket allows a burst and then its rate
+    # Test 2: Test that bets and chat have separate allowances
+    # Test 3: Test that a user's sockets share an allowance between them
+    # Test 4: Test that a socket with too many messages turned away is reported as abusive
+    # Test 5: Test that the shared allowance goes once the user's last socket closes
+    # Test 6: Test that a rate of 0 stops messages once the burst is used, with no time to retry, and can't go below 0
+
+    def setUp(self):
+        ratelimit._users.clear()
+        self.clock = Clock()
+        patcher = mock.patch('Groups.ratelimit.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_1_bucket(self):
+        bucket = TokenBucket(2, 3)
+
+        self.assertEqual([bucket.take() for x in range(4)], [True, True, True, False])
+        self.assertEqual(bucket.wait(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual([bucket.take() for x in range(2)], [True, False])
+
+    def test_2_kinds(self):
+        limiter = Limiter(AnonymousUser(), 1, {'bet': (1, 2), 'chat': (1, 1)})
+
+        self.assertEqual([limiter.allow('bet') for x in range(3)], [True, True, False])
+        self.assertTrue(limiter.allow('chat'))
+        self.assertFalse(limiter.allow('chat'))
+        self.assertEqual(limiter.retry_after('chat'), 1)
+
+    def test_3_shared_by_user(self):
+        rates = {'bet': (1, 2), 'chat': (1, 2)}
+        limiters = [Limiter(FakeUser(1), 1, rates) for x in range(3)]
+
+        # Each socket can send 2, but the user can only send 4 between them
+        allowed = [limiter.allow('bet') for limiter in limiters for x in range(2)]
+        self.assertEqual(allowed, [True, True, True, True, False, False])
+
+        # Someone else, or the same user in another group, has their own
+        self.assertTrue(Limiter(FakeUser(2), 1, rates).allow('bet'))
+        self.assertTrue(Limiter(FakeUser(1), 2, rates).allow('bet'))
+
+    def test_4_abusive(self):
+        limiter = Limiter(AnonymousUser(), 1, {'bet': (1, 1), 'chat': (1, 1)})
+
+        self.assertEqual([limiter.abusive() for x in range(4)], [False, False, False, True])
+
+    def test_5_close(self):
+        rates = {'bet': (1, 2), 'chat': (1, 2)}
+        limiters = [Limiter(FakeUser(1), 1, rates) for x in range(2)]
+
+        limiters[0].close()
+        self.assertEqual(len(ratelimit._users), 2)
+        limiters[1].close()
+        self.assertEqual(ratelimit._users, {})
+
+    def test_6_rate_of_zero(self):
+        bucket = TokenBucket(0, 1)
+
+        self.assertEqual(bucket.wait(), 0)
+        self.assertEqual([bucket.take() for x in range(2)], [True, False])
+        self.assertIsNone(bucket.wait())
+
+        limiter = Limiter(FakeUser(1), 1, {'bet': (0, 0), 'chat': (1, 1)})
+        self.assertFalse(limiter.allow('bet'))
+        self.assertIsNone(limiter.retry_after('bet'))
+        self.assertTrue(limiter.allow('chat'))
+
+        CommunityGroup._meta.get_field('bet_rate').run_validators(0)
+        with self.assertRaises(ValidationError):
+            CommunityGroup._meta.get_field('chat_rate').run_validators(-1)
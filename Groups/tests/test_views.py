@@ -4,11 +4,13 @@ from django.contrib.auth import get_user_model
 from django.contrib import auth
 from django.urls import reverse
 from Groups.models import CommunityGroup
+from Groups import metrics
 from Games.models import Tournament, Match, Videogame
-from Profiles.models import Wallet
+from Profiles.models import Wallet, Team
 from Bets.models import MatchBettingGroup, Bet
 from django.utils import timezone
 from datetime import datetime
+from decimal import Decimal
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.http import JsonResponse
 from django.template import loader
@@ -821,6 +823,8 @@ class GroupPageTests(TestCase):
     # Test 10: Check that the url variable q correctly filters "completed_tournaments"
     # Test 11: Check that "latest_game_list" Will provide only the most recent 12 games in the correct order
     # Test 12: Check that the url variable q correctly filters "latest_game_list"
+    # Test 13: Check that each match's card splits its pie by the odds on the match
+    # Test 14: Check that the page is read with the same number of queries however many cards and tournaments it has
 
     def setUp(self):
         # Every test needs a client.
@@ -1557,6 +1561,86 @@ class GroupPageTests(TestCase):
         self.assertNotIn(match_5.game_mbgs.all()[0], latest_game_list)
         self.assertNotIn(match_6.game_mbgs.all()[0], latest_game_list)
 
+    def test_13_card_odds(self):
+        user_2 = User.objects.create(username='testuser2')
+        user_2_wallet = Wallet.objects.create(
+            profile=user_2.profile,
+            group=self.group_object,
+            status=Wallet.active
+        )
+        tournament_1 = Tournament.objects.create(
+            name="tournament_1",
+            owning_group=self.group_object,
+            start_datetime=timezone.now() - timezone.timedelta(hours=20),
+            end_datetime=timezone.now() + timezone.timedelta(hours=20)
+        )
+        match_1 = Match.objects.create(
+            user_a=self.wallet,
+            user_b=user_2_wallet,
+            tournament=tournament_1,
+            start_datetime=timezone.now() + timezone.timedelta(hours=1)
+        )
+        match_2 = Match.objects.create(
+            user_a=self.wallet,
+            user_b=user_2_wallet,
+            tournament=tournament_1,
+            start_datetime=timezone.now() + timezone.timedelta(hours=2)
+        )
+        mbg = MatchBettingGroup.objects.get(match=match_1, group=self.group_object)
+        Bet.objects.create(match_betting_group=mbg, wallet=user_2_wallet, amount=30, chosen_user=self.wallet)
+        Bet.objects.create(match_betting_group=mbg, wallet=user_2_wallet, amount=10, chosen_user=user_2_wallet)
+
+        response = self.client.get(reverse('groups:groupPage', kwargs={"group_id": self.group_object.id}))
+
+        self.assertContains(response, 'var teamdata_a_percent = 75.0;')
+        self.assertContains(response, 'var teamdata_b_percent = 25.0;')
+        # A match nobody has bet on yet is split evenly
+        self.assertContains(response, 'var teamdata_a_percent = 50.0;')
+
+    def test_14_constant_queries(self):
+        user_2 = User.objects.create(username='testuser2')
+        user_2_wallet = Wallet.objects.create(
+            profile=user_2.profile,
+            group=self.group_object,
+            status=Wallet.active
+        )
+        team_a = Team.objects.create(name='team_a')
+        team_b = Team.objects.create(name='team_b')
+        address = reverse('groups:groupPage', kwargs={"group_id": self.group_object.id})
+
+        def add_cards(first, last):
+            # Each tournament has its own videogame, one match between users and one between teams
+            for x in range(first, last):
+                tournament = Tournament.objects.create(
+                    name="tournament_{0}".format(x),
+                    owning_group=self.group_object,
+                    start_datetime=timezone.now() - timezone.timedelta(hours=20),
+                    end_datetime=timezone.now() + timezone.timedelta(hours=20),
+                    videogame=Videogame.objects.create(name="videogame_{0}".format(x))
+                )
+                Match.objects.create(
+                    user_a=self.wallet,
+                    user_b=user_2_wallet,
+                    tournament=tournament,
+                    start_datetime=timezone.now() + timezone.timedelta(hours=1)
+                )
+                Match.objects.create(
+                    team_a=team_a,
+                    team_b=team_b,
+                    tournament=tournament,
+                    start_datetime=timezone.now() + timezone.timedelta(hours=1)
+                )
+
+        add_cards(0, 1)
+        with self.assertNumQueries(8):
+            self.client.get(address)
+
+        add_cards(1, 6)
+        with self.assertNumQueries(8):
+            response = self.client.get(address)
+        self.assertEqual(len(response.context['latest_game_list']), 12)
+        self.assertContains(response, 'team_a vs team_b')
+
 
 class LazyLoadTests(TestCase):
     # Lazy_load takes a group_id and a "page" variable via post request
@@ -1575,6 +1659,7 @@ class LazyLoadTests(TestCase):
     # Test 5: Test that the q variable does not have an affect when the tournament_id is submitted
     # Test 6: Test that a member of another group cannot view another groups games by submitting their group's ID and
     # the tournament_id of another group's tournament
+    # Test 7: Test that a full page of games is read with the same number of queries as a part filled one
 
     def setUp(self):
         # Every test needs a client.
@@ -1961,7 +2046,15 @@ class LazyLoadTests(TestCase):
         # Check that the response is 404.
         self.assertEqual(response.status_code, 404)
 
+    def test_7_constant_queries(self):
+        self.client.login(username='testuser', password='12345')
+        address = reverse('groups:lazy_load_posts', kwargs={"group_id": self.group_object.id})
 
+        # 30 games, so the first page is full and the third has 6 on it
+        for page, games in ((1, 12), (3, 6)):
+            with self.assertNumQueries(8):
+                response = self.client.post(address, {"page": page})
+            self.assertEqual(response.content.count(b'TrackPie('), games)
 
 
 class TournamentListViewTests(TestCase):
@@ -4603,6 +4696,7 @@ class MatchViewTests(TestCase):
     # Test 10: Test that an admin cannot change the status to a non standard status i.e. one on the status array within
     #       the Match model
     # Test 11: Test that an admin can successfully set the winner of a match
+    # Test 13: Test that the pool is returned added up per bettor and side
 
     def setUp(self):
         # Every test needs a client.
@@ -5081,3 +5175,58 @@ class MatchViewTests(TestCase):
         # Check that the response is 404.
         self.assertEqual(response.status_code, 404)
 
+    def test_13_pool(self):
+        # Log user in to admin account
+        self.client.login(username='testuser_admin', password='12345')
+
+        address = reverse(self.url, kwargs={'group_id': self.group_object.id, "betting_group_id": self.match_1_betting_group.id})
+
+        # Send the get request
+        response = self.client.get(address)
+
+        pool = response.context['pool']
+
+        # Check that the bets are added up per bettor and side rather than sent one by one
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(pool[0]['name'], 'testuser_nonadmin')
+        self.assertEqual(pool[0]['amount'], Decimal('165.00'))
+        self.assertAlmostEqual(sum(entry['percent'] for entry in pool), 100, places=1)
+
+
+class WebsocketMetricsViewTests(TestCase):
+    # Staff can see the websocket metrics for the process serving the request
+    # ----
+    # Test 1: Test that staff get the metrics back
+    # Test 2: Test that other users are sent to the admin login
+
+    def setUp(self):
+        self.client = Client()
+
+        self.staff_user = User.objects.create(username='testuser_staff', is_staff=True)
+        self.staff_user.set_password('12345')
+        self.staff_user.save()
+
+        self.user = User.objects.create(username='testuser_nonstaff')
+        self.user.set_password('12345')
+        self.user.save()
+
+        metrics.reset()
+        metrics.observe('db_queue_wait', 0.5)
+
+        self.url = reverse('groups:websocketMetrics')
+
+    def test_1_staff(self):
+        self.client.login(username='testuser_staff', password='12345')
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['db_queue_wait']['count'], 1)
+        self.assertEqual(response.json()['viewers'], {})
+
+    def test_2_non_staff(self):
+        self.client.login(username='testuser_nonstaff', password='12345')
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 302)
@@ -20,5 +20,6 @@ urlpatterns = [
     path('<int:group_id>/tournaments/<int:tournament_id>/', views.tournament_view, name='tournament_view'),
     path('<int:group_id>/<int:betting_group_id>/', views.match_view, name='matchView'),
     path('<int:group_id>/completed-games/', views.completed_game_list_view, name='completed_games_list_view'),
+    path('websocket-metrics/', views.websocket_metrics, name='websocketMetrics'),
 
 ]
\ No newline at end of file
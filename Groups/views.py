@@ -16,11 +16,27 @@ from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse_lazy
 from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from .auth import issue_token
+from . import metrics, presence
 
 User = get_user_model()
 # Create your views here.
 landing_page_url = reverse_lazy('profiles:landingPage')
 
+# Everything games_list.html draws on a match's card. The pool totals are kept on the betting group itself, so with
+# these a page of cards is read with one query however many cards it has
+card_related = (
+    'match__team_a',
+    'match__team_b',
+    'match__user_a__profile__user',
+    'match__user_a__group',
+    'match__user_b__profile__user',
+    'match__user_b__group',
+    'match__tournament__videogame'
+)
+
 
 @login_required(login_url=landing_page_url, redirect_field_name="")
 def groupsHome(request):
@@ -206,9 +222,9 @@ def group_page(request, group_id):
     latest_game_list = MatchBettingGroup.objects.filter(
         Q(group__id=group_id),
         Q(status=MatchBettingGroup.active)
-    )
+    ).select_related(*card_related)
 
-    tournament_list = group.owning_group_tournaments.all()
+    tournament_list = group.owning_group_tournaments.select_related('videogame')
 
     # Nd to create separate qurysets for different tournament statuses and only display active tournaments
     # & tournaments not yet begun
@@ -286,7 +302,10 @@ def lazy_load_games(request, group_id, tournament_id=None):
 
     group = get_object_or_404(CommunityGroup, id=group_id)
 
-    latest_game_list = MatchBettingGroup.objects.filter(Q(group__id=group_id), Q(status=MatchBettingGroup.active))
+    latest_game_list = MatchBettingGroup.objects.filter(
+        Q(group__id=group_id),
+        Q(status=MatchBettingGroup.active)
+    ).select_related(*card_related)
     query = request.GET.get('q')
     if tournament_id:
         tournament = get_object_or_404(Tournament, id=tournament_id, owning_group=group)
@@ -361,7 +380,7 @@ def tournament_list_view(request, group_id):
         wallet = Wallet.objects.get(group=group, profile=user.profile, status=Wallet.active)
     except Wallet.DoesNotExist:
         raise Http404('You are not a member of this group.')
-    tournament_list = group.owning_group_tournaments.all()
+    tournament_list = group.owning_group_tournaments.select_related('videogame')
     activesection = request.GET.get('activesection')
     query = request.GET.get('q')
     current_datetime = timezone.now()
@@ -799,7 +818,7 @@ def tournament_view(request, tournament_id, group_id):
     tournament_games = MatchBettingGroup.objects.filter(
         Q(group__id=group_id),
         Q(match__tournament__id=tournament_id)
-    ).order_by('match__start_datetime')[:12]
+    ).select_related(*card_related).order_by('match__start_datetime')[:12]
 
     videogames = Videogame.objects.all()
 
@@ -881,7 +900,7 @@ def completed_game_list_view(request, group_id):
 
     game_list = MatchBettingGroup.objects.filter(
         Q(group__id=group_id)
-    ).order_by('match__start_datetime')
+    ).select_related(*card_related).order_by('match__start_datetime')
 
     query = request.GET.get('q')
     if query:
@@ -921,15 +940,12 @@ def match_view(request, betting_group_id, group_id):
 
     userbets = Bet.objects.all().filter(match_betting_group__id=betting_group_id, wallet=wallet).order_by('created')
     game_bgg = get_object_or_404(MatchBettingGroup, pk=betting_group_id)
-    qs = game_bgg.mbg_bets.all()
 
     static_image_user_a = game_bgg.match.user_a.picture_url
 
     static_image_user_b = game_bgg.match.user_b.picture_url
 
-    total_bet = 0
-    for bet in qs:
-        total_bet += bet.amount
+    total_bet = game_bgg.total_staked
 
     if request.method == "POST":
         # The group must be the owning group to make changes to the match
@@ -988,10 +1004,19 @@ def match_view(request, betting_group_id, group_id):
         'group': group,
         'game_bgg': game_bgg,
         'total_bet': total_bet,
+        'pool': game_bgg.bettor_pool(settings.POOL_TOP_BETTORS),
         'userbets': userbets,
         'wallet': wallet,
         'image_user_a': static_image_user_a,
-        'image_user_b': static_image_user_b
+        'image_user_b': static_image_user_b,
+        # Lets the page's socket sign in without the session being read
+        'socket_token': issue_token(user, wallet, game_bgg.id)
     }
     return render(request, 'groups/match.html', context)
 
+
+@staff_member_required
+def websocket_metrics(request):
+    # Metrics are kept per process, so these are for the websockets served by the process that answered. The viewer
+    # counts cover every process, but only for rooms this one has sockets in
+    return JsonResponse(dict(metrics.snapshot(), viewers=presence.viewer_counts()))